@@ -1,29 +1,144 @@
 import os
+import re
+import hashlib
+import importlib.metadata
+import itertools
+import types
+import contextlib
+import csv
+import copy
+import sys
 import zipfile
 import tempfile
 import io
-from datetime import datetime, timedelta
-from flask import Flask, request, send_file, jsonify
+import base64
+import cProfile
+import functools
+import hmac
+import json
+import math
+import queue
+import signal
+import sqlite3
+import uuid
+import zlib
+from xml.sax.saxutils import escape as xml_escape
+import multiprocessing
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from flask import Flask, Response, g, has_request_context, request, send_file, jsonify
 from flask_cors import CORS
+from werkzeug.http import unquote_etag
+from werkzeug.middleware.proxy_fix import ProxyFix
 
-# --- All your document generation libraries ---
-from docx import Document
-from docx.shared import Inches, Pt, RGBColor, Cm
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.oxml.ns import qn
-from docx.oxml import OxmlElement
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-from reportlab.lib import colors
+# The document generation libraries (python-docx, openpyxl, reportlab) are
+# imported inside the builders, so a process only loads the formats it
+# actually renders and health checks never pay for them.
 
 # --- Flask App Setup ---
 app = Flask(__name__)
 CORS(app)  # Allows the frontend to talk to the backend
 
+# --- Builder Pool Settings ---
+# PACK_WORKERS=1 (or 0) builds every document in the request process, one after another.
+PACK_WORKERS = int(os.environ.get('PACK_WORKERS', min(10, os.cpu_count() or 1)))
+PACK_BUILDER_TIMEOUT = float(os.environ.get('PACK_BUILDER_TIMEOUT', '30'))
+PACK_WORKER_START_TIMEOUT = float(os.environ.get('PACK_WORKER_START_TIMEOUT', '60'))
+# SKELETON_CACHE=0 always renders documents from scratch.
+SKELETON_CACHE_ENABLED = os.environ.get('SKELETON_CACHE', '1') != '0'
+
+# Rendered user guide PDFs kept per (company name, day); 0 lays it out on every build.
+USER_GUIDE_CACHE_SIZE = int(os.environ.get('USER_GUIDE_CACHE_SIZE', '256'))
+# DOCX header/footer XML kept per company
+HEADER_FOOTER_CACHE_SIZE = int(os.environ.get('HEADER_FOOTER_CACHE_SIZE', '256'))
+
+# --- Pack Cache Settings ---
+# Finished ZIPs are kept in memory (LRU); set PACK_CACHE_DIR to add a disk tier.
+PACK_CACHE_MAX_ENTRIES = int(os.environ.get('PACK_CACHE_MAX_ENTRIES', '64'))
+PACK_CACHE_MAX_BYTES = int(os.environ.get('PACK_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+PACK_CACHE_DIR = os.environ.get('PACK_CACHE_DIR')
+PACK_CACHE_TTL = float(os.environ.get('PACK_CACHE_TTL', str(24 * 3600)))
+PACK_CACHE_DISK_MAX_BYTES = int(os.environ.get('PACK_CACHE_DISK_MAX_BYTES', str(512 * 1024 * 1024)))
+
+# --- ZIP Assembly Settings ---
+# Packs are zipped in memory; a non-zero PACK_SPOOL_MAX_BYTES spills larger archives to a temp file.
+PACK_SPOOL_MAX_BYTES = int(os.environ.get('PACK_SPOOL_MAX_BYTES', '0'))
+# --- Metrics Settings ---
+# Stage timings feed the Prometheus histograms on /metrics (per process).
+METRICS_ENABLED = os.environ.get('METRICS', '1') != '0'
+# SERVER_TIMING=1 adds a Server-Timing header with the stage totals to buffered responses.
+SERVER_TIMING_ENABLED = os.environ.get('SERVER_TIMING', '0') == '1'
+
+# --- Profiling Settings ---
+# Requests carrying X-Profile-Token: <PROFILE_ADMIN_TOKEN> are profiled (disabled when unset).
+PROFILE_ADMIN_TOKEN = os.environ.get('PROFILE_ADMIN_TOKEN')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'template_pack_profiles'))
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', '0.005'))
+# Only the newest PROFILE_MAX_FILES dumps are kept; 0 = keep them all.
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', '50'))
+
+# --- Batch Settings ---
+BATCH_MAX_COMPANIES = int(os.environ.get('BATCH_MAX_COMPANIES', '500'))
+# Companies built at the same time; their documents share the builder pool.
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '4'))
+
+# --- Job Queue Settings ---
+# Async jobs live in a local SQLite file, so any gunicorn worker can answer a poll.
+JOB_DB_PATH = os.environ.get('JOB_DB_PATH', os.path.join(tempfile.gettempdir(), 'template_pack_jobs.sqlite3'))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))  # background threads per process
+JOB_QUEUE_MAX = int(os.environ.get('JOB_QUEUE_MAX', '100'))
+JOB_RESULT_TTL = float(os.environ.get('JOB_RESULT_TTL', '3600'))
+JOB_TIMEOUT = float(os.environ.get('JOB_TIMEOUT', '600'))
+
+# --- Admission Control Settings ---
+# Requests are priced in document builds: one per selected document plus one per
+# ADMISSION_ROWS_PER_COST line items, equipment rows or service log entries.
+ADMISSION_ROWS_PER_COST = int(os.environ.get('ADMISSION_ROWS_PER_COST', '100'))
+# Token buckets refill at *_RATE builds per second up to *_BURST; a rate of 0 turns the bucket off.
+# Clients are told apart by address. An X-API-Key only gets a bucket of its own if it is one of
+# RATE_LIMIT_API_KEYS (comma-separated), so made-up keys can't mint fresh buckets.
+RATE_LIMIT_API_KEYS = [key.strip() for key in os.environ.get('RATE_LIMIT_API_KEYS', '').split(',') if key.strip()]
+# Behind a reverse proxy every request comes from the proxy's address, so all clients would share
+# one bucket: set TRUSTED_PROXY_HOPS to the number of proxies that append to X-Forwarded-For.
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', '0'))
+RATE_LIMIT_KEY_RATE = float(os.environ.get('RATE_LIMIT_KEY_RATE', '0'))
+RATE_LIMIT_KEY_BURST = float(os.environ.get('RATE_LIMIT_KEY_BURST', '50'))
+RATE_LIMIT_GLOBAL_RATE = float(os.environ.get('RATE_LIMIT_GLOBAL_RATE', '0'))
+RATE_LIMIT_GLOBAL_BURST = float(os.environ.get('RATE_LIMIT_GLOBAL_BURST', '200'))
+# Buckets live in process memory unless RATE_LIMIT_DB names a SQLite file all workers share.
+RATE_LIMIT_DB = os.environ.get('RATE_LIMIT_DB')
+# Builds in flight per process, in cost units (0 = no cap). Past it, up to
+# ADMISSION_QUEUE_MAX requests wait at most ADMISSION_MAX_WAIT seconds, then get a 429.
+ADMISSION_MAX_INFLIGHT = float(os.environ.get('ADMISSION_MAX_INFLIGHT', '20'))
+ADMISSION_QUEUE_MAX = int(os.environ.get('ADMISSION_QUEUE_MAX', '8'))
+ADMISSION_MAX_WAIT = float(os.environ.get('ADMISSION_MAX_WAIT', '10'))
+
+# --- Memory Settings ---
+# MEMORY_TRACE=1 adds tracemalloc peaks to the per-builder memory metrics (slows builds down noticeably).
+MEMORY_TRACE = os.environ.get('MEMORY_TRACE', '0') == '1'
+# Opt-in: with MEMORY_PER_DOCUMENT_MB set (8 is a reasonable start), a build is admitted only if
+# its estimate fits in the memory the host/container has left, less MEMORY_RESERVE_MB.
+MEMORY_PER_DOCUMENT_MB = float(os.environ.get('MEMORY_PER_DOCUMENT_MB', '0'))  # per document built at once
+MEMORY_PER_ROW_KB = float(os.environ.get('MEMORY_PER_ROW_KB', '8'))  # per line item / equipment row / log entry
+MEMORY_RESERVE_MB = float(os.environ.get('MEMORY_RESERVE_MB', '256'))
+# Retire the builder pool (gracefully) once one of its workers reports more RSS than this; 0 = never.
+PACK_WORKER_MAX_RSS_MB = float(os.environ.get('PACK_WORKER_MAX_RSS_MB', '0'))
+
+# PACK_COMPRESSION picks how members are stored in the pack ZIP:
+#   policy   - store DOCX/XLSX (already deflated inside), deflate everything else
+#   adaptive - deflate a file type only if its first member shrinks by PACK_ADAPTIVE_MIN_SAVING
+#   deflate  - deflate everything (the old behaviour);  stored - no compression at all
+PACK_COMPRESSION = os.environ.get('PACK_COMPRESSION', 'policy')
+PACK_COMPRESS_LEVEL = int(os.environ.get('PACK_COMPRESS_LEVEL', '6'))
+PACK_ADAPTIVE_MIN_SAVING = float(os.environ.get('PACK_ADAPTIVE_MIN_SAVING', '0.10'))
+# PACK_STREAMING=1 streams every uncached pack; otherwise clients opt in with ?stream=1.
+PACK_STREAMING = os.environ.get('PACK_STREAMING', '0') == '1'
+
 # --- Text & Disclaimers ---
 DISCLAIMER_TEXT = (
     "This document is a template and is provided for general informational and educational "
@@ -36,33 +151,197 @@ DISCLAIMER_TEXT = (
 DISCLAIMER_EN = "This document is a template only and not legal advice. Please consult with a qualified legal professional to ensure compliance with local laws."
 DISCLAIMER_MS = "Dokumen ini hanyalah templat dan bukan nasihat undang-undang. Sila berunding dengan profesional undang-undang yang berkelayakan untuk memastikan pematuhan undang-undang tempatan."
 
+# --- Clock ---
+# Builders read the date through today() so the skeleton cache can pin it.
+_clock = threading.local()
+DATE_FIELD = '@date'  # stands for today() in document_fields()
+
+
+def today():
+    reads = getattr(_clock, 'reads', None)
+    if reads is not None:  # document_fields() is watching
+        reads.add(DATE_FIELD)
+    return getattr(_clock, 'pinned', None) or datetime.now()
+
+
+@contextlib.contextmanager
+def pinned_clock(moment):
+    _clock.pinned = moment
+    try:
+        yield
+    finally:
+        _clock.pinned = None
+
+
+# --- Stage Timing & Metrics ---
+# Builders mark their expensive steps with `with stage(...)`. Timings are only
+# collected while render_document_timed() is recording, so direct calls cost a
+# single attribute lookup.
+_stage_recorder = threading.local()
+
+
+@contextlib.contextmanager
+def stage(name):
+    entries = getattr(_stage_recorder, 'entries', None)
+    if entries is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        entries.append((name, time.perf_counter() - started))
+
+
+class Histogram:
+    """Minimal thread-safe Prometheus histogram."""
+
+    def __init__(self, name, help_text, label_names,
+                 buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series_items = sorted((labels, list(series)) for labels, series in self._series.items())
+        for label_values, series in series_items:
+            labels = ','.join(f'{name}="{value}"' for name, value in zip(self.label_names, label_values))
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound:g}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {series[-1]}')
+            lines.append(f'{self.name}_sum{{{labels}}} {series[-2]:.6f}')
+            lines.append(f'{self.name}_count{{{labels}}} {series[-1]}')
+        return lines
+
+
+STAGE_SECONDS = Histogram('pack_stage_seconds', 'Time spent in each document generation stage.', ('stage', 'document'))
+REQUEST_SECONDS = Histogram('pack_request_seconds', 'Request latency by endpoint and status.', ('endpoint', 'status'))
+
+
+MIB = 1024 * 1024
+BUILDER_RSS_DELTA = Histogram('pack_builder_rss_delta_bytes', 'Growth of the building process RSS per document.',
+                              ('document',), buckets=(0, MIB, 4 * MIB, 16 * MIB, 64 * MIB, 256 * MIB, 1024 * MIB))
+BUILDER_PEAK = Histogram('pack_builder_peak_bytes', 'tracemalloc peak per document build (MEMORY_TRACE=1).',
+                         ('document',), buckets=(MIB, 4 * MIB, 16 * MIB, 64 * MIB, 256 * MIB, 1024 * MIB))
+
+if MEMORY_TRACE:
+    tracemalloc.start()  # before any fork, so builder workers inherit it
+
+
+def current_rss():
+    """This process's resident set size in bytes, or None where /proc isn't available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def memory_available():
+    """Bytes the host, or the container's cgroup if tighter, can still hand out (None if unknown).
+
+    The cgroup's inactive page cache counts as free: the kernel reclaims it
+    before it would OOM-kill anything.
+    """
+    limits = []
+    with contextlib.suppress(OSError, ValueError, StopIteration):
+        with open('/proc/meminfo') as f:
+            limits.append(int(next(line for line in f if line.startswith('MemAvailable:')).split()[1]) * 1024)
+    with contextlib.suppress(OSError, ValueError):
+        with open('/sys/fs/cgroup/memory.max') as f:
+            limit = f.read().strip()
+        if limit != 'max':
+            with open('/sys/fs/cgroup/memory.current') as f:
+                current = int(f.read())
+            with contextlib.suppress(OSError, StopIteration):
+                with open('/sys/fs/cgroup/memory.stat') as f:
+                    current -= int(next(line for line in f if line.startswith('inactive_file ')).split()[1])
+            limits.append(int(limit) - current)
+    return min(limits) if limits else None
+
+
+def record_memory(document, usage):
+    """Feed one build's memory use (see render_document_timed) into the histograms."""
+    if not METRICS_ENABLED:
+        return
+    if usage.get('rss_delta') is not None:
+        BUILDER_RSS_DELTA.observe(usage['rss_delta'], document)
+    if usage.get('peak') is not None:
+        BUILDER_PEAK.observe(usage['peak'], document)
+
+
+def record_stages(document, entries):
+    """Feed stage timings into the histograms and this request's Server-Timing totals."""
+    if not METRICS_ENABLED:
+        return
+    for name, seconds in entries:
+        STAGE_SECONDS.observe(seconds, name, document)
+    if SERVER_TIMING_ENABLED and has_request_context():
+        totals = g.setdefault('server_timing', {})
+        for name, seconds in entries:
+            totals[name] = totals.get(name, 0.0) + seconds
+
 
 # ============================================================================
 # ALL 10 OF YOUR DOCUMENT GENERATION FUNCTIONS + HELPER
 # (Copied directly from your script)
 # ============================================================================
 
-def add_header_footer(doc, company_info):
-    section = doc.sections[0]
-    
+@functools.lru_cache(maxsize=None)
+def docx_template():
+    """python-docx's default package, parsed once per process; never handed out itself."""
+    from docx import Document
+    return Document()
+
+
+def new_docx():
+    """A fresh blank Document: a deep copy of the template package instead of re-reading default.docx."""
+    return copy.deepcopy(docx_template())
+
+
+@functools.lru_cache(maxsize=HEADER_FOOTER_CACHE_SIZE)
+def company_header_footer(name, phone, email, tax_id, reg_no):
+    """(w:hdr, w:ftr) elements for one company, built once; callers attach deep copies."""
+    from docx.oxml import OxmlElement, parse_xml
+    from docx.oxml.ns import qn
+    from docx.parts.hdrftr import FooterPart, HeaderPart
+    from docx.shared import Pt, RGBColor
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    from docx.text.paragraph import Paragraph
+    hdr = parse_xml(HeaderPart._default_header_xml())
+    ftr = parse_xml(FooterPart._default_footer_xml())
+
     # Header
-    header = section.header
-    header_para = header.paragraphs[0]
-    header_para.text = company_info['name']
+    header_para = Paragraph(hdr.p_lst[0], None)
+    header_para.text = name
     header_para.runs[0].font.bold = True
     header_para.runs[0].font.size = Pt(12)
     header_para.runs[0].font.color.rgb = RGBColor(31, 78, 120) # Dark Blue
-    
+
     # Footer
-    footer = section.footer
-    footer_para = footer.paragraphs[0]
-    footer_text = (f"Phone: {company_info['phone']} | Email: {company_info['email']} | "
-                   f"Tax ID: {company_info['tax_id']} | Reg: {company_info['reg_no']}")
-    
+    footer_para = Paragraph(ftr.p_lst[0], None)
+    footer_text = f"Phone: {phone} | Email: {email} | Tax ID: {tax_id} | Reg: {reg_no}"
+
     run = footer_para.add_run(footer_text + " | Page ")
     run.font.size = Pt(8)
     run.font.color.rgb = RGBColor(128, 128, 128)
-    
+
     run = footer_para.add_run()
     fldChar = OxmlElement('w:fldChar')
     fldChar.set(qn('w:fldCharType'), 'begin')
@@ -78,12 +357,293 @@ def add_header_footer(doc, company_info):
     fldChar = OxmlElement('w:fldChar')
     fldChar.set(qn('w:fldCharType'), 'end')
     run._r.append(fldChar)
-    
+
     footer_para.alignment = WD_ALIGN_PARAGRAPH.LEFT
+    return hdr, ftr
+
+
+def add_header_footer(doc, company_info):
+    """Give doc's first section the company header and the page-numbered footer."""
+    from docx.enum.section import WD_HEADER_FOOTER
+    from docx.opc.constants import CONTENT_TYPE as CT, RELATIONSHIP_TYPE as RT
+    from docx.parts.hdrftr import FooterPart, HeaderPart
+    with stage('header_footer'):
+        hdr, ftr = company_header_footer(company_info['name'], company_info['phone'], company_info['email'],
+                                         company_info['tax_id'], company_info['reg_no'])
+        # What section.header/section.footer do when they add a definition,
+        # but with a copy of the cached part XML instead of python-docx's
+        # template read from disk and filled in run by run.
+        package = doc.part.package
+        sectPr = doc.sections[0]._sectPr
+        header_part = HeaderPart(package.next_partname('/word/header%d.xml'), CT.WML_HEADER, copy.deepcopy(hdr), package)
+        sectPr.add_headerReference(WD_HEADER_FOOTER.PRIMARY, doc.part.relate_to(header_part, RT.HEADER))
+        footer_part = FooterPart(package.next_partname('/word/footer%d.xml'), CT.WML_FOOTER, copy.deepcopy(ftr), package)
+        sectPr.add_footerReference(WD_HEADER_FOOTER.PRIMARY, doc.part.relate_to(footer_part, RT.FOOTER))
+
+
+@functools.lru_cache(maxsize=None)
+def xlsx_style_parts():
+    """Font/fill/border/alignment/number format of every pack cell style.
+
+    Built once per process; openpyxl style objects are treated as immutable, so
+    every workbook shares them.
+    """
+    from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+    thin = Side(style='thin')
+    border = Border(left=thin, right=thin, top=thin, bottom=thin)
+    header_fill = PatternFill(start_color="1F4E78", end_color="1F4E78", fill_type="solid")
+    header_font = Font(color="FFFFFF", bold=True, size=11)
+    bold = Font(bold=True)
+    amount = '#,##0.00'
+    return types.MappingProxyType({
+        'Pack Title': dict(font=Font(size=16, bold=True, color="1F4E78")),
+        'Pack Title Centered': dict(font=Font(size=16, bold=True, color="1F4E78"), alignment=Alignment(horizontal='center')),
+        'Pack Centered': dict(alignment=Alignment(horizontal='center')),
+        'Pack Bold': dict(font=bold),
+        'Pack Italic': dict(font=Font(italic=True)),
+        'Pack Label': dict(font=bold, alignment=Alignment(horizontal='right')),
+        'Pack Header': dict(font=header_font, fill=header_fill, border=border),
+        'Pack Log Header': dict(font=Font(color="FFFFFF", bold=True, size=10), fill=header_fill, border=border,
+                                alignment=Alignment(horizontal='center', vertical='center', wrap_text=True)),
+        'Pack Cell': dict(border=border),
+        'Pack Amount Cell': dict(border=border, number_format=amount),
+        'Pack Days Cell': dict(border=border, number_format='General" days"'),
+        'Pack Amount': dict(number_format=amount),
+        'Pack Total': dict(font=header_font, fill=header_fill),
+        'Pack Total Amount': dict(font=header_font, fill=header_fill, number_format=amount),
+    })
+
+
+def add_xlsx_styles(wb, *names):
+    """Register the named pack styles on wb so cells can take them by name."""
+    from openpyxl.styles import NamedStyle
+    from openpyxl.styles.borders import DEFAULT_BORDER
+    from openpyxl.styles.fills import DEFAULT_EMPTY_FILL
+    from openpyxl.styles.fonts import DEFAULT_FONT
+    parts = xlsx_style_parts()
+    for name in names:
+        # Unset parts fall back to what a plain cell has, not to NamedStyle's bare defaults.
+        # NamedStyle binds to one workbook, so each workbook gets its own wrapper.
+        style = dict(dict(font=DEFAULT_FONT, fill=DEFAULT_EMPTY_FILL, border=DEFAULT_BORDER), **parts[name])
+        wb.add_named_style(NamedStyle(name=name, **style))
+
+
+def write_xlsx_row(ws, row, values, styles=None, column=1):
+    """Write values along one row from column; styles is one style name or one per value."""
+    if styles is None or isinstance(styles, str):
+        styles = [styles] * len(values)
+    for col, (value, style) in enumerate(zip(values, styles), column):
+        if value is None and style is None:
+            continue
+        cell = ws.cell(row=row, column=col, value=value)
+        if style is not None:
+            cell.style = style
+
+
+def styled_cell(ws, value, style):
+    """A write-only worksheet cell carrying one of the named pack styles."""
+    from openpyxl.cell import WriteOnlyCell
+    cell = WriteOnlyCell(ws, value=value)
+    cell.style = style
+    return cell
+
+
+class InvalidField(ValueError):
+    """A request field the builders can't use; routes check for these up front and answer 400."""
+
+    def __init__(self, field, message):
+        super().__init__(message)
+        self.field = field
+
+    def to_dict(self):
+        return {"error": str(self), "field": self.field}
+
+
+def parse_number(value, field, what):
+    """value as a finite int or float; numeric strings such as '1,200.50' are accepted."""
+    number = None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        number = value
+    elif isinstance(value, str):  # CSV cells and loosely typed JSON
+        with contextlib.suppress(ValueError):
+            number = float(value.replace(',', ''))
+            number = int(number) if number.is_integer() else number
+    # float() takes 'nan' and 'inf' (and JSON NaN/Infinity parse to them); they'd end up as cached cell values
+    if number is None or not math.isfinite(number):
+        raise InvalidField(field, f"{what} {value!r} is not a number")
+    return number
+
+
+LINE_ITEM_FIELDS = ('description', 'quantity', 'unit_price')
+
+
+def document_line_items(COMPANY_INFO, sample_data):
+    """(description, quantity, unit price) rows from the request's line_items, or sample_data."""
+    items = COMPANY_INFO.get('line_items')
+    if items is None:
+        return sample_data
+    if not isinstance(items, list) or not items:
+        raise InvalidField('line_items', "line_items must be a non-empty list")
+    rows = []
+    for index, item in enumerate(items, 1):
+        if isinstance(item, dict):
+            description, quantity, unit_price = (item.get(field) for field in LINE_ITEM_FIELDS)
+        elif isinstance(item, (list, tuple)) and len(item) == len(LINE_ITEM_FIELDS):
+            description, quantity, unit_price = item
+        else:
+            raise InvalidField('line_items', f"line_items row {index} must be an object or a [description, quantity, unit_price] list")
+        if description is not None and not isinstance(description, (str, int, float)):
+            raise InvalidField('line_items', f"line_items row {index}: description must be text")
+        quantity = parse_number(quantity, 'line_items', f"line_items row {index}: quantity")
+        unit_price = parse_number(unit_price, 'line_items', f"line_items row {index}: unit_price")
+        if not math.isfinite(quantity * unit_price):
+            raise InvalidField('line_items', f"line_items row {index}: amount is out of range")
+        rows.append((description, quantity, unit_price))
+    return rows
+
+
+EQUIPMENT_FIELDS = ('equipment_id', 'description', 'make_model', 'condition', 'replacement_value')
+
+
+def equipment_schedule(COMPANY_INFO, sample_data):
+    """Equipment schedule rows (replacement value last) from the request's equipment list, or sample_data."""
+    equipment = COMPANY_INFO.get('equipment')
+    if equipment is None:
+        return sample_data
+    if not isinstance(equipment, list) or not equipment:
+        raise InvalidField('equipment', "equipment must be a non-empty list")
+    rows = []
+    for index, item in enumerate(equipment, 1):
+        if isinstance(item, dict):
+            values = [item.get(field) for field in EQUIPMENT_FIELDS]
+        elif isinstance(item, (list, tuple)) and len(item) == len(EQUIPMENT_FIELDS):
+            values = list(item)
+        else:
+            raise InvalidField('equipment', f"equipment row {index} must be an object or a list of {len(EQUIPMENT_FIELDS)} values")
+        values = ['' if value is None else value for value in values]
+        values[-1] = parse_number(values[-1], 'equipment', f"equipment row {index}: replacement_value")
+        rows.append(values)
+    return rows
+
+
+def document_client(COMPANY_INFO):
+    client = COMPANY_INFO.get('client') or {}
+    if not isinstance(client, dict):
+        raise InvalidField('client', "client must be an object")
+    return client
+
+
+def write_line_items(ws, start_row, items, styles):
+    """Write line items from start_row with an amount formula each; returns {amount cell: amount}."""
+    amounts = {}
+    with stage('tables'):
+        for row, (description, quantity, unit_price) in enumerate(items, start_row):
+            write_xlsx_row(ws, row, [description, quantity, unit_price, f"=B{row}*C{row}"], styles)
+            amounts[f'D{row}'] = quantity * unit_price
+    return amounts
+
+
+# A formula cell as openpyxl writes it, whatever its attribute order and however it spells the empty value
+FORMULA_CELL_PATTERN = re.compile(rb'<c( [^>]*)><f>([^<]*)</f>(?:<v></v>|<v ?/>)?</c>')
+CELL_REFERENCE_PATTERN = re.compile(rb' r="([A-Z]+[0-9]+)"')
+
+
+def save_with_formula_values(wb, values, sheet='xl/worksheets/sheet1.xml'):
+    """Save wb with the given results ({'D15': 42500, ...}) cached in its formula cells.
+
+    openpyxl leaves every formula's cached value empty, which viewers that
+    don't recalculate (previews, mobile apps, most converters) show as blank.
+    Excel still recalculates on open.
+    """
+    buffer = io.BytesIO()
+    with stage('save'):
+        wb.save(buffer)
+
+    filled = set()
+
+    def fill(match):
+        reference = CELL_REFERENCE_PATTERN.search(match.group(1))
+        value = None if reference is None else values.get(reference.group(1).decode())
+        if value is None:
+            return match.group(0)
+        filled.add(reference.group(1).decode())
+        return b'<c%s><f>%s</f><v>%s</v></c>' % (match.group(1), match.group(2), repr(value).encode())
+
+    output = io.BytesIO()
+    with stage('formula_values'), zipfile.ZipFile(buffer) as source, zipfile.ZipFile(output, 'w') as target:
+        for info in source.infolist():
+            data = source.read(info)
+            target.writestr(info, FORMULA_CELL_PATTERN.sub(fill, data) if info.filename == sheet else data)
+    if len(filled) < len(values):
+        # openpyxl changed how it writes formula cells; the workbook is still right, just blank in previews
+        print(f"Cached no value for {', '.join(sorted(set(values) - filled))} in {sheet}")
+    output.seek(0)
+    return output
+
+
+def docx_run_xml(text, bold=False, color=None):
+    """One w:r for text the way python-docx writes it: tabs and line breaks become w:tab/w:br."""
+    props = ('<w:b/>' if bold else '') + (f'<w:color w:val="{color}"/>' if color else '')
+    parts = [f'<w:rPr>{props}</w:rPr>'] if props else []
+    for piece in re.split(r'([\t\n\r])', text):
+        if piece == '\t':
+            parts.append('<w:tab/>')
+        elif piece in ('\n', '\r'):
+            parts.append('<w:br/>')
+        elif piece:
+            space = ' xml:space="preserve"' if piece != piece.strip() else ''
+            parts.append(f'<w:t{space}>{xml_escape(piece)}</w:t>')
+    return f"<w:r>{''.join(parts)}</w:r>"
+
+
+def add_docx_table(doc, rows, style=None, widths=None):
+    """Append a table built from rows of cell values in a single pass.
+
+    A cell is its text, or a dict with 'text' and optional 'bold', 'color'
+    (hex RGB) and 'span' (columns to merge, like cell.merge()). The rows' XML
+    is generated as one string and parsed once, so the cost is linear in the
+    number of cells; filling python-docx's table.rows[i].cells[j] proxies is
+    quadratic in the row width and slow for long tables.
+    """
+    from docx.oxml import parse_xml
+    from docx.oxml.ns import nsdecls
+    cols = len(widths) if widths else max(sum(cell.get('span', 1) if isinstance(cell, dict) else 1 for cell in row)
+                                          for row in rows)
+    table = doc.add_table(rows=0, cols=cols)
+    if style is not None:
+        table.style = style
+    # Cells keep python-docx's even split even when the grid columns are resized
+    cell_width = table._tbl.tblGrid.gridCol_lst[0].w.twips
+    for column, width in zip(table.columns, widths or ()):
+        column.width = width
+
+    xml = []
+    for row in rows:
+        xml.append('<w:tr>')
+        for cell in row:
+            if not isinstance(cell, dict):
+                cell = {'text': cell}
+            span = cell.get('span', 1)
+            grid_span = f'<w:gridSpan w:val="{span}"/>' if span > 1 else ''
+            xml.append(f'<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{cell_width * span}"/>{grid_span}</w:tcPr>'
+                       f'<w:p>{docx_run_xml(str(cell["text"]), cell.get("bold", False), cell.get("color"))}</w:p></w:tc>')
+        xml.append('</w:tr>')
+    table._tbl.extend(parse_xml(f'<w:tbl {nsdecls("w")}>{"".join(xml)}</w:tbl>').tr_lst)
+    return table
+
+
+def docx_form_rows(fields, heading_color='1F4E78'):
+    """(label, value) pairs as two-column rows; an empty value makes the label a full-width heading."""
+    return [[{'text': label, 'bold': True, 'color': heading_color, 'span': 2}] if value == '' else [label, value]
+            for label, value in fields]
+
 
 # --- DOC 1 ---
 def create_rental_agreement(COMPANY_INFO):
-    doc = Document()
+    from docx.shared import Pt
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    with stage('document'):
+        doc = new_docx()
     add_header_footer(doc, COMPANY_INFO)
     
     title = doc.add_heading('EQUIPMENT RENTAL AGREEMENT', 0)
@@ -127,21 +687,17 @@ def create_rental_agreement(COMPANY_INFO):
     
     doc.add_heading('1.2 Equipment Schedule', level=3)
     doc.add_paragraph("The following equipment ('Equipment') is subject to the terms of this Agreement:")
-    table = doc.add_table(rows=4, cols=5)
-    table.style = 'Light Grid Accent 1'
-    headers = ['Equipment ID', 'Description', 'Make & Model', 'Condition', 'Replacement Value (RM)']
-    for i, header in enumerate(headers):
-        table.rows[0].cells[i].text = header
-        table.rows[0].cells[i].paragraphs[0].runs[0].font.bold = True
-    sample_data = [
-        ['EQ-001', 'Hydraulic Excavator', 'Caterpillar 320', 'Good, 1,200 hrs', '450000'],
-        ['EQ-002', 'Wheel Loader', 'Komatsu WA470', 'Good, 2,100 hrs', '380000'],
-        ['EQ-003', 'Air Compressor', 'Atlas Copco', 'Good, 4,500 hrs', '95000']
-    ]
-    for row_idx, data in enumerate(sample_data, 1):
-        for col_idx, value in enumerate(data):
-            table.rows[row_idx].cells[col_idx].text = str(value)
-    doc.add_paragraph('Total Replacement Value: RM 925,000')
+    with stage('tables'):
+        headers = ['Equipment ID', 'Description', 'Make & Model', 'Condition', 'Replacement Value (RM)']
+        sample_data = [
+            ['EQ-001', 'Hydraulic Excavator', 'Caterpillar 320', 'Good, 1,200 hrs', 450000],
+            ['EQ-002', 'Wheel Loader', 'Komatsu WA470', 'Good, 2,100 hrs', 380000],
+            ['EQ-003', 'Air Compressor', 'Atlas Copco', 'Good, 4,500 hrs', 95000]
+        ]
+        schedule = equipment_schedule(COMPANY_INFO, sample_data)
+        add_docx_table(doc, [[{'text': header, 'bold': True} for header in headers]] + schedule,
+                       style='Light Grid Accent 1')
+    doc.add_paragraph(f'Total Replacement Value: RM {sum(row[-1] for row in schedule):,}')
     doc.add_paragraph()
     
     doc.add_heading('2. FINANCIAL TERMS AND SECURITY DEPOSIT', level=1)
@@ -253,30 +809,25 @@ def create_rental_agreement(COMPANY_INFO):
     doc.add_page_break()
     doc.add_heading('SIGNATURES / TANDATANGAN', level=1)
     doc.add_paragraph("IN WITNESS WHEREOF, the parties have executed this Agreement as of the date first written above.")
-    sig_table = doc.add_table(rows=7, cols=2)
-    sig_table.style = 'Table Grid'
-    sig_table.rows[0].cells[0].text = 'PROVIDER / PEMBEKAL'
-    sig_table.rows[0].cells[1].text = 'CLIENT / PELANGGAN'
-    sig_table.rows[0].cells[0].paragraphs[0].runs[0].font.bold = True
-    sig_table.rows[0].cells[1].paragraphs[0].runs[0].font.bold = True
-    sig_table.rows[1].cells[0].text = COMPANY_INFO['name']
-    sig_table.rows[1].cells[1].text = '<<Client Company Name>>'
-    sig_table.rows[2].cells[0].text = '\n\nSigned: _____________________'
-    sig_table.rows[2].cells[1].text = '\n\nSigned: _____________________'
-    sig_table.rows[3].cells[0].text = 'Name: _____________________'
-    sig_table.rows[3].cells[1].text = 'Name: _____________________'
-    sig_table.rows[4].cells[0].text = 'Title: _____________________'
-    sig_table.rows[4].cells[1].text = 'Title: _____________________'
-    sig_table.rows[5].cells[0].text = 'Date: _____________________'
-    sig_table.rows[5].cells[1].text = 'Date: _____________________'
-    sig_table.rows[6].cells[0].text = '\n\nStamp: [Company Stamp]'
-    sig_table.rows[6].cells[1].text = '\n\nStamp: [Company Stamp]'
+    with stage('tables'):
+        add_docx_table(doc, [
+            [{'text': 'PROVIDER / PEMBEKAL', 'bold': True}, {'text': 'CLIENT / PELANGGAN', 'bold': True}],
+            [COMPANY_INFO['name'], '<<Client Company Name>>'],
+            ['\n\nSigned: _____________________'] * 2,
+            ['Name: _____________________'] * 2,
+            ['Title: _____________________'] * 2,
+            ['Date: _____________________'] * 2,
+            ['\n\nStamp: [Company Stamp]'] * 2,
+        ], style='Table Grid')
     
     return doc
 
 # --- DOC 2 ---
 def create_booking_form(COMPANY_INFO):
-    doc = Document()
+    from docx.shared import Inches, Pt
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    with stage('document'):
+        doc = new_docx()
     add_header_footer(doc, COMPANY_INFO)
     
     title = doc.add_heading('MACHINERY BOOKING FORM', 0)
@@ -288,171 +839,162 @@ def create_booking_form(COMPANY_INFO):
     doc.add_paragraph(DISCLAIMER_MS).runs[0].font.size = Pt(8)
     doc.add_paragraph()
     
-    table = doc.add_table(rows=31, cols=2)
-    table.style = 'Light Grid Accent 1'
-    table.columns[0].width = Inches(2.5)
-    table.columns[1].width = Inches(4.0)
-    
-    fields = [
-        ('Booking Date', datetime.now().strftime('%d-%m-%Y')),
-        ('Booking Reference', '<<BK-YYMMDD-XXXXX>>'),
-        ('', ''),
-        ('CLIENT COMPANY DETAILS', ''),
-        ('Company Name', '<<Company Name>>'),
-        ('Registration No.', '<<Registration>>'),
-        ('Address', '<<Address>>'),
-        ('Phone', '<<Phone>>'),
-        ('Email', '<<Email>>'),
-        ('', ''),
-        ('SITE CONTACT PERSON', ''),
-        ('Name', '<<Contact Name>>'),
-        ('Phone', '<<Contact Phone>>'),
-        ('', ''),
-        ('RENTAL SITE', ''),
-        ('Site Name', '<<Site Name>>'),
-        ('Site Address', '<<Site Address>>'),
-        ('', ''),
-        ('RENTAL PERIOD & PAYMENT', ''),
-        ('Start Date & Time', '<<Date & Time>>'),
-        ('End Date & Time', '<<Date & Time>>'),
-        ('Duration', '<<Days/Weeks>>'),
-        ('Purchase Order (PO) #', '<<PO Number>>'),
-        ('', ''),
-        ('EQUIPMENT REQUIRED', ''),
-        ('Equipment 1', '<<Description>> - Qty: <<Qty>>'),
-        ('Equipment 2', '<<Description>> - Qty: <<Qty>>'),
-        ('Operator Required?', '☐ Yes  ☐ No'),
-        ('', ''),
-        ('Authorized By', '<<Name>>'),
-        ('Signature', '\n\n_______________________'),
-    ]
-    
-    for i, (field, value) in enumerate(fields):
-        cell1 = table.rows[i].cells[0]
-        cell2 = table.rows[i].cells[1]
-        
-        if value == '':
-            cell1.merge(cell2)
-            cell1.text = field
-            cell1.paragraphs[0].runs[0].font.bold = True
-            cell1.paragraphs[0].runs[0].font.color.rgb = RGBColor(31, 78, 120)
-        else:
-            cell1.text = field
-            cell2.text = value
+    with stage('tables'):
+        fields = [
+            ('Booking Date', today().strftime('%d-%m-%Y')),
+            ('Booking Reference', '<<BK-YYMMDD-XXXXX>>'),
+            ('', ''),
+            ('CLIENT COMPANY DETAILS', ''),
+            ('Company Name', '<<Company Name>>'),
+            ('Registration No.', '<<Registration>>'),
+            ('Address', '<<Address>>'),
+            ('Phone', '<<Phone>>'),
+            ('Email', '<<Email>>'),
+            ('', ''),
+            ('SITE CONTACT PERSON', ''),
+            ('Name', '<<Contact Name>>'),
+            ('Phone', '<<Contact Phone>>'),
+            ('', ''),
+            ('RENTAL SITE', ''),
+            ('Site Name', '<<Site Name>>'),
+            ('Site Address', '<<Site Address>>'),
+            ('', ''),
+            ('RENTAL PERIOD & PAYMENT', ''),
+            ('Start Date & Time', '<<Date & Time>>'),
+            ('End Date & Time', '<<Date & Time>>'),
+            ('Duration', '<<Days/Weeks>>'),
+            ('Purchase Order (PO) #', '<<PO Number>>'),
+            ('', ''),
+            ('EQUIPMENT REQUIRED', ''),
+            ('Equipment 1', '<<Description>> - Qty: <<Qty>>'),
+            ('Equipment 2', '<<Description>> - Qty: <<Qty>>'),
+            ('Operator Required?', '☐ Yes  ☐ No'),
+            ('', ''),
+            ('Authorized By', '<<Name>>'),
+            ('Signature', '\n\n_______________________'),
+        ]
+    
+        add_docx_table(doc, docx_form_rows(fields), style='Light Grid Accent 1', widths=[Inches(2.5), Inches(4.0)])
     
     return doc
 
 # --- DOC 3 ---
 def create_invoice_xlsx(COMPANY_INFO):
+    from openpyxl import Workbook
     wb = Workbook()
     ws = wb.active
     ws.title = "Invoice"
+    add_xlsx_styles(wb, 'Pack Title', 'Pack Bold', 'Pack Italic', 'Pack Label', 'Pack Header', 'Pack Cell',
+                    'Pack Amount Cell', 'Pack Amount', 'Pack Total', 'Pack Total Amount')
     
     ws.column_dimensions['A'].width = 35
     ws.column_dimensions['B'].width = 10
     ws.column_dimensions['C'].width = 15
     ws.column_dimensions['D'].width = 15
     
-    header_fill = PatternFill(start_color="1F4E78", end_color="1F4E78", fill_type="solid")
-    header_font = Font(color="FFFFFF", bold=True, size=11)
-    title_font = Font(size=16, bold=True, color="1F4E78")
-    border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-    
-    ws['A1'] = "PROFESSIONAL INVOICE / INVOIS PROFESIONAL"
-    ws['A1'].font = title_font
-    ws.merge_cells('A1:D1')
-    
-    ws['A3'] = COMPANY_INFO['name']
-    ws['A3'].font = Font(bold=True)
-    ws['A4'] = f"Tax ID: {COMPANY_INFO['tax_id']} | Reg: {COMPANY_INFO['reg_no']}"
-    ws['A5'] = f"Phone: {COMPANY_INFO['phone']} | Email: {COMPANY_INFO['email']}"
-    ws['A6'] = COMPANY_INFO['address']
-    
-    ws['C3'] = "Invoice Number / No. Invois:"
-    ws['D3'] = "<<INV-2025-XXXXX>>"
-    ws['C4'] = "Invoice Date / Tarikh Invois:"
-    ws['D4'] = datetime.now().strftime("%d-%m-%Y")
-    ws['C5'] = "Due Date / Tarikh Luput:"
-    ws['D5'] = (datetime.now() + timedelta(days=30)).strftime("%d-%m-%Y")
-    
-    for cell in ['C3', 'C4', 'C5']:
-        ws[cell].alignment = Alignment(horizontal='right')
-        ws[cell].font = Font(bold=True)
-
-    ws['A8'] = "Bill To / Bil Kepada:"
-    ws['A8'].font = Font(bold=True)
-    ws['A9'] = "Client: <<Client Name>>"
-    ws['A10'] = "Address: <<Address>>"
-    ws['A11'] = "Attn: <<Contact Person>>"
-    ws['A12'] = "Reference / Rujukan: <<PO Number>>"
-    
-    ws['A14'] = "Description / Keterangan"
-    ws['B14'] = "Qty / Kuantiti"
-    ws['C14'] = "Unit Price / Harga Unit (RM)"
-    ws['D14'] = "Amount / Jumlah (RM)"
-    
-    for cell in ['A14', 'B14', 'C14', 'D14']:
-        ws[cell].fill = header_fill
-        ws[cell].font = header_font
-        ws[cell].border = border
+    write_xlsx_row(ws, 1, ["PROFESSIONAL INVOICE / INVOIS PROFESIONAL"], 'Pack Title')
+    ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=4)
+    
+    client = document_client(COMPANY_INFO)
+    write_xlsx_row(ws, 3, [COMPANY_INFO['name'], None, "Invoice Number / No. Invois:",
+                           COMPANY_INFO.get('invoice_number') or "<<INV-2025-XXXXX>>"],
+                   ['Pack Bold', None, 'Pack Label', None])
+    write_xlsx_row(ws, 4, [f"Tax ID: {COMPANY_INFO['tax_id']} | Reg: {COMPANY_INFO['reg_no']}", None,
+                           "Invoice Date / Tarikh Invois:", today().strftime("%d-%m-%Y")],
+                   [None, None, 'Pack Label', None])
+    write_xlsx_row(ws, 5, [f"Phone: {COMPANY_INFO['phone']} | Email: {COMPANY_INFO['email']}", None,
+                           "Due Date / Tarikh Luput:", (today() + timedelta(days=30)).strftime("%d-%m-%Y")],
+                   [None, None, 'Pack Label', None])
+    write_xlsx_row(ws, 6, [COMPANY_INFO['address']])
+
+    write_xlsx_row(ws, 8, ["Bill To / Bil Kepada:"], 'Pack Bold')
+    write_xlsx_row(ws, 9, [f"Client: {client.get('name') or '<<Client Name>>'}"])
+    write_xlsx_row(ws, 10, [f"Address: {client.get('address') or '<<Address>>'}"])
+    write_xlsx_row(ws, 11, [f"Attn: {client.get('contact') or '<<Contact Person>>'}"])
+    write_xlsx_row(ws, 12, [f"Reference / Rujukan: {client.get('reference') or '<<PO Number>>'}"])
+    
+    write_xlsx_row(ws, 14, ["Description / Keterangan", "Qty / Kuantiti", "Unit Price / Harga Unit (RM)",
+                            "Amount / Jumlah (RM)"], 'Pack Header')
     
     sample_data = [
         ('Equipment Rental - 5 days', 5, 8500),
         ('Operator Service - 5 days', 5, 2000),
         ('Delivery & Pickup', 1, 1500),
     ]
+    items = document_line_items(COMPANY_INFO, sample_data)
     
     start_row = 15
-    for i, (desc, qty, price) in enumerate(sample_data):
-        row = start_row + i
-        ws[f'A{row}'] = desc
-        ws[f'B{row}'] = qty
-        ws[f'C{row}'] = price
-        ws[f'D{row}'] = f"=B{row}*C{row}"
-        ws[f'C{row}'].number_format = '#,##0.00'
-        ws[f'D{row}'].number_format = '#,##0.00'
-        for col in ['A', 'B', 'C', 'D']:
-            ws[f'{col}{row}'].border = border
-
-    end_row = start_row + len(sample_data) - 1
+    amounts = write_line_items(ws, start_row, items, ['Pack Cell', 'Pack Cell', 'Pack Amount Cell', 'Pack Amount Cell'])
+    end_row = start_row + len(items) - 1
     
     subtotal_row = end_row + 2
-    ws[f'C{subtotal_row}'] = "Subtotal / Jumlah Kecil:"
-    ws[f'D{subtotal_row}'] = f"=SUM(D{start_row}:D{end_row})"
-    ws[f'C{subtotal_row}'].font = Font(bold=True)
-    ws[f'D{subtotal_row}'].number_format = '#,##0.00'
+    write_xlsx_row(ws, subtotal_row, ["Subtotal / Jumlah Kecil:", f"=SUM(D{start_row}:D{end_row})"],
+                   ['Pack Bold', 'Pack Amount'], column=3)
 
     sst_row = subtotal_row + 1
-    ws[f'C{sst_row}'] = "SST 6% / Cukai SST 6%:"
-    ws[f'D{sst_row}'] = f"=D{subtotal_row}*0.06"
-    ws[f'C{sst_row}'].font = Font(bold=True)
-    ws[f'D{sst_row}'].number_format = '#,##0.00'
+    write_xlsx_row(ws, sst_row, ["SST 6% / Cukai SST 6%:", f"=D{subtotal_row}*0.06"], ['Pack Bold', 'Pack Amount'], column=3)
 
     total_row = sst_row + 1
-    ws[f'C{total_row}'] = "TOTAL / JUMLAH (RM):"
-    ws[f'D{total_row}'] = f"=D{subtotal_row}+D{sst_row}"
-    ws[f'C{total_row}'].font = header_font
-    ws[f'C{total_row}'].fill = header_fill
-    ws[f'D{total_row}'].font = header_font
-    ws[f'D{total_row}'].fill = header_fill
-    ws[f'D{total_row}'].number_format = '#,##0.00'
+    write_xlsx_row(ws, total_row, ["TOTAL / JUMLAH (RM):", f"=D{subtotal_row}+D{sst_row}"],
+                   ['Pack Total', 'Pack Total Amount'], column=3)
+    
+    # The same arithmetic as the formulas, in the same order, so the cached results match Excel's
+    subtotal = sum(amounts.values())
+    sst = subtotal * 0.06
+    formula_values = dict(amounts, **{f'D{subtotal_row}': subtotal, f'D{sst_row}': sst, f'D{total_row}': subtotal + sst})
     
     payment_row = total_row + 2
-    ws[f'A{payment_row}'] = "Payment Details / Butiran Bayaran:"
-    ws[f'A{payment_row}'].font = Font(bold=True)
-    ws[f'A{payment_row+1}'] = f"Payment Terms / Terma Bayaran: Net 30 days from invoice date"
-    ws[f'A{payment_row+2}'] = f"Bank: {COMPANY_INFO['bank_name']}"
-    ws[f'A{payment_row+3}'] = f"Account: {COMPANY_INFO['bank_account']}"
-    ws[f'A{payment_row+4}'] = "Thank you for your business! / Terima kasih atas urus niaga anda!"
-    ws[f'A{payment_row+4}'].font = Font(italic=True)
+    write_xlsx_row(ws, payment_row, ["Payment Details / Butiran Bayaran:"], 'Pack Bold')
+    write_xlsx_row(ws, payment_row + 1, ["Payment Terms / Terma Bayaran: Net 30 days from invoice date"])
+    write_xlsx_row(ws, payment_row + 2, [f"Bank: {COMPANY_INFO['bank_name']}"])
+    write_xlsx_row(ws, payment_row + 3, [f"Account: {COMPANY_INFO['bank_account']}"])
+    write_xlsx_row(ws, payment_row + 4, ["Thank you for your business! / Terima kasih atas urus niaga anda!"], 'Pack Italic')
     
-    return wb
+    return save_with_formula_values(wb, formula_values)
 
 # --- DOC 4 ---
+SERVICE_LOG_FIELDS = ('equipment_id', 'location', 'date', 'hour_meter', 'service_type', 'description',
+                      'parts_used', 'labour_cost', 'parts_cost', 'next_service_due')
+SERVICE_LOG_NUMBER_FIELDS = ('hour_meter', 'labour_cost', 'parts_cost')
+
+
+def service_log_values(index, entry):
+    """One service_log entry (an object, or a list in SERVICE_LOG_FIELDS order) as cell values."""
+    if isinstance(entry, dict):
+        values = [entry.get(field) for field in SERVICE_LOG_FIELDS]
+    elif isinstance(entry, (list, tuple)):
+        values = (list(entry) + [None] * len(SERVICE_LOG_FIELDS))[:len(SERVICE_LOG_FIELDS)]
+    else:
+        raise InvalidField('service_log', f"service_log row {index} must be an object or a list")
+    values = [None if value == '' else value for value in values]
+    for field in SERVICE_LOG_NUMBER_FIELDS:
+        position = SERVICE_LOG_FIELDS.index(field)
+        if values[position] is not None:
+            values[position] = parse_number(values[position], 'service_log', f"service_log row {index}: {field}")
+    return values
+
+
+def iter_service_log_csv(stream):
+    """Yield service_log entries from an uploaded CSV one row at a time.
+
+    The header names the columns, e.g. "Equipment ID" or "equipment_id".
+    """
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    fieldnames = [re.sub(r'\W+', '_', name.strip().lower()).strip('_') for name in reader.fieldnames or []]
+    if not set(fieldnames) & set(SERVICE_LOG_FIELDS):
+        raise ValueError(f"service_log CSV needs a header row with some of: {', '.join(SERVICE_LOG_FIELDS)}")
+    reader.fieldnames = fieldnames
+    yield from reader
+
+
 def create_service_log(COMPANY_INFO):
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Service Log"
+    from openpyxl import Workbook
+    from openpyxl.worksheet.cell_range import CellRange
+    # Write-only: rows are streamed to a temp file as they are appended, so a
+    # fleet's whole maintenance history never sits in memory as cell objects.
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Service Log")
+    add_xlsx_styles(wb, 'Pack Title Centered', 'Pack Centered', 'Pack Log Header', 'Pack Cell', 'Pack Amount Cell')
     
     columns = [
         'Equipment ID / ID Peralatan',
@@ -471,55 +1013,58 @@ def create_service_log(COMPANY_INFO):
     
     for i, width in enumerate(col_widths, 1):
         ws.column_dimensions[chr(64 + i)].width = width
+    for row in (1, 2):
+        ws.merged_cells.add(CellRange(min_col=1, min_row=row, max_col=len(columns), max_row=row))
     
-    ws['A1'] = "EQUIPMENT SERVICE & MAINTENANCE LOG / LOG SERVIS & PENYELENGGARAAN PERALATAN"
-    ws['A1'].font = Font(size=16, bold=True, color="1F4E78")
-    ws.merge_cells(f'A1:{chr(64 + len(columns))}1')
-    ws['A1'].alignment = Alignment(horizontal='center')
-    
-    ws['A2'] = COMPANY_INFO['name']
-    ws.merge_cells(f'A2:{chr(64 + len(columns))}2')
-    ws['A2'].alignment = Alignment(horizontal='center')
-    
-    header_fill = PatternFill(start_color="1F4E78", end_color="1F4E78", fill_type="solid")
-    header_font = Font(color="FFFFFF", bold=True, size=10)
-    border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-    
-    for col_num, col_name in enumerate(columns, 1):
-        cell = ws.cell(row=4, column=col_num)
-        cell.value = col_name
-        cell.fill = header_fill
-        cell.font = header_font
-        cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-        cell.border = border
+    ws.append([styled_cell(ws, "EQUIPMENT SERVICE & MAINTENANCE LOG / LOG SERVIS & PENYELENGGARAAN PERALATAN",
+                           'Pack Title Centered')])
+    ws.append([styled_cell(ws, COMPANY_INFO['name'], 'Pack Centered')])
+    ws.append([])
+    ws.append([styled_cell(ws, name, 'Pack Log Header') for name in columns])
     
     sample_data = [
         ('EQ-001', 'Site A', '2025-01-15', 1200, 'Routine', '500-hour service, oil change', 'Oil, Filters', 500, 850, '2025-02-15'),
         ('EQ-002', 'Yard', '2025-01-18', 2100, 'Repair', 'Replaced hydraulic hose', 'Hose #H123', 1200, 450, '2025-01-25'),
         ('EQ-003', 'Site B', '2025-01-20', 4500, 'Inspection', 'Pre-rental safety check', 'None', 300, 0, '2025-03-20'),
     ]
-    
-    for row_num, row_data in enumerate(sample_data, 5):
-        for col_num, value in enumerate(row_data, 1):
-            cell = ws.cell(row=row_num, column=col_num)
-            cell.value = value
-            cell.border = border
-            if col_num in [8, 9, 10]:
-                cell.number_format = '#,##0.00'
-        
-        total_cell = ws.cell(row=row_num, column=10)
-        total_cell.value = f"=H{row_num}+I{row_num}"
+    entries = COMPANY_INFO.get('service_log')
+    if entries is None:
+        entries = sample_data
+    elif isinstance(entries, (str, dict)):
+        raise InvalidField('service_log', "service_log must be a list of rows")
+    
+    # Labour, parts and the total (column J) are amounts. A write-only row is
+    # serialised as soon as it is appended, so one set of styled cells is reused.
+    row_cells = [styled_cell(ws, None, style) for style in ['Pack Cell'] * 7 + ['Pack Amount Cell'] * 3 + ['Pack Cell']]
+    with stage('tables'):
+        try:
+            for row_num, entry in enumerate(entries, 5):
+                values = service_log_values(row_num - 4, entry)
+                values[9:9] = [f"=H{row_num}+I{row_num}"]
+                for cell, value in zip(row_cells, values):
+                    cell.value = value
+                ws.append(row_cells)
+        except Exception:
+            # A bad row abandons the workbook. Saving it to nowhere is openpyxl's
+            # public way to finish the half-written sheet and remove its temp
+            # file now rather than at exit; a failure there mustn't hide the row's.
+            with contextlib.suppress(Exception):
+                wb.save(io.BytesIO())
+            raise
     
     return wb
 
 # --- DOC 5 ---
 def create_payment_reminder(COMPANY_INFO):
-    doc = Document()
+    from docx.shared import Pt
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    with stage('document'):
+        doc = new_docx()
     add_header_footer(doc, COMPANY_INFO)
     
     date_para = doc.add_paragraph()
     date_para.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-    date_para.add_run(f"Date: {datetime.now().strftime('%d %B %Y')}").font.size = Pt(11)
+    date_para.add_run(f"Date: {today().strftime('%d %B %Y')}").font.size = Pt(11)
     
     doc.add_paragraph()
     doc.add_paragraph("<<Client Company Name>>")
@@ -539,21 +1084,14 @@ def create_payment_reminder(COMPANY_INFO):
     p.add_run("Dear <<Client Name>>,\n\n")
     p.add_run("This is a friendly reminder that payment for the following invoice is now overdue:\n\n")
     
-    table = doc.add_table(rows=5, cols=2)
-    table.style = 'Light Grid Accent 1'
-    table.rows[0].cells[0].text = "Invoice Number"
-    table.rows[0].cells[1].text = "<<INV-XXXXX>>"
-    table.rows[1].cells[0].text = "Invoice Date"
-    table.rows[1].cells[1].text = "<<Date>>"
-    table.rows[2].cells[0].text = "Due Date"
-    table.rows[2].cells[1].text = "<<Date>>"
-    table.rows[3].cells[0].text = "Amount Due (RM)"
-    table.rows[3].cells[1].text = "<<Amount>>"
-    table.rows[4].cells[0].text = "Days Overdue"
-    table.rows[4].cells[1].text = "<<XX>> days"
-    
-    for cell in table.rows[3].cells:
-        cell.paragraphs[0].runs[0].font.bold = True
+    with stage('tables'):
+        add_docx_table(doc, [
+            ["Invoice Number", "<<INV-XXXXX>>"],
+            ["Invoice Date", "<<Date>>"],
+            ["Due Date", "<<Date>>"],
+            [{'text': "Amount Due (RM)", 'bold': True}, {'text': "<<Amount>>", 'bold': True}],
+            ["Days Overdue", "<<XX>> days"],
+        ], style='Light Grid Accent 1')
     
     doc.add_paragraph()
     p2 = doc.add_paragraph()
@@ -576,7 +1114,9 @@ def create_payment_reminder(COMPANY_INFO):
 
 # --- DOC 6 ---
 def create_customer_portal_form(COMPANY_INFO):
-    doc = Document()
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    with stage('document'):
+        doc = new_docx()
     add_header_footer(doc, COMPANY_INFO)
     
     title = doc.add_heading('CUSTOMER PORTAL ACCESS REQUEST FORM', 0)
@@ -588,37 +1128,23 @@ def create_customer_portal_form(COMPANY_INFO):
     doc.add_paragraph("Please complete this form to register for online access to your account, where you can track equipment, view invoices, and make payments.")
     doc.add_paragraph()
 
-    table = doc.add_table(rows=12, cols=2)
-    table.style = 'Light Grid Accent 1'
-    
-    fields = [
-        ('Company Name', '<<Company Name>>'),
-        ('Registration No.', '<<Reg No>>'),
-        ('', ''),
-        ('PRIMARY AUTHORIZED USER', ''),
-        ('Contact Name', '<<Contact Name>>'),
-        ('Designation', '<<Job Title>>'),
-        ('Email Address (Username)', '<<Email>>'),
-        ('Phone Number', '<<Phone>>'),
-        ('', ''),
-        ('PORTAL ACCESS REQUIRED', ''),
-        ('Access Features', '☐ View/Download Invoices\n☐ Make Online Payments\n☐ Track Equipment On-Site\n☐ Log Service Requests'),
-        ('Notification Preferences', '☐ Email Notifications ☐ SMS Alerts'),
-    ]
-    
-    for i, (field, value) in enumerate(fields):
-        cell1 = table.rows[i].cells[0]
-        cell2 = table.rows[i].cells[1]
-        
-        if value == '':
-            cell1.merge(cell2)
-            cell1.text = field
-            cell1.paragraphs[0].runs[0].font.bold = True
-            cell1.paragraphs[0].runs[0].font.color.rgb = RGBColor(31, 78, 120)
-        else:
-            cell1.text = field
-            cell2.text = value
-    
+    with stage('tables'):
+        fields = [
+            ('Company Name', '<<Company Name>>'),
+            ('Registration No.', '<<Reg No>>'),
+            ('', ''),
+            ('PRIMARY AUTHORIZED USER', ''),
+            ('Contact Name', '<<Contact Name>>'),
+            ('Designation', '<<Job Title>>'),
+            ('Email Address (Username)', '<<Email>>'),
+            ('Phone Number', '<<Phone>>'),
+            ('', ''),
+            ('PORTAL ACCESS REQUIRED', ''),
+            ('Access Features', '☐ View/Download Invoices\n☐ Make Online Payments\n☐ Track Equipment On-Site\n☐ Log Service Requests'),
+            ('Notification Preferences', '☐ Email Notifications ☐ SMS Alerts'),
+        ]
+    
+        add_docx_table(doc, docx_form_rows(fields), style='Light Grid Accent 1')    
     doc.add_paragraph()
     doc.add_heading('Declaration / Pengisytiharan', level=3)
     doc.add_paragraph("I, the undersigned, confirm that I am an authorized representative of the above-named company and request access to the customer portal.")
@@ -632,109 +1158,78 @@ def create_customer_portal_form(COMPANY_INFO):
 
 # --- DOC 7 ---
 def create_quotation_template(COMPANY_INFO):
+    from openpyxl import Workbook
     wb = Workbook()
     ws = wb.active
     ws.title = "Quotation"
+    add_xlsx_styles(wb, 'Pack Title', 'Pack Bold', 'Pack Label', 'Pack Header', 'Pack Cell', 'Pack Days Cell',
+                    'Pack Amount Cell', 'Pack Amount', 'Pack Total', 'Pack Total Amount')
     
     ws.column_dimensions['A'].width = 35
     ws.column_dimensions['B'].width = 10
     ws.column_dimensions['C'].width = 15
     ws.column_dimensions['D'].width = 15
     
-    header_fill = PatternFill(start_color="1F4E78", end_color="1F4E78", fill_type="solid")
-    header_font = Font(color="FFFFFF", bold=True, size=11)
-    title_font = Font(size=16, bold=True, color="1F4E78")
-    border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-    
-    ws['A1'] = "QUOTATION / SEBUT HARGA"
-    ws['A1'].font = title_font
-    ws.merge_cells('A1:D1')
-    
-    ws['A3'] = COMPANY_INFO['name']
-    ws['A3'].font = Font(bold=True)
-    ws['A4'] = f"Tax ID: {COMPANY_INFO['tax_id']} | Reg: {COMPANY_INFO['reg_no']}"
-    ws['A5'] = f"Phone: {COMPANY_INFO['phone']} | Email: {COMPANY_INFO['email']}"
-    ws['A6'] = COMPANY_INFO['address']
-    
-    ws['C3'] = "Quote #:"
-    ws['D3'] = "<<QT-YYMMDD-XXXXX>>"
-    ws['C4'] = "Quote Date:"
-    ws['D4'] = datetime.now().strftime("%d-%m-%Y")
-    ws['C5'] = "Valid Until:"
-    ws['D5'] = (datetime.now() + timedelta(days=30)).strftime("%d-%m-%Y")
-    
-    for cell in ['C3', 'C4', 'C5']:
-        ws[cell].alignment = Alignment(horizontal='right')
-        ws[cell].font = Font(bold=True)
-
-    ws['A8'] = "Client Information:"
-    ws['A8'].font = Font(bold=True)
-    ws['A9'] = "Client: <<Client Name>>"
-    ws['A10'] = "Address: <<Address>>"
-    ws['A11'] = "Attn: <<Contact Person>>"
-    
-    ws['A13'] = "Description"
-    ws['B13'] = "Duration"
-    ws['C13'] = "Rate (RM)"
-    ws['D13'] = "Amount (RM)"
-    
-    for cell in ['A13', 'B13', 'C13', 'D13']:
-        ws[cell].fill = header_fill
-        ws[cell].font = header_font
-        ws[cell].border = border
+    write_xlsx_row(ws, 1, ["QUOTATION / SEBUT HARGA"], 'Pack Title')
+    ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=4)
+    
+    client = document_client(COMPANY_INFO)
+    write_xlsx_row(ws, 3, [COMPANY_INFO['name'], None, "Quote #:", COMPANY_INFO.get('quote_number') or "<<QT-YYMMDD-XXXXX>>"],
+                   ['Pack Bold', None, 'Pack Label', None])
+    write_xlsx_row(ws, 4, [f"Tax ID: {COMPANY_INFO['tax_id']} | Reg: {COMPANY_INFO['reg_no']}", None,
+                           "Quote Date:", today().strftime("%d-%m-%Y")],
+                   [None, None, 'Pack Label', None])
+    write_xlsx_row(ws, 5, [f"Phone: {COMPANY_INFO['phone']} | Email: {COMPANY_INFO['email']}", None,
+                           "Valid Until:", (today() + timedelta(days=30)).strftime("%d-%m-%Y")],
+                   [None, None, 'Pack Label', None])
+    write_xlsx_row(ws, 6, [COMPANY_INFO['address']])
+
+    write_xlsx_row(ws, 8, ["Client Information:"], 'Pack Bold')
+    write_xlsx_row(ws, 9, [f"Client: {client.get('name') or '<<Client Name>>'}"])
+    write_xlsx_row(ws, 10, [f"Address: {client.get('address') or '<<Address>>'}"])
+    write_xlsx_row(ws, 11, [f"Attn: {client.get('contact') or '<<Contact Person>>'}"])
     
+    write_xlsx_row(ws, 13, ["Description", "Duration", "Rate (RM)", "Amount (RM)"], 'Pack Header')
+    
+    # Duration is the line item's quantity in days, shown as "5 days"
     sample_data = [
-        ('Hydraulic Excavator', '5 days', 8500),
-        ('Operator Service', '5 days', 2000),
+        ('Hydraulic Excavator', 5, 8500),
+        ('Operator Service', 5, 2000),
     ]
+    items = document_line_items(COMPANY_INFO, sample_data)
     
     start_row = 14
-    for i, (desc, duration, rate) in enumerate(sample_data):
-        row = start_row + i
-        ws[f'A{row}'] = desc
-        ws[f'B{row}'] = duration
-        ws[f'C{row}'] = rate
-        ws[f'D{row}'] = f"={rate}*5"
-        ws[f'C{row}'].number_format = '#,##0.00'
-        ws[f'D{row}'].number_format = '#,##0.00'
-        for col in ['A', 'B', 'C', 'D']:
-            ws[f'{col}{row}'].border = border
-            
-    end_row = start_row + len(sample_data) - 1
+    amounts = write_line_items(ws, start_row, items, ['Pack Cell', 'Pack Days Cell', 'Pack Amount Cell', 'Pack Amount Cell'])
+    end_row = start_row + len(items) - 1
 
     subtotal_row = end_row + 2
-    ws[f'C{subtotal_row}'] = "Subtotal:"
-    ws[f'D{subtotal_row}'] = f"=SUM(D{start_row}:D{end_row})"
-    ws[f'C{subtotal_row}'].font = Font(bold=True)
-    ws[f'D{subtotal_row}'].number_format = '#,##0.00'
+    write_xlsx_row(ws, subtotal_row, ["Subtotal:", f"=SUM(D{start_row}:D{end_row})"], ['Pack Bold', 'Pack Amount'], column=3)
 
     sst_row = subtotal_row + 1
-    ws[f'C{sst_row}'] = "SST 6%:"
-    ws[f'D{sst_row}'] = f"=D{subtotal_row}*0.06"
-    ws[f'C{sst_row}'].font = Font(bold=True)
-    ws[f'D{sst_row}'].number_format = '#,##0.00'
+    write_xlsx_row(ws, sst_row, ["SST 6%:", f"=D{subtotal_row}*0.06"], ['Pack Bold', 'Pack Amount'], column=3)
 
     total_row = sst_row + 1
-    ws[f'C{total_row}'] = "TOTAL QUOTATION (RM):"
-    ws[f'D{total_row}'] = f"=D{subtotal_row}+D{sst_row}"
-    ws[f'C{total_row}'].font = header_font
-    ws[f'C{total_row}'].fill = header_fill
-    ws[f'D{total_row}'].font = header_font
-    ws[f'D{total_row}'].fill = header_fill
-    ws[f'D{total_row}'].number_format = '#,##0.00'
+    write_xlsx_row(ws, total_row, ["TOTAL QUOTATION (RM):", f"=D{subtotal_row}+D{sst_row}"],
+                   ['Pack Total', 'Pack Total Amount'], column=3)
+    
+    subtotal = sum(amounts.values())
+    sst = subtotal * 0.06
+    formula_values = dict(amounts, **{f'D{subtotal_row}': subtotal, f'D{sst_row}': sst, f'D{total_row}': subtotal + sst})
     
     terms_row = total_row + 2
-    ws[f'A{terms_row}'] = "Terms & Conditions:"
-    ws[f'A{terms_row}'].font = Font(bold=True)
-    ws[f'A{terms_row+1}'] = "1. Payment Terms: 50% deposit upon confirmation, 50% upon completion."
-    ws[f'A{terms_row+2}'] = "2. Validity: This quotation is valid for 30 days."
-    ws[f'A{terms_row+3}'] = "3. Client to provide mandatory 'All-Risk' insurance."
+    write_xlsx_row(ws, terms_row, ["Terms & Conditions:"], 'Pack Bold')
+    write_xlsx_row(ws, terms_row + 1, ["1. Payment Terms: 50% deposit upon confirmation, 50% upon completion."])
+    write_xlsx_row(ws, terms_row + 2, ["2. Validity: This quotation is valid for 30 days."])
+    write_xlsx_row(ws, terms_row + 3, ["3. Client to provide mandatory 'All-Risk' insurance."])
     
-    return wb
+    return save_with_formula_values(wb, formula_values)
 
 # --- DOC 8 ---
 def create_delivery_checklist(COMPANY_INFO):
-    doc = Document()
+    from docx.shared import Inches
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    with stage('document'):
+        doc = new_docx()
     add_header_footer(doc, COMPANY_INFO)
     
     title = doc.add_heading('EQUIPMENT PRE-DELIVERY CHECKLIST', 0)
@@ -743,21 +1238,14 @@ def create_delivery_checklist(COMPANY_INFO):
     title_ms.alignment = WD_ALIGN_PARAGRAPH.CENTER
     doc.add_paragraph()
     
-    table = doc.add_table(rows=5, cols=2)
-    table.style = 'Light Grid Accent 1'
-    table.columns[0].width = Inches(2.0)
-    table.columns[1].width = Inches(4.5)
-    
-    table.rows[0].cells[0].text = "Delivery Date"
-    table.rows[0].cells[1].text = "<<Date>>"
-    table.rows[1].cells[0].text = "Equipment ID"
-    table.rows[1].cells[1].text = "<<Equipment ID>>"
-    table.rows[2].cells[0].text = "Client"
-    table.rows[2].cells[1].text = "<<Client Name>>"
-    table.rows[3].cells[0].text = "Delivery Address"
-    table.rows[3].cells[1].text = "<<Address>>"
-    table.rows[4].cells[0].text = "Inspector"
-    table.rows[4].cells[1].text = "<<Inspector Name>>"
+    with stage('tables'):
+        add_docx_table(doc, [
+            ["Delivery Date", "<<Date>>"],
+            ["Equipment ID", "<<Equipment ID>>"],
+            ["Client", "<<Client Name>>"],
+            ["Delivery Address", "<<Address>>"],
+            ["Inspector", "<<Inspector Name>>"],
+        ], style='Light Grid Accent 1', widths=[Inches(2.0), Inches(4.5)])
     
     doc.add_paragraph()
     doc.add_heading('CHECKLIST / SENARAI SEMAK', level=2)
@@ -798,68 +1286,112 @@ def create_delivery_checklist(COMPANY_INFO):
     return doc
 
 # --- DOC 9 ---
-def create_user_guide_pdf(COMPANY_INFO):
-    # This function creates a PDF in memory
+@functools.lru_cache(maxsize=None)
+def user_guide_styles():
+    """The user guide's paragraph styles, built once per process and shared read-only."""
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib.units import inch
+    from reportlab.lib import colors
     styles = getSampleStyleSheet()
-    story = []
-    
-    title_style = ParagraphStyle('CustomTitle', parent=styles['Heading1'], fontSize=16, textColor=colors.HexColor('#1F4E78'), alignment=1, spaceAfter=14)
-    h2_style = ParagraphStyle('CustomH2', parent=styles['Heading2'], fontSize=12, textColor=colors.HexColor('#1F4E78'), spaceBefore=10, spaceAfter=6)
     body_style = ParagraphStyle('CustomBody', parent=styles['BodyText'], fontSize=10, leading=14, spaceAfter=6)
-    bullet_style = ParagraphStyle('CustomBullet', parent=body_style, leftIndent=0.25*inch, bulletIndent=0.1*inch, spaceAfter=4)
-    disclaimer_style = ParagraphStyle('Disclaimer', parent=body_style, fontSize=9, textColor=colors.darkred, spaceAfter=10)
-
-    story.append(Paragraph(f"<b>{COMPANY_INFO['name']}</b>", styles['Normal']))
-    story.append(Spacer(1, 0.1*inch))
-    story.append(Paragraph("BILINGUAL BUSINESS OPERATIONS TEMPLATE PACK", title_style))
-    story.append(Spacer(1, 0.2*inch))
-    story.append(Paragraph("<b>Complete Professional Solution for Malaysian Machinery Rental SMEs</b>", h2_style))
-    story.append(Spacer(1, 0.2*inch))
-    story.append(Paragraph(f"<b>LEGAL DISCLAIMER:</b> {DISCLAIMER_TEXT}", disclaimer_style))
-    story.append(Paragraph("<b>WHAT'S INCLUDED:</b>", h2_style))
-    story.append(Paragraph("<b>1. Equipment Rental Agreement</b> - Complete legal contract (EN/MS)", bullet_style, bulletText='•'))
-    story.append(Paragraph("<b>2. Machinery Booking Form</b> - Professional bilingual form", bullet_style, bulletText='•'))
-    story.append(Paragraph("<b>3. Professional Invoice</b> - Auto-calculated Excel template (EN/MS)", bullet_style, bulletText='•'))
-    story.append(Paragraph("<b>4. Equipment Service Log</b> - Maintenance tracking spreadsheet (EN/MS)", bullet_style, bulletText='•'))
-    story.append(Paragraph("<b>5. Payment Reminder Letter</b> - Overdue payment follow-up (EN/MS)", bullet_style, bulletText='•'))
-    story.append(Paragraph("<b>6. Customer Portal Form</b> - Online client access registration", bullet_style, bulletText='•'))
-    story.append(Paragraph("<b>7. Quotation Template</b> - Professional quotes with auto-calc", bullet_style, bulletText='•'))
-    story.append(Paragraph("<b>8. Delivery Checklist</b> - Pre-delivery inspection (EN/MS)", bullet_style, bulletText='•'))
-    story.append(Paragraph("<b>9. User Guide (This Doc)</b> - Complete instructions", bullet_style, bulletText='•'))
-    story.append(Paragraph("<b>10. Product Overview</b> - Sales materials", bullet_style, bulletText='•'))
-    story.append(Spacer(1, 0.2*inch))
-    story.append(Paragraph("<b>HOW TO USE:</b>", h2_style))
-    story.append(Paragraph("<b>STEP 1:</b> Open the desired template in Microsoft Word/Excel or Google Docs/Sheets.", bullet_style, bulletText='1.'))
-    story.append(Paragraph("<b>STEP 2:</b> Find all text marked with <b>&lt;&lt;placeholders&gt;&gt;</b>.", bullet_style, bulletText='2.'))
-    story.append(Paragraph("<b>STEP 3:</b> Replace the placeholders with your client's or job's specific information.", bullet_style, bulletText='3.'))
-    story.append(Paragraph("<b>STEP 4:</b> For Excel files (Invoice, Quote, Log), enter your data and the formulas will auto-calculate.", bullet_style, bulletText='4.'))
-    story.append(Paragraph("<b>STEP 5:</b> Save the document with a new name (e.g., 'Invoice_ClientName_Date.xlsx').", bullet_style, bulletText='5.'))
-    story.append(Spacer(1, 0.2*inch))
-    story.append(Paragraph("<b>RECOMMENDED WORKFLOW:</b>", h2_style))
-    story.append(Paragraph("Client inquires → Use <b>Booking Form</b> to capture details (including PO #).", bullet_style, bulletText='1.'))
-    story.append(Paragraph("Confirm booking → Send <b>Quotation Template</b>.", bullet_style, bulletText='2.'))
-    story.append(Paragraph("Client confirms → Send <b>Equipment Rental Agreement</b> for signature.", bullet_style, bulletText='3.'))
-    story.append(Paragraph("Before delivery → Use <b>Delivery Checklist</b> for inspection.", bullet_style, bulletText='4.'))
-    story.append(Paragraph("Job completion → Issue <b>Professional Invoice</b> (use PO # as reference).", bullet_style, bulletText='5.'))
-    story.append(Paragraph("Payment overdue → Send <b>Payment Reminder Letter</b>.", bullet_style, bulletText='6.'))
-    story.append(Paragraph("After service → Update <b>Equipment Service Log</b> (note Hour Meter).", bullet_style, bulletText='7.'))
-    story.append(Spacer(1, 0.2*inch))
-    story.append(Paragraph("<b>CUSTOMIZATION TIPS:</b>", h2_style))
-    story.append(Paragraph("Your main company details (name, address, bank) are already included.", bullet_style, bulletText='•'))
-    story.append(Paragraph("You can add your company logo to the headers of the Word documents.", bullet_style, bulletText='•'))
-    story.append(Paragraph("Adjust tax rates (e.g., SST 6%) in the Excel formulas if needed.", bullet_style, bulletText='•'))
-    story.append(Paragraph("<b>Crucial:</b> Review the legal clauses in the Agreement with a professional.", bullet_style, bulletText='•'))
-    
-    # Create PDF in memory
+    return types.MappingProxyType({
+        'Normal': styles['Normal'],
+        'CustomTitle': ParagraphStyle('CustomTitle', parent=styles['Heading1'], fontSize=16, textColor=colors.HexColor('#1F4E78'), alignment=1, spaceAfter=14),
+        'CustomH2': ParagraphStyle('CustomH2', parent=styles['Heading2'], fontSize=12, textColor=colors.HexColor('#1F4E78'), spaceBefore=10, spaceAfter=6),
+        'CustomBody': body_style,
+        'CustomBullet': ParagraphStyle('CustomBullet', parent=body_style, leftIndent=0.25*inch, bulletIndent=0.1*inch, spaceAfter=4),
+        'Disclaimer': ParagraphStyle('Disclaimer', parent=body_style, fontSize=9, textColor=colors.darkred, spaceAfter=10),
+    })
+
+
+@functools.lru_cache(maxsize=None)
+def user_guide_static_story():
+    """(head, tail) flowables around the company name and disclaimer, parsed once per process."""
+    from reportlab.platypus import Paragraph, Spacer
+    from reportlab.lib.units import inch
+    styles = user_guide_styles()
+    head = (
+        Spacer(1, 0.1*inch),
+        Paragraph("BILINGUAL BUSINESS OPERATIONS TEMPLATE PACK", styles['CustomTitle']),
+        Spacer(1, 0.2*inch),
+        Paragraph("<b>Complete Professional Solution for Malaysian Machinery Rental SMEs</b>", styles['CustomH2']),
+        Spacer(1, 0.2*inch),
+    )
+    tail = []
+    tail.append(Paragraph("<b>WHAT'S INCLUDED:</b>", styles['CustomH2']))
+    tail.append(Paragraph("<b>1. Equipment Rental Agreement</b> - Complete legal contract (EN/MS)", styles['CustomBullet'], bulletText='•'))
+    tail.append(Paragraph("<b>2. Machinery Booking Form</b> - Professional bilingual form", styles['CustomBullet'], bulletText='•'))
+    tail.append(Paragraph("<b>3. Professional Invoice</b> - Auto-calculated Excel template (EN/MS)", styles['CustomBullet'], bulletText='•'))
+    tail.append(Paragraph("<b>4. Equipment Service Log</b> - Maintenance tracking spreadsheet (EN/MS)", styles['CustomBullet'], bulletText='•'))
+    tail.append(Paragraph("<b>5. Payment Reminder Letter</b> - Overdue payment follow-up (EN/MS)", styles['CustomBullet'], bulletText='•'))
+    tail.append(Paragraph("<b>6. Customer Portal Form</b> - Online client access registration", styles['CustomBullet'], bulletText='•'))
+    tail.append(Paragraph("<b>7. Quotation Template</b> - Professional quotes with auto-calc", styles['CustomBullet'], bulletText='•'))
+    tail.append(Paragraph("<b>8. Delivery Checklist</b> - Pre-delivery inspection (EN/MS)", styles['CustomBullet'], bulletText='•'))
+    tail.append(Paragraph("<b>9. User Guide (This Doc)</b> - Complete instructions", styles['CustomBullet'], bulletText='•'))
+    tail.append(Paragraph("<b>10. Product Overview</b> - Sales materials", styles['CustomBullet'], bulletText='•'))
+    tail.append(Spacer(1, 0.2*inch))
+    tail.append(Paragraph("<b>HOW TO USE:</b>", styles['CustomH2']))
+    tail.append(Paragraph("<b>STEP 1:</b> Open the desired template in Microsoft Word/Excel or Google Docs/Sheets.", styles['CustomBullet'], bulletText='1.'))
+    tail.append(Paragraph("<b>STEP 2:</b> Find all text marked with <b>&lt;&lt;placeholders&gt;&gt;</b>.", styles['CustomBullet'], bulletText='2.'))
+    tail.append(Paragraph("<b>STEP 3:</b> Replace the placeholders with your client's or job's specific information.", styles['CustomBullet'], bulletText='3.'))
+    tail.append(Paragraph("<b>STEP 4:</b> For Excel files (Invoice, Quote, Log), enter your data and the formulas will auto-calculate.", styles['CustomBullet'], bulletText='4.'))
+    tail.append(Paragraph("<b>STEP 5:</b> Save the document with a new name (e.g., 'Invoice_ClientName_Date.xlsx').", styles['CustomBullet'], bulletText='5.'))
+    tail.append(Spacer(1, 0.2*inch))
+    tail.append(Paragraph("<b>RECOMMENDED WORKFLOW:</b>", styles['CustomH2']))
+    tail.append(Paragraph("Client inquires → Use <b>Booking Form</b> to capture details (including PO #).", styles['CustomBullet'], bulletText='1.'))
+    tail.append(Paragraph("Confirm booking → Send <b>Quotation Template</b>.", styles['CustomBullet'], bulletText='2.'))
+    tail.append(Paragraph("Client confirms → Send <b>Equipment Rental Agreement</b> for signature.", styles['CustomBullet'], bulletText='3.'))
+    tail.append(Paragraph("Before delivery → Use <b>Delivery Checklist</b> for inspection.", styles['CustomBullet'], bulletText='4.'))
+    tail.append(Paragraph("Job completion → Issue <b>Professional Invoice</b> (use PO # as reference).", styles['CustomBullet'], bulletText='5.'))
+    tail.append(Paragraph("Payment overdue → Send <b>Payment Reminder Letter</b>.", styles['CustomBullet'], bulletText='6.'))
+    tail.append(Paragraph("After service → Update <b>Equipment Service Log</b> (note Hour Meter).", styles['CustomBullet'], bulletText='7.'))
+    tail.append(Spacer(1, 0.2*inch))
+    tail.append(Paragraph("<b>CUSTOMIZATION TIPS:</b>", styles['CustomH2']))
+    tail.append(Paragraph("Your main company details (name, address, bank) are already included.", styles['CustomBullet'], bulletText='•'))
+    tail.append(Paragraph("You can add your company logo to the headers of the Word documents.", styles['CustomBullet'], bulletText='•'))
+    tail.append(Paragraph("Adjust tax rates (e.g., SST 6%) in the Excel formulas if needed.", styles['CustomBullet'], bulletText='•'))
+    tail.append(Paragraph("<b>Crucial:</b> Review the legal clauses in the Agreement with a professional.", styles['CustomBullet'], bulletText='•'))
+    return head, tuple(tail)
+
+
+def layout_user_guide(company_name, disclaimer=DISCLAIMER_TEXT):
+    """Lay out the user guide PDF and return its bytes."""
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate, Paragraph
+    from reportlab.lib.units import inch
+    styles = user_guide_styles()
+    head, tail = user_guide_static_story()
+    # Layout stores wrap/split state on the flowables, so each build lays out
+    # shallow copies and the shared originals are never touched.
+    story = [Paragraph(f"<b>{company_name}</b>", styles['Normal'])]
+    story.extend(copy.copy(flowable) for flowable in head)
+    story.append(Paragraph(f"<b>LEGAL DISCLAIMER:</b> {disclaimer}", styles['Disclaimer']))
+    story.extend(copy.copy(flowable) for flowable in tail)
+
     pdf_buffer = io.BytesIO()
     doc_template = SimpleDocTemplate(pdf_buffer, pagesize=letter, leftMargin=0.75*inch, rightMargin=0.75*inch, topMargin=0.75*inch, bottomMargin=0.75*inch)
-    doc_template.build(story)
-    pdf_buffer.seek(0)
-    return pdf_buffer
+    with stage('pdf_layout'):
+        doc_template.build(story)
+    return pdf_buffer.getvalue()
+
+
+@functools.lru_cache(maxsize=USER_GUIDE_CACHE_SIZE)
+def cached_user_guide(company_name, day):
+    # Keyed on the day as well, like the pack cache, so the PDF's creation date stays current
+    return layout_user_guide(company_name)
+
+
+def create_user_guide_pdf(COMPANY_INFO):
+    # This function creates a PDF in memory; only the company name varies
+    if USER_GUIDE_CACHE_SIZE:
+        return io.BytesIO(cached_user_guide(COMPANY_INFO['name'], today().date()))
+    return io.BytesIO(layout_user_guide(COMPANY_INFO['name']))
 
 # --- DOC 10 ---
 def create_product_overview(COMPANY_INFO):
-    doc = Document()
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    with stage('document'):
+        doc = new_docx()
     add_header_footer(doc, COMPANY_INFO)
     
     title = doc.add_heading('COMPLETE BILINGUAL BUSINESS TEMPLATE PACK', 0)
@@ -909,85 +1441,2095 @@ def create_product_overview(COMPANY_INFO):
     return doc
 
 
+# ============================================================================
+# DOCUMENT REGISTRY & PARALLEL BUILDER POOL
+# The ten builders don't depend on each other, so they run side by side in a
+# process pool (python-docx/openpyxl/reportlab are CPU-bound and hold the GIL).
+# ============================================================================
+PACK_DOCUMENTS = [
+    # (doc_id, filename in the ZIP, builder)
+    ('rental_agreement', '01_Equipment_Rental_Agreement.docx', create_rental_agreement),
+    ('booking_form', '02_Machinery_Booking_Form.docx', create_booking_form),
+    ('invoice', '03_Professional_Invoice.xlsx', create_invoice_xlsx),
+    ('service_log', '04_Equipment_Service_Log.xlsx', create_service_log),
+    ('payment_reminder', '05_Payment_Reminder_Letter.docx', create_payment_reminder),
+    ('customer_portal_form', '06_Customer_Portal_Form.docx', create_customer_portal_form),
+    ('quotation', '07_Quotation_Template.xlsx', create_quotation_template),
+    ('delivery_checklist', '08_Delivery_Checklist.docx', create_delivery_checklist),
+    ('user_guide', '09_User_Guide.pdf', create_user_guide_pdf),
+    ('product_overview', '10_Product_Overview.docx', create_product_overview),
+]
+DOCUMENT_BUILDERS = {doc_id: (filename, builder) for doc_id, filename, builder in PACK_DOCUMENTS}
+DOCUMENT_IDS = [doc_id for doc_id, _, _ in PACK_DOCUMENTS]
+# Request fields besides the company details that a document reads; they bypass its skeleton
+DOCUMENT_INPUTS = {
+    'rental_agreement': ('equipment',),
+    'invoice': ('line_items', 'client', 'invoice_number'),
+    'quotation': ('line_items', 'client', 'quote_number'),
+    'service_log': ('service_log',),
+}
+DOCUMENT_MIMETYPES = {
+    '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    '.pdf': 'application/pdf',
+}
+
+
+def document_mimetype(doc_id):
+    return DOCUMENT_MIMETYPES[os.path.splitext(DOCUMENT_BUILDERS[doc_id][0])[1]]
+
+
+def parse_doc_selection(value):
+    """Turn a 'invoice,quotation' selector into doc ids in pack order (None = whole pack)."""
+    if not value:
+        return None
+    requested = {doc_id.strip() for doc_id in value.split(',') if doc_id.strip()}
+    if not requested:
+        raise ValueError("No document IDs given")
+    unknown = requested - set(DOCUMENT_IDS)
+    if unknown:
+        raise ValueError(f"Unknown document(s): {', '.join(sorted(unknown))}")
+    return [doc_id for doc_id in DOCUMENT_IDS if doc_id in requested]
+
+
+def check_document_inputs(COMPANY_INFO, doc_ids=None):
+    """Parse the request fields the selected documents read besides the company details.
+
+    Raises InvalidField in the request thread, so malformed line items or
+    equipment are a 400 naming the field instead of a builder failure. An
+    uploaded service log CSV is only read while its sheet is written.
+    """
+    if not isinstance(COMPANY_INFO, dict):
+        return
+    doc_ids = DOCUMENT_IDS if doc_ids is None else doc_ids
+    fields = {field for doc_id in doc_ids for field in DOCUMENT_INPUTS.get(doc_id, ())}
+    if 'line_items' in fields:
+        document_line_items(COMPANY_INFO, ())
+    if 'client' in fields:
+        document_client(COMPANY_INFO)
+    if 'equipment' in fields:
+        equipment_schedule(COMPANY_INFO, ())
+    entries = COMPANY_INFO.get('service_log')
+    if 'service_log' in fields and isinstance(entries, (list, str, dict)):
+        if not isinstance(entries, list):
+            raise InvalidField('service_log', "service_log must be a list of rows")
+        for index, entry in enumerate(entries, 1):
+            service_log_values(index, entry)
+
+
+class DocumentBuildError(Exception):
+    """A single builder failed or ran past its timeout."""
+
+    def __init__(self, doc_id, message, timed_out=False):
+        super().__init__(message)
+        self.doc_id = doc_id  # None when the failure can't be pinned on one document
+        self.filename = DOCUMENT_BUILDERS[doc_id][0] if doc_id is not None else None
+        self.timed_out = timed_out
+
+    def to_dict(self):
+        return {
+            "error": str(self),
+            "document": self.doc_id,
+            "filename": self.filename,
+            "type": "timeout" if self.timed_out else "build_error",
+        }
+
+
+def render_document(doc_id, COMPANY_INFO):
+    """Build one document and return its file bytes (runs inside a pool worker)."""
+    data = render_from_skeleton(doc_id, COMPANY_INFO) if SKELETON_CACHE_ENABLED else None
+    return data if data is not None else render_full_document(doc_id, COMPANY_INFO)
+
+
+def render_document_timed(doc_id, COMPANY_INFO):
+    """render_document plus the (stage, seconds) pairs recorded while it ran and its memory use.
+
+    The memory dict has the building process's pid and rss afterwards, the
+    rss_delta over the build and, with MEMORY_TRACE, the tracemalloc peak
+    (process-wide, so builds running side by side in threads share it).
+    """
+    if not METRICS_ENABLED:
+        return render_document(doc_id, COMPANY_INFO), [], {'pid': os.getpid(), 'rss': current_rss()}
+    _stage_recorder.entries = entries = []
+    rss_before = current_rss()
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        traced_before = tracemalloc.get_traced_memory()[0]
+    try:
+        with stage('render'):
+            data = render_document(doc_id, COMPANY_INFO)
+        usage = {'pid': os.getpid(), 'rss': current_rss(), 'rss_delta': None, 'peak': None}
+        if rss_before is not None and usage['rss'] is not None:
+            usage['rss_delta'] = usage['rss'] - rss_before
+        if tracing:
+            usage['peak'] = tracemalloc.get_traced_memory()[1] - traced_before
+        return data, entries, usage
+    finally:
+        _stage_recorder.entries = None
+
+
+def render_full_document(doc_id, COMPANY_INFO):
+    _, builder = DOCUMENT_BUILDERS[doc_id]
+    with stage('build'):
+        result = builder(COMPANY_INFO)
+    if isinstance(result, io.BytesIO):  # the PDF builder already renders to memory
+        return result.getvalue()
+    buffer = io.BytesIO()
+    with stage('save'):
+        result.save(buffer)
+    return buffer.getvalue()
+
+
+# ============================================================================
+# SKELETON CACHE
+# Each DOCX/XLSX is rendered once with marker values in place of the company
+# fields and dates. Later requests copy the cached archive members and patch
+# the markers, which skips building the python-docx/openpyxl object model.
+# ============================================================================
+SKELETON_FIELDS = ('name', 'phone', 'email', 'tax_id', 'reg_no', 'address',
+                   'bank_name', 'bank_account', 'swift_code')
+# (strftime format, days from today) for every date the builders print
+SKELETON_DATE_FORMATS = [('%d-%m-%Y', 0), ('%d-%m-%Y', 30), ('%d %B %Y', 0)]
+SKELETON_SENTINEL_DATE = datetime(1901, 1, 2, 3, 4, 5)
+SKELETON_PROBE_INFO = {
+    'name': 'Probe & Sons <Sdn> Bhd', 'phone': '+60 1-2345 6789', 'email': 'probe@example.my',
+    'tax_id': 'C 1234567-08', 'reg_no': '201901000001 (1-P)', 'address': 'Lot 1, Jalan Ujian \u2013 50000 Kuala Lumpur',
+    'bank_name': 'Bank Ujian', 'bank_account': '0000-1111-2222', 'swift_code': 'TESTMYKL',
+}
+SLOT_PATTERN = re.compile(rb'@@slot:(\w+)@@')
+CORE_TIMESTAMP_PATTERN = re.compile(rb'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ')
+# Characters python-docx/openpyxl would not write verbatim as XML text
+UNSAFE_SLOT_VALUE = re.compile('[^\u0020-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]')
+
+_skeletons = {}  # doc_id -> (template fingerprint, members or None if the doc can't be slotted)
+_skeletons_lock = threading.Lock()
+
+
+# Distributions whose output ends up in each kind of document
+DOCUMENT_LIBRARIES = {'.docx': ('python-docx', 'lxml'), '.xlsx': ('openpyxl',), '.pdf': ('reportlab',)}
+# Module globals of these types are template data (disclaimers, field lists, patterns)
+CONSTANT_TYPES = (str, bytes, int, float, tuple, list, dict, set, frozenset, re.Pattern)
+
+
+def constant_repr(value):
+    """repr() of a constant that comes out the same in every process (set order follows the hash seed)."""
+    if isinstance(value, (set, frozenset)):
+        return repr(sorted(constant_repr(item) for item in value))
+    if isinstance(value, (tuple, list)):
+        return repr([constant_repr(item) for item in value])
+    if isinstance(value, dict):
+        return repr([(constant_repr(key), constant_repr(item)) for key, item in value.items()])
+    if isinstance(value, re.Pattern):
+        return repr((value.pattern, value.flags))
+    return repr(value)
+
+
+def hash_code(code, digest):
+    # marshal output depends on reference counts, so walk the code object instead
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            hash_code(const, digest)
+        else:
+            digest.update(constant_repr(const).encode())
+
+
+def code_names(code):
+    yield from code.co_names
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            yield from code_names(const)
+
+
+def library_version(distribution):
+    with contextlib.suppress(importlib.metadata.PackageNotFoundError):
+        return importlib.metadata.version(distribution)
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def template_fingerprint(doc_id):
+    """Hash of everything a builder's output depends on besides its input.
+
+    That is its bytecode and defaults, every module function it reaches, the
+    values of the module constants those read (disclaimers, field lists) and
+    the versions of the libraries that write the format. None of it can
+    change inside a running process, so it is worked out once per document.
+    A change invalidates the document's skeleton, cached packs and ETags.
+    """
+    filename, builder = DOCUMENT_BUILDERS[doc_id]
+    digest = hashlib.sha1()
+    for distribution in DOCUMENT_LIBRARIES[os.path.splitext(filename)[1]]:
+        digest.update(f"{distribution}=={library_version(distribution)};".encode())
+    pending, seen = [builder], set()
+    while pending:
+        function = pending.pop(0)
+        if function in seen:
+            continue
+        seen.add(function)
+        hash_code(function.__code__, digest)
+        digest.update(constant_repr((function.__defaults__ or (), function.__kwdefaults__ or {})).encode())
+        for name in code_names(function.__code__):
+            value = globals().get(name)
+            helper = getattr(value, '__wrapped__', value)
+            if isinstance(helper, types.FunctionType) and helper.__module__ == __name__:
+                pending.append(helper)
+            elif isinstance(value, CONSTANT_TYPES):
+                digest.update(f"{name}={constant_repr(value)};".encode())
+    return digest.hexdigest()
+
+
+def slot_values(filename, COMPANY_INFO, moment):
+    """Marker -> XML-escaped bytes for one request, or None when a value can't be patched in."""
+    # openpyxl writes non-ASCII text as character references, python-docx as UTF-8
+    encoding, errors = ('ascii', 'xmlcharrefreplace') if filename.endswith('.xlsx') else ('utf-8', 'strict')
+    values = {}
+    for field in SKELETON_FIELDS:
+        value = COMPANY_INFO.get(field)
+        # Missing, empty, padded, formula-like or non-text values take the full
+        # render path, which also keeps its error behaviour for bad input.
+        if (not isinstance(value, str) or not value or value != value.strip()
+                or value.startswith('=') or UNSAFE_SLOT_VALUE.search(value)):
+            return None
+        values[field] = value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').encode(encoding, errors)
+    for i, (fmt, days) in enumerate(SKELETON_DATE_FORMATS):
+        values[f'date{i}'] = (moment + timedelta(days=days)).strftime(fmt).encode('utf-8')
+    return values
+
+
+def build_skeleton(doc_id):
+    """Render doc_id with slot markers and return its archive members (or None)."""
+    filename, _ = DOCUMENT_BUILDERS[doc_id]
+    if not filename.endswith(('.docx', '.xlsx')):
+        return None
+
+    marker_info = {field: f'@@slot:{field}@@' for field in SKELETON_FIELDS}
+    with pinned_clock(SKELETON_SENTINEL_DATE):
+        archive = render_full_document(doc_id, marker_info)
+
+    date_markers = [
+        ((SKELETON_SENTINEL_DATE + timedelta(days=days)).strftime(fmt).encode('utf-8'), f'@@slot:date{i}@@'.encode())
+        for i, (fmt, days) in enumerate(SKELETON_DATE_FORMATS)
+    ]
+    members = []
+    with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+        for info in zf.infolist():
+            data = zf.read(info)
+            for sentinel, marker in date_markers:
+                data = data.replace(sentinel, marker)
+            # Members no request patches are compressed here, once, and later copied as they are
+            patched = b'@@slot:' in data or (filename.endswith('.xlsx') and info.filename == 'docProps/core.xml')
+            packed = None if patched else pack_member(info.compress_type, data)
+            members.append((info.filename, info.compress_type, info.external_attr, data, packed))
+
+    # Prove the skeleton reproduces a full render before trusting it.
+    probe = fill_skeleton(filename, members, slot_values(filename, SKELETON_PROBE_INFO, today()))
+    expected = render_full_document(doc_id, SKELETON_PROBE_INFO)
+    if archive_members(probe) != archive_members(expected):
+        print(f"Skeleton for {filename} does not match a full render; using full rendering")
+        return None
+    return members
+
+
+def archive_members(data):
+    """{name: bytes} for a DOCX/XLSX archive, with the save timestamps blanked out."""
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        return {
+            name: CORE_TIMESTAMP_PATTERN.sub(b'', zf.read(name)) if name == 'docProps/core.xml' else zf.read(name)
+            for name in zf.namelist()
+        }
+
+
+def pack_member(compress_type, data):
+    """(CRC, compressed bytes) of data as ZipFile.writestr() would store it, or None for other methods."""
+    if compress_type == zipfile.ZIP_STORED:
+        return zlib.crc32(data), data
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        return zlib.crc32(data), compressor.compress(data) + compressor.flush()
+    return None
+
+
+def fill_skeleton(filename, members, values):
+    date_time = time.localtime()[:6]
+    # openpyxl stamps created/modified with the save time (UTC); python-docx keeps its template's
+    saved_at = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ').encode() if filename.endswith('.xlsx') else None
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zf:
+        for name, compress_type, external_attr, data, packed in members:
+            info = zipfile.ZipInfo(name, date_time=date_time)
+            info.compress_type = compress_type
+            info.external_attr = external_attr
+            if packed is not None:
+                # Unchanged (styles.xml, themes, rels...): no need to deflate it again
+                info.CRC, info.file_size = packed[0], len(data)
+                write_raw_member(zf, info, packed[1])
+                continue
+            if b'@@slot:' in data:
+                data = SLOT_PATTERN.sub(lambda m: values[m.group(1).decode()], data)
+            if saved_at and name == 'docProps/core.xml':
+                data = CORE_TIMESTAMP_PATTERN.sub(saved_at, data)
+            zf.writestr(info, data)
+    return buffer.getvalue()
+
+
+def get_skeleton(doc_id):
+    fingerprint = template_fingerprint(doc_id)
+    cached = _skeletons.get(doc_id)
+    if cached is not None and cached[0] == fingerprint:
+        return cached[1]
+    with _skeletons_lock:
+        cached = _skeletons.get(doc_id)
+        if cached is None or cached[0] != fingerprint:
+            try:
+                members = build_skeleton(doc_id)
+            except Exception as e:
+                print(f"Skeleton build failed for {doc_id}: {e}")
+                members = None
+            cached = _skeletons[doc_id] = (fingerprint, members)
+        return cached[1]
+
+
+def render_from_skeleton(doc_id, COMPANY_INFO):
+    """Patch the cached skeleton for doc_id, or return None to fall back to a full render."""
+    if any(COMPANY_INFO.get(field) is not None for field in DOCUMENT_INPUTS.get(doc_id, ())):
+        return None
+    members = get_skeleton(doc_id)
+    if members is None:
+        return None
+    filename = DOCUMENT_BUILDERS[doc_id][0]
+    values = slot_values(filename, COMPANY_INFO, today())
+    if values is None:
+        return None
+    with stage('skeleton_fill'):
+        return fill_skeleton(filename, members, values)
+
+
+def warm_skeletons():
+    """Build every skeleton up front (pool worker initializer)."""
+    if SKELETON_CACHE_ENABLED:
+        for doc_id in DOCUMENT_IDS:
+            get_skeleton(doc_id)
+
+
+_builder_pool = None
+_builder_pool_lock = threading.Lock()
+
+# Workers report every build they pick up on _build_starts; watch_builds()
+# stamps the start time, so a builder's PACK_BUILDER_TIMEOUT only covers the
+# time it actually runs, never the time it sat queued behind other requests.
+_build_starts = None  # multiprocessing queue of (build id, worker pid)
+_build_ids = itertools.count()
+_builds = {}  # build id -> {'pool', 'doc_id', 'pid', 'started'} until its future is done
+_stuck_workers = {}  # retired pool -> pids of its workers stuck past PACK_BUILDER_TIMEOUT
+_builds_lock = threading.Lock()
+BUILD_WATCH_INTERVAL = 0.25
+
+
+def init_builder_worker(ready, starts):
+    global _build_starts
+    _build_starts = starts
+    warm_builders()
+    with contextlib.suppress(threading.BrokenBarrierError):
+        ready.wait(timeout=PACK_WORKER_START_TIMEOUT)
+
+
+def run_build(build_id, doc_id, COMPANY_INFO):
+    """Pool-side entry point: report the build as started, then render it."""
+    _build_starts.put((build_id, os.getpid()))
+    return render_document_timed(doc_id, COMPANY_INFO)
+
+
+def get_builder_pool():
+    global _builder_pool, _build_starts
+    with _builder_pool_lock:
+        if _builder_pool is None:
+            if _build_starts is None:
+                _build_starts = multiprocessing.Queue()
+                threading.Thread(target=watch_builds, name='builder-watchdog', daemon=True).start()
+            # Start every worker and let it finish its skeletons before handing the
+            # pool out, so start-up time never counts against a builder's timeout.
+            ready = multiprocessing.Barrier(PACK_WORKERS + 1)
+            pool = ProcessPoolExecutor(max_workers=PACK_WORKERS, initializer=init_builder_worker,
+                                       initargs=(ready, _build_starts))
+            for _ in range(PACK_WORKERS):
+                pool.submit(int)
+            with contextlib.suppress(threading.BrokenBarrierError):
+                ready.wait(timeout=PACK_WORKER_START_TIMEOUT)
+            _builder_pool = pool
+        return _builder_pool
+
+
+def reset_builder_pool(pool=None):
+    """Throw the current pool away, killing its workers; with pool, only if that is still the current one."""
+    global _builder_pool
+    with _builder_pool_lock:
+        if pool is not None and pool is not _builder_pool:
+            return  # already replaced
+        pool, _builder_pool = _builder_pool, None
+    worker_rss.clear()
+    if pool is not None:
+        # Queued futures are left alone: the broken pool fails them with BrokenProcessPool.
+        for process in list((pool._processes or {}).values()):
+            process.terminate()
+        pool.shutdown(wait=False)
+
+
+def submit_build(doc_id, COMPANY_INFO):
+    """Queue one document on the builder pool and return (pool, build id, future).
+
+    A pool that broke since get_builder_pool() handed it out is replaced and
+    the submit tried once more; one retired in the meantime just gives way to
+    its successor.
+    """
+    build_id = next(_build_ids)
+    for attempt in range(2):
+        pool = get_builder_pool()
+        with _builds_lock:
+            _builds[build_id] = {'pool': pool, 'doc_id': doc_id, 'pid': None, 'started': None}
+        try:
+            future = pool.submit(run_build, build_id, doc_id, COMPANY_INFO)
+        except RuntimeError as e:  # shut down or BrokenProcessPool
+            forget_build(build_id)
+            reset_builder_pool(pool)
+            if attempt:
+                raise DocumentBuildError(doc_id, f"Builder pool unavailable: {e}") from e
+            continue
+        future.add_done_callback(lambda _: forget_build(build_id))
+        return pool, build_id, future
+
+
+def forget_build(build_id):
+    with _builds_lock:
+        _builds.pop(build_id, None)
+
+
+def build_started(build_id):
+    """time.monotonic() at which a worker picked the build up, or None while it is queued."""
+    build = _builds.get(build_id)
+    return build and build['started']
+
+
+def watch_builds():
+    """Watchdog thread: stamps build start reports and retires workers stuck past PACK_BUILDER_TIMEOUT."""
+    while True:
+        try:
+            with contextlib.suppress(queue.Empty):
+                build_id, pid = _build_starts.get(timeout=BUILD_WATCH_INTERVAL)
+                with _builds_lock:
+                    build = _builds.get(build_id)
+                    if build is not None:
+                        build.update(pid=pid, started=time.monotonic())
+            now = time.monotonic()
+            with _builds_lock:
+                overdue = [(build['pool'], build['pid'], build['doc_id']) for build in _builds.values()
+                           if build['started'] is not None and now - build['started'] >= PACK_BUILDER_TIMEOUT
+                           and build['pid'] not in _stuck_workers.get(build['pool'], ())]
+            for pool, pid, doc_id in overdue:
+                retire_stuck_worker(pool, pid, doc_id)
+            reap_stuck_workers()
+        except Exception as e:
+            print(f"Builder watchdog error: {e}")
+            time.sleep(BUILD_WATCH_INTERVAL)
+
+
+def retire_stuck_worker(pool, pid, doc_id):
+    """Take a worker stuck past its builder's timeout out of service without failing other builds.
+
+    A ProcessPoolExecutor fails every outstanding future as soon as one of
+    its workers dies, so the pool is retired first (new builds go to a fresh
+    pool) and the worker itself is only terminated by reap_stuck_workers()
+    once the rest of the old pool has nothing left to run.
+    """
+    with _builds_lock:
+        _stuck_workers.setdefault(pool, set()).add(pid)
+    recycle_builder_pool(pool)
+    print(f"Builder worker {pid} is stuck on {doc_id} after {PACK_BUILDER_TIMEOUT:g}s; retired the builder pool")
+
+
+def reap_stuck_workers():
+    """Terminate the stuck workers of retired pools whose other workers have run out of work."""
+    stuck_pids = []
+    with _builds_lock:
+        for pool, stuck in list(_stuck_workers.items()):
+            builds = [build for build in _builds.values() if build['pool'] is pool]
+            if any(build['started'] is not None and build['pid'] not in stuck for build in builds):
+                continue  # a healthy worker is still building
+            if any(build['started'] is None for build in builds) and len(stuck) < PACK_WORKERS:
+                continue  # queued builds a healthy worker will still pick up
+            del _stuck_workers[pool]
+            # A worker whose build finished after all isn't stuck any more
+            stuck_pids += [build['pid'] for build in builds if build['pid'] in stuck]
+    for pid in stuck_pids:
+        # Its pool breaks, failing just the stuck builds (and any left queued behind them)
+        with contextlib.suppress(ProcessLookupError):
+            os.kill(pid, signal.SIGTERM)
+
+
+builder_pool_recycles = 0
+worker_rss = {}  # pid -> RSS last reported by a worker of the current pool
+
+
+def recycle_builder_pool(pool):
+    """Retire pool without killing it: builds already queued finish, new ones go to a fresh pool.
+
+    Unlike reset_builder_pool() this is for workers that have merely grown
+    (fragmented lxml/openpyxl heaps) or got stuck while the rest of the pool is
+    still busy; the replacement starts in the background.
+    """
+    global _builder_pool, builder_pool_recycles
+    with _builder_pool_lock:
+        if _builder_pool is not pool:
+            return False  # already retired by another request
+        _builder_pool = None
+        builder_pool_recycles += 1
+        worker_rss.clear()
+    pool.shutdown(wait=False)
+    threading.Thread(target=get_builder_pool, name='builder-pool-start', daemon=True).start()
+    return True
+
+
+def note_worker_rss(pool, usage):
+    """Remember a pool worker's RSS and retire the pool once one passes PACK_WORKER_MAX_RSS_MB."""
+    if usage.get('rss') is None or pool is not _builder_pool:
+        return
+    worker_rss[usage['pid']] = usage['rss']
+    if PACK_WORKER_MAX_RSS_MB and usage['rss'] > PACK_WORKER_MAX_RSS_MB * MIB and recycle_builder_pool(pool):
+        print(f"Builder worker {usage['pid']} is at {usage['rss'] / MIB:.0f} MiB; recycled the builder pool")
+
+
+# ============================================================================
+# WARM-UP AND READINESS
+# The first build in a fresh process pays for lazy imports, the default
+# python-docx template, reportlab's stylesheet and font lookups. warm_up()
+# builds every document once with dummy data and throws the results away;
+# /readyz only reports ready once it has finished.
+# ============================================================================
+_ready = threading.Event()
+_warm_up_lock = threading.Lock()
+warm_up_state = {'state': 'cold', 'seconds': None, 'error': None}
+
+
+def warm_builders():
+    """Build each document once in this process (results discarded), then its skeleton."""
+    for doc_id in DOCUMENT_IDS:
+        document_fields(doc_id)  # a full build with the probe data
+    warm_skeletons()
+
+
+def warm_up():
+    """Warm this process, start the builder pool and then the job workers; marks the app ready when done."""
+    with _warm_up_lock:
+        if _ready.is_set():
+            return
+        warm_up_state['state'] = 'warming'
+        started = time.perf_counter()
+        try:
+            warm_builders()
+            if PACK_WORKERS > 1:
+                get_builder_pool()
+        except Exception as e:
+            warm_up_state.update(state='failed', error=str(e))
+            raise
+        finally:
+            # Only after the pool has forked, so no job thread holds a lock across the fork
+            job_queue.start_workers()
+        warm_up_state.update(state='ready', seconds=round(time.perf_counter() - started, 3))
+        _ready.set()
+
+
+def start_warm_up():
+    """Run warm_up() in the background so the process can answer /healthz meanwhile."""
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+
+def iter_documents(COMPANY_INFO, doc_ids=None, window=None):
+    """Yield (doc_id, filename, bytes) for each requested document as soon as it is built.
+
+    With a window, at most that many builds are submitted at once, and the
+    next is submitted only when the consumer asks for another document, so
+    finished documents don't pile up ahead of a slow consumer.
+
+    Raises DocumentBuildError naming the first document that failed or timed out.
+    """
+    doc_ids = DOCUMENT_IDS if doc_ids is None else list(doc_ids)
+
+    if PACK_WORKERS <= 1 or (has_request_context() and g.get('build_inline')):
+        for doc_id in doc_ids:
+            try:
+                data, entries, usage = render_document_timed(doc_id, COMPANY_INFO)
+            except Exception as e:
+                raise DocumentBuildError(doc_id, str(e)) from e
+            record_stages(doc_id, entries)
+            record_memory(doc_id, usage)
+            yield doc_id, DOCUMENT_BUILDERS[doc_id][0], data
+        return
+
+    builds = {}  # future -> (position, doc_id, build id, pool)
+    unsubmitted = iter(enumerate(doc_ids))
+
+    def submit(count):
+        for position, doc_id in itertools.islice(unsubmitted, count):
+            pool, build_id, future = submit_build(doc_id, COMPANY_INFO)
+            builds[future] = (position, doc_id, build_id, pool)
+            pending.add(future)
+
+    try:
+        pending = set()
+        submit(len(doc_ids) if window is None else max(1, window))
+        while pending:
+            # Each builder's timeout runs from when a worker picked it up.
+            now = time.monotonic()
+            started = {future: build_started(builds[future][2]) for future in pending}
+            overdue = [future for future, at in started.items() if at and now - at >= PACK_BUILDER_TIMEOUT]
+            if overdue:
+                # watch_builds() retires the stuck worker
+                doc_id = builds[min(overdue, key=lambda future: builds[future][0])][1]
+                raise DocumentBuildError(doc_id, f"Timed out after {PACK_BUILDER_TIMEOUT:g}s", timed_out=True)
+            # A build that hasn't started yet can't run out before now + PACK_BUILDER_TIMEOUT
+            deadline = min((at + PACK_BUILDER_TIMEOUT for at in started.values() if at),
+                           default=now + PACK_BUILDER_TIMEOUT)
+            done, pending = wait(pending, timeout=max(0, deadline - now), return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=lambda future: builds[future][0]):
+                _, doc_id, _, pool = builds[future]
+                try:
+                    data, entries, usage = future.result()
+                except BrokenProcessPool as e:
+                    # Every outstanding build of the pool fails alike, so don't blame this one
+                    reset_builder_pool(pool)
+                    raise DocumentBuildError(None, f"A builder process died: {e}") from e
+                except Exception as e:
+                    raise DocumentBuildError(doc_id, str(e)) from e
+                record_stages(doc_id, entries)
+                record_memory(doc_id, usage)
+                note_worker_rss(pool, usage)
+                yield doc_id, DOCUMENT_BUILDERS[doc_id][0], data
+                submit(1)
+    finally:
+        for future in builds:
+            future.cancel()
+
+
+def build_documents(COMPANY_INFO, doc_ids=None):
+    """Build the requested documents and return {filename: bytes} in pack order."""
+    results = {doc_id: (filename, data) for doc_id, filename, data in iter_documents(COMPANY_INFO, doc_ids)}
+    return dict(results[doc_id] for doc_id in (DOCUMENT_IDS if doc_ids is None else doc_ids))
+
+
+# ============================================================================
+# PACK CACHE
+# Whole ZIPs keyed on a hash of the request JSON, the date the builders print
+# and the templates' fingerprints. Memory LRU first, optional disk tier second.
+# ============================================================================
+class PackCache:
+    def __init__(self, max_entries, max_bytes, directory=None, ttl=None, disk_max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.ttl = ttl
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'disk_evictions': 0}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return data
+        data = self._disk_get(key)
+        with self._lock:
+            if data is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['disk_hits'] += 1
+        self._memory_put(key, data)
+        return data
+
+    def put(self, key, data):
+        self._memory_put(key, data)
+        self._disk_put(key, data)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), bytes=self._bytes)
+
+    def _memory_put(self, key, data):
+        if self.max_entries <= 0 or len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= len(self._entries.pop(key))
+            self._entries[key] = data
+            self._bytes += len(data)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.stats['evictions'] += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.directory, f'{key}.zip')
+
+    def _disk_get(self, key):
+        if not self.directory:
+            return None
+        path = self._disk_path(key)
+        try:
+            if self.ttl and time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                with self._lock:
+                    self.stats['disk_evictions'] += 1
+                return None
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _disk_put(self, key, data):
+        if not self.directory:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self._disk_path(key))
+        self._disk_evict()
+
+    def _disk_evict(self):
+        """Drop expired files, then the oldest ones until the byte budget fits."""
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.zip'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for mtime, size, path in files:
+            expired = self.ttl and now - mtime > self.ttl
+            if not expired and (not self.disk_max_bytes or total <= self.disk_max_bytes):
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+                total -= size
+                with self._lock:
+                    self.stats['disk_evictions'] += 1
+
+
+pack_cache = PackCache(PACK_CACHE_MAX_ENTRIES, PACK_CACHE_MAX_BYTES, PACK_CACHE_DIR,
+                       PACK_CACHE_TTL, PACK_CACHE_DISK_MAX_BYTES)
+
+
+def pack_cache_key(COMPANY_INFO, doc_ids=None, kind='zip'):
+    """Content address of a pack (or single file): canonical request JSON + today's date + template versions."""
+    doc_ids = DOCUMENT_IDS if doc_ids is None else doc_ids
+    digest = hashlib.sha256(json.dumps(COMPANY_INFO, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+    # Booking form, invoice, quotation and payment reminder all print today's date
+    digest.update(today().strftime('%Y-%m-%d').encode())
+    digest.update(f"{kind}:{','.join(doc_ids)}".encode())
+    for doc_id in doc_ids:
+        digest.update(template_fingerprint(doc_id).encode())
+    return digest.hexdigest()
+
+
+# ============================================================================
+# PACK ARCHIVE MEMBERS
+# How each document is compressed into the pack ZIP (PACK_COMPRESSION), and
+# writing members whose compressed bytes already exist: copied from an earlier
+# pack or produced by fill_skeleton().
+# ============================================================================
+# Suffixes whose content is already a deflated container or compressed image.
+# PDFs are not among them: reportlab does compress page streams, but then
+# ASCII85-encodes them (rl_config.useA85) and writes the object dictionaries
+# and xref table as plain text, so deflate still takes about a third off the
+# user guide.
+STORED_SUFFIXES = ('.docx', '.xlsx', '.zip', '.png', '.jpg', '.jpeg')
+
+_measured_methods = {}  # suffix -> compress_type chosen by the adaptive mode
+
+
+def deflate_saving(data, level=PACK_COMPRESS_LEVEL):
+    """Fraction of the size raw deflate would save on data."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = len(compressor.compress(data)) + len(compressor.flush())
+    return 1 - compressed / max(1, len(data))
+
+
+def member_compression(filename, data, mode=None, level=None):
+    """(compress_type, compresslevel) for one pack member under the given mode."""
+    mode = mode or PACK_COMPRESSION
+    level = PACK_COMPRESS_LEVEL if level is None else level
+    suffix = os.path.splitext(filename)[1].lower()
+    if mode == 'deflate':
+        method = zipfile.ZIP_DEFLATED
+    elif mode == 'stored':
+        method = zipfile.ZIP_STORED
+    elif mode == 'adaptive':
+        method = _measured_methods.get(suffix)
+        if method is None:
+            saving = deflate_saving(data, level)
+            method = zipfile.ZIP_DEFLATED if saving >= PACK_ADAPTIVE_MIN_SAVING else zipfile.ZIP_STORED
+            _measured_methods[suffix] = method
+    else:
+        method = zipfile.ZIP_STORED if suffix in STORED_SUFFIXES else zipfile.ZIP_DEFLATED
+    return method, (level if method == zipfile.ZIP_DEFLATED else None)
+
+
+def write_member(zf, filename, data, mode=None, level=None):
+    compress_type, compresslevel = member_compression(filename, data, mode, level)
+    zf.writestr(filename, data, compress_type=compress_type, compresslevel=compresslevel)
+
+
+def write_raw_member(target, info, data):
+    """Append a member whose compressed bytes are data, with info already carrying its CRC and file_size.
+
+    zipfile can only write members it compresses itself, so this writes the
+    local header and data straight to target.fp and registers the entry the
+    way ZipFile.write() does.
+    """
+    info.compress_size = len(data)
+    info.header_offset = target.fp.tell()
+    target.fp.write(info.FileHeader())
+    target.fp.write(data)
+    target.filelist.append(info)
+    target.NameToInfo[info.filename] = info
+    target.start_dir = target.fp.tell()
+    target._didModify = True
+
+
+def copy_member(source, target, info):
+    """Append source's member info to target unchanged: same compressed bytes, CRC and timestamp."""
+    source.fp.seek(info.header_offset)
+    header = source.fp.read(zipfile.sizeFileHeader)
+    name_length, extra_length = int.from_bytes(header[26:28], 'little'), int.from_bytes(header[28:30], 'little')
+    source.fp.seek(info.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+    data = source.fp.read(info.compress_size)
+    copied = copy.copy(info)
+    copied.flag_bits &= ~0x08  # sizes go in the local header; streamed archives had a data descriptor
+    write_raw_member(target, copied, data)
+
+
+class ZipChunkSink:
+    """Write-only, unseekable file object that collects what ZipFile writes.
+
+    ZipFile falls back to data descriptors on unseekable output, so every
+    member can be flushed to the client as soon as it has been written.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+# ============================================================================
+# INCREMENTAL REBUILDS
+# document_fields() runs each builder once over a dict that notes every
+# COMPANY_INFO key it reads. A pack member's digest covers just those fields,
+# its template fingerprint and, if it prints the date, the day; it is kept as
+# the member's ZIP comment. Given the archive of an earlier pack, members
+# whose digest still matches are copied over as they are and only the rest
+# are rebuilt.
+# ============================================================================
+ALL_FIELDS = '*'  # the builder looked at the whole dict
+PACK_KEY_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+
+class FieldRecorder(dict):
+    """COMPANY_INFO stand-in that adds every key read through it to reads."""
+
+    def __init__(self, data, reads):
+        super().__init__(data)
+        self.reads = reads
+
+    def __getitem__(self, key):
+        self.reads.add(key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.reads.add(key)
+        return super().get(key, default)
+
+    def __contains__(self, key):
+        self.reads.add(key)
+        return super().__contains__(key)
+
+    def __iter__(self):
+        self.reads.add(ALL_FIELDS)
+        return super().__iter__()
+
+    def keys(self):
+        self.reads.add(ALL_FIELDS)
+        return super().keys()
+
+    def items(self):
+        self.reads.add(ALL_FIELDS)
+        return super().items()
+
+    def values(self):
+        self.reads.add(ALL_FIELDS)
+        return super().values()
+
+
+@functools.lru_cache(maxsize=None)
+def document_fields(doc_id):
+    """The COMPANY_INFO keys doc_id's builder reads (DATE_FIELD if it prints today's date)."""
+    reads = set()
+    _clock.reads = reads
+    try:
+        render_full_document(doc_id, FieldRecorder(SKELETON_PROBE_INFO, reads))
+    finally:
+        _clock.reads = None
+    return frozenset(reads)
+
+
+def field_dependencies():
+    """{field: [doc_id, ...]}: which documents have to be rebuilt when a field changes."""
+    dependencies = {}
+    for doc_id in DOCUMENT_IDS:
+        for field in sorted(document_fields(doc_id)):
+            dependencies.setdefault(field, []).append(doc_id)
+    return dependencies
+
+
+def member_digest(doc_id, COMPANY_INFO):
+    """Content address of one pack member: the fields its builder reads, its template and maybe the date."""
+    fields = document_fields(doc_id)
+    if ALL_FIELDS in fields:
+        relevant = COMPANY_INFO
+    else:
+        relevant = {field: COMPANY_INFO[field] for field in fields if field in COMPANY_INFO}
+    digest = hashlib.sha256(json.dumps(relevant, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+    digest.update(template_fingerprint(doc_id).encode())
+    if DATE_FIELD in fields:
+        digest.update(today().strftime('%Y-%m-%d').encode())
+    return digest.hexdigest()[:32]
+
+
+def find_base_pack(header):
+    """Archive bytes of the first earlier pack named in an X-Base-Pack/If-None-Match value that is still cached."""
+    for etag in (header or '').split(',')[:4]:
+        etag, _ = unquote_etag(etag.strip())
+        # Cache keys double as file names in the disk tier, so only well-formed ones are looked up
+        if etag and PACK_KEY_PATTERN.fullmatch(etag) and (data := pack_cache.get(etag)) is not None:
+            return data
+    return None
+
+
+def plan_rebuild(COMPANY_INFO, doc_ids, base_header):
+    """(base archive or None, doc_ids that still have to be built) for a pack request."""
+    base = find_base_pack(base_header)
+    reused = reusable_members(COMPANY_INFO, doc_ids, base)
+    return base, [doc_id for doc_id in (DOCUMENT_IDS if doc_ids is None else doc_ids) if doc_id not in reused]
+
+
+def reusable_members(COMPANY_INFO, doc_ids, base):
+    """{doc_id: ZipInfo} for the members of base that this request would build byte for byte."""
+    if base is None or not isinstance(COMPANY_INFO, dict):
+        return {}
+    with zipfile.ZipFile(io.BytesIO(base)) as source:
+        previous = {info.filename: info for info in source.infolist()}
+    reusable = {}
+    for doc_id in DOCUMENT_IDS if doc_ids is None else doc_ids:
+        info = previous.get(DOCUMENT_BUILDERS[doc_id][0])
+        if info is not None and info.comment == member_digest(doc_id, COMPANY_INFO).encode():
+            reusable[doc_id] = info
+    return reusable
+
+
+
 # ============================================================================
 # 5. MAIN FLASK ROUTE
 # This is the "backend system" you described
 # ============================================================================
+def build_pack_zip(COMPANY_INFO, doc_ids=None, base=None):
+    """Build the documents and write them straight into the archive.
+
+    base is an earlier pack's archive bytes; its members that would come out
+    the same (see reusable_members) are copied instead of rebuilt. Returns the
+    archive at offset 0 and the doc_ids that were built.
+    """
+    doc_ids = DOCUMENT_IDS if doc_ids is None else doc_ids
+    reusable = reusable_members(COMPANY_INFO, doc_ids, base)
+    built = [doc_id for doc_id in doc_ids if doc_id not in reusable]
+
+    # --- 3. Generate all 10 (or the selected) documents in parallel ---
+    documents = build_documents(COMPANY_INFO, built)
+    
+    # --- 4. Create the ZIP file (in memory unless it outgrows PACK_SPOOL_MAX_BYTES) ---
+    if PACK_SPOOL_MAX_BYTES:
+        archive = tempfile.SpooledTemporaryFile(max_size=PACK_SPOOL_MAX_BYTES)
+    else:
+        archive = io.BytesIO()
+    started = time.perf_counter()
+    with zipfile.ZipFile(archive, 'w') as zf, \
+            (zipfile.ZipFile(io.BytesIO(base)) if reusable else contextlib.nullcontext()) as source:
+        for doc_id in doc_ids:
+            filename = DOCUMENT_BUILDERS[doc_id][0]
+            if doc_id in reusable:
+                copy_member(source, zf, reusable[doc_id])
+                continue
+            write_member(zf, filename, documents[filename])
+            if isinstance(COMPANY_INFO, dict):
+                zf.getinfo(filename).comment = member_digest(doc_id, COMPANY_INFO).encode()
+    record_stages('pack', [('zip', time.perf_counter() - started)])
+    
+    archive.seek(0)
+    return archive, built
+
+
+def stream_pack_zip(COMPANY_INFO, doc_ids=None):
+    """Yield the pack ZIP one member at a time, in the order the builders finish.
+
+    Only PACK_WORKERS documents are in flight at once, so a slow client holds
+    back the builds instead of a queue of finished documents.
+    """
+    sink = ZipChunkSink()
+    try:
+        with zipfile.ZipFile(sink, 'w') as zf:
+            for _, filename, data in iter_documents(COMPANY_INFO, doc_ids, window=PACK_WORKERS):
+                write_member(zf, filename, data)
+                del data
+                yield sink.drain()
+    except DocumentBuildError as e:
+        # The status line is already sent; cutting the stream leaves the client
+        # with an archive that has no central directory, i.e. an obvious failure.
+        print(f"Error building {e.filename or 'the pack'} while streaming: {e}")
+        raise
+    # --- central directory ---
+    yield sink.drain()
+
+
+# ============================================================================
+# BATCH GENERATION
+# Many companies per request. Each company is built on its own thread (the
+# documents still go through the shared process pool) and a failure only
+# affects that company's entry.
+# ============================================================================
+def build_company_documents(COMPANY_INFO, doc_ids=None):
+    if not isinstance(COMPANY_INFO, dict):
+        raise ValueError("Each company must be a JSON object")
+    check_document_inputs(COMPANY_INFO, doc_ids)
+    return build_documents(COMPANY_INFO, doc_ids)
+
+
+def iter_batch(companies, doc_ids=None):
+    """Yield (index, documents, error) per company as it finishes, BATCH_CONCURRENCY at a time."""
+    executor = ThreadPoolExecutor(max_workers=max(1, BATCH_CONCURRENCY))
+    queued = iter(enumerate(companies))
+    running = {}
+    try:
+        for index, COMPANY_INFO in queued:
+            running[executor.submit(build_company_documents, COMPANY_INFO, doc_ids)] = index
+            if len(running) >= BATCH_CONCURRENCY:
+                break
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)
+                try:
+                    yield index, future.result(), None
+                except DocumentBuildError as e:
+                    yield index, None, e.to_dict()
+                except InvalidField as e:
+                    yield index, None, dict(e.to_dict(), type="invalid_company")
+                except Exception as e:
+                    yield index, None, {"error": str(e), "type": "invalid_company"}
+                next_company = next(queued, None)
+                if next_company is not None:
+                    running[executor.submit(build_company_documents, next_company[1], doc_ids)] = next_company[0]
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def batch_folder_name(index, COMPANY_INFO):
+    name = COMPANY_INFO.get('name') if isinstance(COMPANY_INFO, dict) else None
+    safe_name = re.sub(r'[^A-Za-z0-9._-]+', '_', str(name or 'company')).strip('._')[:60] or 'company'
+    return f"{index + 1:03d}_{safe_name}"
+
+
+def stream_batch_zip(companies, doc_ids=None):
+    """One folder per company; batch_report.json at the end records every company's outcome.
+
+    The archive carries no progress of its own: clients that want to follow
+    a batch company by company ask for "format": "ndjson".
+    """
+    sink = ZipChunkSink()
+    report = []
+    with zipfile.ZipFile(sink, 'w') as zf:
+        for index, documents, error in iter_batch(companies, doc_ids):
+            folder = batch_folder_name(index, companies[index])
+            if error is None:
+                for filename, data in documents.items():
+                    write_member(zf, f"{folder}/{filename}", data)
+                report.append({"index": index, "folder": folder, "status": "ok"})
+            else:
+                report.append({"index": index, "folder": folder, "status": "error", "error": error})
+            yield sink.drain()
+        report.sort(key=lambda item: item['index'])
+        summary = {"total": len(companies), "failed": sum(item['status'] == 'error' for item in report), "companies": report}
+        write_member(zf, 'batch_report.json', json.dumps(summary, indent=2).encode('utf-8'))
+    yield sink.drain()
+
+
+def stream_batch_ndjson(companies, doc_ids=None):
+    """One JSON line per company (its pack ZIP base64-encoded), progress counters on every line."""
+    done = failed = 0
+    for index, documents, error in iter_batch(companies, doc_ids):
+        done += 1
+        line = {"index": index, "name": batch_folder_name(index, companies[index]), "done": done, "total": len(companies)}
+        if error is None:
+            archive = io.BytesIO()
+            with zipfile.ZipFile(archive, 'w') as zf:
+                for filename, data in documents.items():
+                    write_member(zf, filename, data)
+            line.update(status="ok", filename=f"{line['name']}.zip", zip_base64=base64.b64encode(archive.getvalue()).decode('ascii'))
+        else:
+            failed += 1
+            line.update(status="error", error=error)
+        yield json.dumps(line) + '\n'
+    yield json.dumps({"summary": {"total": len(companies), "succeeded": done - failed, "failed": failed}}) + '\n'
+
+
+# ============================================================================
+# ASYNC JOB QUEUE
+# POST /jobs stores the request and returns at once; background threads claim
+# queued jobs from SQLite, build the pack and keep the ZIP until it expires.
+# ============================================================================
+class QueueFull(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Job queue is full")
+        self.retry_after = retry_after
+
+
+class JobQueue:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,          -- queued, running, done, failed, expired
+            payload TEXT NOT NULL,
+            doc_ids TEXT,
+            submitted_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            expires_at REAL,
+            result BLOB,
+            error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, submitted_at);
+    """
+
+    def __init__(self, path, workers, max_queued, result_ttl, timeout):
+        self.path = path
+        self.workers = workers
+        self.max_queued = max_queued
+        self.result_ttl = result_ttl
+        self.timeout = timeout
+        self.rejected = 0
+        self._wakeup = threading.Event()
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        self._admitting = threading.Lock()
+        with self._connect() as db:
+            db.executescript(self.SCHEMA)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA journal_mode=WAL')
+        return contextlib.closing(db)
+
+    def start_workers(self):
+        """Start this process's worker threads (once per process, so it's safe after a fork).
+
+        Jobs left queued by an earlier process are picked up straight away;
+        ones it left running are failed by the first sweep once they time out.
+        """
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            self._try_sweep()
+            for i in range(self.workers):
+                threading.Thread(target=self._work, name=f'pack-job-{i}', daemon=True).start()
+
+    def submit(self, COMPANY_INFO, doc_ids=None):
+        job_id = uuid.uuid4().hex
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            depth = db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if depth >= self.max_queued:
+                db.execute('ROLLBACK')
+                self.rejected += 1
+                raise QueueFull(self._retry_after(db, depth))
+            db.execute(
+                "INSERT INTO jobs (id, status, payload, doc_ids, submitted_at) VALUES (?, 'queued', ?, ?, ?)",
+                (job_id, json.dumps(COMPANY_INFO), json.dumps(doc_ids), time.time()))
+            db.execute('COMMIT')
+        if warm_up_state['state'] != 'warming':  # warm_up() starts them once its pool exists
+            self.start_workers()
+        self._wakeup.set()
+        return job_id
+
+    def status(self, job_id):
+        self._try_sweep()
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT id, status, submitted_at, started_at, finished_at, expires_at, error, LENGTH(result) AS size "
+                "FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            job = {key: row[key] for key in ('id', 'status', 'submitted_at', 'started_at', 'finished_at', 'expires_at')}
+            if row['status'] == 'queued':
+                job['position'] = db.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND submitted_at <= ?",
+                    (row['submitted_at'],)).fetchone()[0]
+        if row['started_at']:
+            job['wait_ms'] = round((row['started_at'] - row['submitted_at']) * 1000, 1)
+        if row['finished_at']:
+            job['run_ms'] = round((row['finished_at'] - row['started_at']) * 1000, 1)
+        if row['error']:
+            job['error'] = json.loads(row['error'])
+        if row['size'] is not None:
+            job['size'] = row['size']
+        return job
+
+    def result(self, job_id):
+        with self._connect() as db:
+            row = db.execute("SELECT status, result FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return (None, None) if row is None else (row['status'], row['result'])
+
+    def stats(self):
+        self._try_sweep()
+        with self._connect() as db:
+            counts = dict(db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            timing = db.execute(
+                "SELECT AVG(started_at - submitted_at), MAX(started_at - submitted_at), "
+                "AVG(finished_at - started_at), MAX(finished_at - started_at) "
+                "FROM jobs WHERE finished_at IS NOT NULL").fetchone()
+        return {
+            "queue_depth": counts.get('queued', 0),
+            "queue_limit": self.max_queued,
+            "counts": counts,
+            "rejected": self.rejected,  # this process only
+            "workers_per_process": self.workers,
+            "wait_ms": {"avg": ms(timing[0]), "max": ms(timing[1])},
+            "run_ms": {"avg": ms(timing[2]), "max": ms(timing[3])},
+        }
+
+    def _retry_after(self, db, depth):
+        avg_run = db.execute(
+            "SELECT AVG(finished_at - started_at) FROM jobs WHERE finished_at IS NOT NULL").fetchone()[0] or 1.0
+        return max(1, math.ceil(depth * avg_run / max(1, self.workers)))
+
+    def _next(self):
+        """Wait until build_gate has room for the oldest queued job, then claim it.
+
+        Returns (job, admission), or None if nothing is queued. A job only
+        becomes running, and starts counting against the timeout, once admitted.
+        """
+        with self._admitting:
+            while True:
+                with self._connect() as db:
+                    job = db.execute(
+                        "SELECT id, payload, doc_ids FROM jobs WHERE status = 'queued' "
+                        "ORDER BY submitted_at LIMIT 1").fetchone()
+                if job is None:
+                    return None
+                admission = self._admit(job)
+                try:
+                    with self._connect() as db:
+                        claimed = db.execute(
+                            "UPDATE jobs SET status = 'running', started_at = ? WHERE id = ? AND status = 'queued'",
+                            (time.time(), job['id'])).rowcount
+                except sqlite3.Error:
+                    admission.close()
+                    raise
+                if claimed:
+                    return job, admission
+                admission.close()  # another process claimed it meanwhile
+
+    def _finish(self, job_id, result=None, error=None):
+        finished_at = time.time()
+        with self._connect() as db:
+            db.execute(
+                # A job the sweep already failed as timed out stays failed
+                "UPDATE jobs SET status = ?, finished_at = ?, expires_at = ?, result = ?, error = ? "
+                "WHERE id = ? AND status = 'running'",
+                ('done' if error is None else 'failed', finished_at, finished_at + self.result_ttl,
+                 result, None if error is None else json.dumps(error), job_id))
+
+    def _try_sweep(self):
+        """_sweep(), but a busy database only postpones it to the next call."""
+        try:
+            self._sweep()
+        except sqlite3.Error as e:
+            print(f"Job queue error: {e}")
+
+    def _sweep(self):
+        """Expire old results and fail jobs whose worker disappeared mid-build."""
+        now = time.time()
+        with self._connect() as db:
+            db.execute("UPDATE jobs SET status = 'expired', result = NULL WHERE status IN ('done', 'failed') AND expires_at < ?", (now,))
+            db.execute("DELETE FROM jobs WHERE status = 'expired' AND expires_at < ?", (now - 10 * self.result_ttl,))
+            db.execute(
+                "UPDATE jobs SET status = 'failed', finished_at = ?, expires_at = ?, error = ? "
+                "WHERE status = 'running' AND started_at < ?",
+                (now, now + self.result_ttl, json.dumps({"error": "Job timed out or its worker exited"}), now - self.timeout))
+
+    def _admit(self, job):
+        """Wait for room at build_gate like a request would, but for as long as it takes."""
+        admission = contextlib.ExitStack()
+        try:
+            COMPANY_INFO, doc_ids = json.loads(job['payload']), json.loads(job['doc_ids'])
+            cost = request_cost([COMPANY_INFO], doc_ids)
+            memory = request_memory([COMPANY_INFO], doc_ids) if MEMORY_PER_DOCUMENT_MB else 0
+        except Exception:
+            return admission  # can't be priced; _run() fails it
+        while True:
+            try:
+                admission.enter_context(build_gate.admit(cost, memory))
+                return admission
+            except RateLimited as e:
+                time.sleep(e.retry_after)
+
+    def _run(self, job, admission):
+        try:
+            with admission:
+                COMPANY_INFO, doc_ids = json.loads(job['payload']), json.loads(job['doc_ids'])
+                archive, _ = build_pack_zip(COMPANY_INFO, doc_ids)
+                result = archive.read()
+        except DocumentBuildError as e:
+            self._finish(job['id'], error=e.to_dict())
+        except Exception as e:
+            print(f"Error: {e}")
+            self._finish(job['id'], error={"error": str(e)})
+        else:
+            self._finish(job['id'], result=result)
+
+    def _work(self):
+        while True:
+            try:
+                claimed = self._next()
+                if claimed is None:
+                    self._wakeup.wait(timeout=1.0)
+                    self._wakeup.clear()
+                    self._sweep()
+                else:
+                    self._run(*claimed)
+            except sqlite3.Error as e:
+                # e.g. "database is locked"; the job, if any, is failed by a later sweep
+                print(f"Job queue error: {e}")
+                time.sleep(1.0)
+
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+job_queue = JobQueue(JOB_DB_PATH, JOB_WORKERS, JOB_QUEUE_MAX, JOB_RESULT_TTL, JOB_TIMEOUT)
+
+
+# ============================================================================
+# ADMISSION CONTROL
+# A request that has to build is priced first (request_cost) and charged to
+# its client's token bucket and the global one; an empty bucket means 429 with
+# Retry-After. Builds then pass a per-process gate on the cost in flight, with
+# a short wait queue in front of it, so overload turns into quick 429s rather
+# than ever longer latency. 304s and cache hits are never charged.
+# ============================================================================
+class RateLimited(Exception):
+    status = 429
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class MemoryExhausted(RateLimited):
+    status = 503  # the server is short, not the client over its limit
+
+
+def document_rows(COMPANY_INFO, doc_ids):
+    """Table rows (line items, equipment, service log entries) one company sends to doc_ids."""
+    if not isinstance(COMPANY_INFO, dict):
+        return 0
+    return sum(len(value) for doc_id in doc_ids for field in DOCUMENT_INPUTS.get(doc_id, ())
+               if isinstance(value := COMPANY_INFO.get(field), list))
+
+
+def request_cost(companies, doc_ids=None, extra_rows=0):
+    """Estimated work, in document builds, of building doc_ids for each company."""
+    doc_ids = DOCUMENT_IDS if doc_ids is None else doc_ids
+    rows = extra_rows + sum(document_rows(COMPANY_INFO, doc_ids) for COMPANY_INFO in companies)
+    return len(doc_ids) * len(companies) + rows / ADMISSION_ROWS_PER_COST
+
+
+def request_memory(companies, doc_ids=None, extra_rows=0):
+    """Rough peak memory, in bytes, of building doc_ids for each company.
+
+    Documents are built at most PACK_WORKERS (and batch companies
+    BATCH_CONCURRENCY) at a time, so only that many count; table rows are
+    what makes a single build large.
+    """
+    doc_ids = DOCUMENT_IDS if doc_ids is None else doc_ids
+    at_once = min(len(companies), BATCH_CONCURRENCY)
+    documents = min(len(doc_ids) * at_once, max(1, PACK_WORKERS))
+    rows = sorted(document_rows(COMPANY_INFO, doc_ids) for COMPANY_INFO in companies)[-at_once:]
+    return documents * MEMORY_PER_DOCUMENT_MB * MIB + (extra_rows + sum(rows)) * MEMORY_PER_ROW_KB * 1024
+
+
+def api_key_digest(api_key):
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:32]
+
+
+KNOWN_API_KEYS = frozenset(api_key_digest(key) for key in RATE_LIMIT_API_KEYS)
+
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
+
+def proxied_address(address, forwarded_for):
+    """The client address ProxyFix gives the Flask routes, for the ASGI route that bypasses them."""
+    hops = [hop.strip() for hop in (forwarded_for or '').split(',')]
+    if TRUSTED_PROXY_HOPS and forwarded_for and len(hops) >= TRUSTED_PROXY_HOPS:
+        return hops[-TRUSTED_PROXY_HOPS]
+    return address
+
+
+def client_key(api_key, address):
+    """Bucket name for a client: a known API key (hashed, so keys never reach the SQLite file), else its address."""
+    if api_key and (digest := api_key_digest(api_key)) in KNOWN_API_KEYS:
+        return 'key:' + digest
+    return f'addr:{address}'
+
+
+class TokenBuckets:
+    """Named token buckets, in this process's memory or in a SQLite file every worker shares."""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS buckets (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+    """
+    IDLE_TTL = 3600  # buckets untouched this long are dropped (long since refilled)
+
+    def __init__(self, path=None):
+        self.path = path
+        self.limited = 0
+        self._buckets = {}  # key -> (tokens, updated_at)
+        self._takes = 0
+        self._lock = threading.Lock()
+        if path:
+            with self._connect() as db:
+                db.executescript(self.SCHEMA)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        return contextlib.closing(db)
+
+    def take(self, cost, limits):
+        """Charge cost to every (key, rate, burst) bucket in limits, or to none of them.
+
+        A bucket only needs min(cost, burst) tokens on hand, so a batch larger
+        than the burst is let through from a full bucket and leaves it in debt.
+        Returns 0 when charged, else the seconds until every bucket could pay.
+        """
+        now = time.time()
+        keys = [key for key, _, _ in limits]
+        with self._lock:
+            self._takes += 1
+            sweep = self._takes % 1000 == 0
+            if self.path is None:
+                if sweep:
+                    self._buckets = {key: value for key, value in self._buckets.items()
+                                     if value[1] > now - self.IDLE_TTL}
+                wait = self._take(self._buckets, cost, limits, now)
+            else:
+                with self._connect() as db:
+                    db.execute('BEGIN IMMEDIATE')
+                    if sweep:
+                        db.execute("DELETE FROM buckets WHERE updated_at < ?", (now - self.IDLE_TTL,))
+                    stored = {key: (tokens, updated_at) for key, tokens, updated_at in db.execute(
+                        f"SELECT key, tokens, updated_at FROM buckets WHERE key IN ({','.join('?' * len(keys))})", keys)}
+                    wait = self._take(stored, cost, limits, now)
+                    if not wait:
+                        db.executemany("INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                                       [(key, *stored[key]) for key in keys])
+                    db.execute('COMMIT')
+            if wait:
+                self.limited += 1
+        return wait
+
+    @staticmethod
+    def _take(buckets, cost, limits, now):
+        levels, wait = {}, 0.0
+        for key, rate, burst in limits:
+            tokens, updated_at = buckets.get(key, (burst, now))
+            levels[key] = tokens = min(burst, tokens + (now - updated_at) * rate)
+            need = min(cost, burst)
+            if tokens < need:
+                wait = max(wait, (need - tokens) / rate)
+        if not wait:
+            for key in levels:
+                buckets[key] = (levels[key] - cost, now)
+        return wait
+
+
+class BuildGate:
+    """Caps the cost being built at once in this process; admits a build only if its memory fits.
+
+    Requests that don't fit wait in a bounded, time-limited queue. Memory
+    frees up without notifying anyone, so waiters also re-check it every
+    MEMORY_POLL seconds.
+    """
+    MEMORY_POLL = 0.25
+
+    def __init__(self, capacity, max_waiting, max_wait):
+        self.capacity = capacity
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.inflight = 0.0
+        self.inflight_memory = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.rejected_memory = 0
+        self._cond = threading.Condition()
+
+    def _blocker(self, cost, memory):
+        """Why the request can't start yet ('builders' or 'memory'), or None."""
+        # A request bigger than the whole capacity runs once nothing else is
+        if cost and self.capacity > 0 and self.inflight and self.inflight + cost > self.capacity:
+            return 'builders'
+        if memory:
+            # Builds already running show up in memory_available() itself;
+            # inflight_memory is only reported
+            available = memory_available()
+            if available is not None and memory > available - MEMORY_RESERVE_MB * MIB:
+                return 'memory'
+        return None
+
+    def _reject(self, blocker, message):
+        retry_after = max(1, math.ceil(self.max_wait))
+        self.rejected += 1
+        if blocker == 'memory':
+            self.rejected_memory += 1
+            return MemoryExhausted(f"{message}: not enough memory left for this request", retry_after)
+        return RateLimited(f"{message}: all builders are busy", retry_after)
+
+    @contextlib.contextmanager
+    def admit(self, cost, memory=0, wait=True):
+        """Hold cost and memory while building; without wait, refuse at once instead of queueing."""
+        with self._cond:
+            blocker = self._blocker(cost, memory)
+            if blocker and (not wait or self.waiting >= self.max_waiting):
+                raise self._reject(blocker, "Too many builds queued" if wait else "Refused")
+            if blocker:
+                deadline = time.monotonic() + self.max_wait
+                self.waiting += 1
+                try:
+                    while blocker and (remaining := deadline - time.monotonic()) > 0:
+                        self._cond.wait(timeout=min(remaining, self.MEMORY_POLL) if blocker == 'memory' else remaining)
+                        blocker = self._blocker(cost, memory)
+                finally:
+                    self.waiting -= 1
+                if blocker:
+                    raise self._reject(blocker, f"Waited {self.max_wait:g}s")
+            self.inflight += cost
+            self.inflight_memory += memory
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.inflight -= cost
+                self.inflight_memory -= memory
+                self._cond.notify_all()
+
+
+rate_buckets = TokenBuckets(RATE_LIMIT_DB)
+build_gate = BuildGate(ADMISSION_MAX_INFLIGHT, ADMISSION_QUEUE_MAX, ADMISSION_MAX_WAIT)
+
+
+def charge(client, cost):
+    """Take cost from client's bucket and the global one; raises RateLimited when either is short."""
+    limits = []
+    if RATE_LIMIT_KEY_RATE > 0:
+        limits.append((client, RATE_LIMIT_KEY_RATE, RATE_LIMIT_KEY_BURST))
+    if RATE_LIMIT_GLOBAL_RATE > 0:
+        limits.append(('global', RATE_LIMIT_GLOBAL_RATE, RATE_LIMIT_GLOBAL_BURST))
+    wait = rate_buckets.take(cost, limits) if limits else 0
+    if wait:
+        raise RateLimited(f"Rate limit exceeded (this request costs {cost:g} builds)", max(1, math.ceil(wait)))
+
+
+def admit_build(cost, memory=0):
+    """Charge the current request and wait for the build gate; use the result as a context manager."""
+    charge(client_key(request.headers.get('X-API-Key'), request.remote_addr), cost)
+    return build_gate.admit(cost, memory if MEMORY_PER_DOCUMENT_MB else 0)
+
+
+def hold_for_response(response, admission):
+    """Keep an entered admission until a streamed response has been sent (or abandoned)."""
+    response.call_on_close(admission.close)
+    return response
+
+
+# ============================================================================
+# ON-DEMAND PROFILING
+# A request with an X-Profile-Token header matching PROFILE_ADMIN_TOKEN runs
+# its builders in-process under cProfile (default) or a stack sampler
+# (X-Profile: sample). The result lands in PROFILE_DIR, which keeps the
+# newest PROFILE_MAX_FILES dumps, and is downloadable from /profiles/<id>.
+# ============================================================================
+def is_profile_admin():
+    # Header only: a query-string token would end up in access logs and browser history
+    token = request.headers.get('X-Profile-Token')
+    return bool(PROFILE_ADMIN_TOKEN and token) and hmac.compare_digest(token.encode(), PROFILE_ADMIN_TOKEN.encode())
+
+
+def profile_names():
+    """Profile dumps in PROFILE_DIR, oldest first (ids start with their timestamp)."""
+    names = sorted(os.listdir(PROFILE_DIR)) if os.path.isdir(PROFILE_DIR) else []
+    return [name for name in names if name.endswith(('.pstats', '.collapsed'))]
+
+
+def prune_profiles():
+    """Delete all but the newest PROFILE_MAX_FILES dumps."""
+    if PROFILE_MAX_FILES <= 0:
+        return
+    for name in profile_names()[:-PROFILE_MAX_FILES]:
+        with contextlib.suppress(FileNotFoundError):  # another worker got there first
+            os.remove(os.path.join(PROFILE_DIR, name))
+
+
+class StackSampler:
+    """Samples one thread's stack on a timer and counts collapsed stacks (flamegraph input)."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def collapsed(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in sorted(self.counts.items()))
+
+
+def profiled(view):
+    """Profile the wrapped view when an admin asks for it; otherwise call it unchanged."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not is_profile_admin():
+            return view(*args, **kwargs)
+        mode = request.headers.get('X-Profile') or request.args.get('profile') or 'cprofile'
+        if mode not in ('cprofile', 'sample'):
+            return jsonify({"error": "X-Profile must be 'cprofile' or 'sample'"}), 400
+        # Pool workers are out of the profiler's reach, and a cache hit would
+        # profile nothing, so this request builds everything in-process.
+        g.build_inline = True
+        g.profiling = True
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profile_id = f"{datetime.now():%Y%m%d-%H%M%S-%f}-{uuid.uuid4().hex[:8]}"
+        if mode == 'sample':
+            with StackSampler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL) as sampler:
+                response = view(*args, **kwargs)
+            path = os.path.join(PROFILE_DIR, f'{profile_id}.collapsed')
+            with open(path, 'w') as f:
+                f.write(sampler.collapsed())
+        else:
+            profiler = cProfile.Profile()
+            response = profiler.runcall(view, *args, **kwargs)
+            path = os.path.join(PROFILE_DIR, f'{profile_id}.pstats')
+            profiler.dump_stats(path)
+        prune_profiles()
+        response = app.make_response(response)
+        response.headers['X-Profile-Id'] = os.path.basename(path)
+        return response
+    return wrapper
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def finish_request_timer(response):
+    started = g.pop('request_started', None)
+    if started is None or not METRICS_ENABLED:
+        return response
+    elapsed = time.perf_counter() - started
+    REQUEST_SECONDS.observe(elapsed, request.url_rule.rule if request.url_rule else 'unmatched', str(response.status_code))
+    # Generator bodies (streamed packs and batches) do their work after the headers are sent
+    if SERVER_TIMING_ENABLED and not isinstance(response.response, types.GeneratorType):
+        timings = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in g.get('server_timing', {}).items()]
+        timings.append(f"total;dur={elapsed * 1000:.1f}")
+        response.headers['Server-Timing'] = ', '.join(timings)
+    return response
+
+
+def retry_later(e):
+    """429 (503 when memory is short) for a QueueFull or RateLimited error, with its Retry-After."""
+    response = jsonify({"error": str(e), "retry_after": e.retry_after})
+    response.status_code = getattr(e, 'status', 429)
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+def not_modified(cache_key):
+    response = app.response_class(status=304)
+    response.set_etag(cache_key, weak=True)
+    return response
+
+
 @app.route('/generate-pack', methods=['POST'])
+@profiled
 def generate_pack():
     try:
-        # 1. Get customer details from the form
+        # 1. Get customer details from the form (and ?docs=invoice,quotation for a partial pack)
         COMPANY_INFO = request.json
+        try:
+            doc_ids = parse_doc_selection(request.args.get('docs'))
+        except ValueError as e:
+            return jsonify({"error": str(e), "available": DOCUMENT_IDS}), 400
+        check_document_inputs(COMPANY_INFO, doc_ids)
+        
+        # Same inputs on the same day -> same pack; let the client keep its copy
+        cache_key = pack_cache_key(COMPANY_INFO, doc_ids)
+        profiling = g.get('profiling', False)
+        if request.if_none_match.contains_weak(cache_key) and not profiling:
+            return not_modified(cache_key)
+        
+        zip_bytes = None if profiling else pack_cache.get(cache_key)
+        cache_status = 'hit' if zip_bytes is not None else 'miss'
+        if zip_bytes is None and not profiling and (PACK_STREAMING or request.args.get('stream') == '1'):
+            admission = contextlib.ExitStack()
+            admission.enter_context(admit_build(request_cost([COMPANY_INFO], doc_ids),
+                                                request_memory([COMPANY_INFO], doc_ids)))
+            # Streamed packs skip the cache so only one document is held at a time
+            response = Response(stream_pack_zip(COMPANY_INFO, doc_ids), mimetype='application/zip')
+            response.headers['Content-Disposition'] = 'attachment; filename=Bilingual_Business_Template_Pack.zip'
+            response.set_etag(cache_key, weak=True)
+            response.headers['X-Pack-Cache'] = 'bypass'
+            return hold_for_response(response, admission)
+        
+        if zip_bytes is not None:
+            archive = io.BytesIO(zip_bytes)
+            size = len(zip_bytes)
+        else:
+            # A client holding an earlier pack (X-Base-Pack or If-None-Match) only pays for what changed
+            base_header = request.headers.get('X-Base-Pack') or request.headers.get('If-None-Match')
+            base, to_build = plan_rebuild(COMPANY_INFO, doc_ids, None if profiling else base_header)
+            with admit_build(request_cost([COMPANY_INFO], to_build), request_memory([COMPANY_INFO], to_build)):
+                archive, rebuilt = build_pack_zip(COMPANY_INFO, doc_ids, base)
+            if len(rebuilt) < len(doc_ids or DOCUMENT_IDS):
+                cache_status = 'partial'
+            size = archive.seek(0, io.SEEK_END)
+            archive.seek(0)
+            # Archives that spilled to disk are streamed from there, not cached in memory
+            if not PACK_SPOOL_MAX_BYTES or size <= PACK_SPOOL_MAX_BYTES:
+                pack_cache.put(cache_key, archive.getvalue() if isinstance(archive, io.BytesIO) else archive.read())
+                archive.seek(0)
+        
+        # --- 5. Send the ZIP file to the customer ---
+        response = send_file(
+            archive,
+            mimetype='application/zip',
+            as_attachment=True,
+            download_name='Bilingual_Business_Template_Pack.zip',
+            etag=False
+        )
+        response.content_length = size
+        response.set_etag(cache_key, weak=True)
+        response.headers['X-Pack-Cache'] = cache_status
+        if cache_status == 'partial':
+            response.headers['X-Pack-Rebuilt'] = ','.join(rebuilt)
+        return response
+
+    except RateLimited as e:
+        return retry_later(e)
+
+    except InvalidField as e:
+        return jsonify(e.to_dict()), 400
+
+    except DocumentBuildError as e:
+        print(f"Error building {e.filename or 'the pack'}: {e}")
+        return jsonify(e.to_dict()), 504 if e.timed_out else 500
+
+    except Exception as e:
+        print(f"Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/generate-batch', methods=['POST'])
+def generate_batch():
+    """Packs for many companies: {"companies": [...], "format": "zip" | "ndjson"} (?docs= works here too)."""
+    payload = request.get_json(silent=True)
+    companies = payload.get('companies') if isinstance(payload, dict) else payload
+    output_format = (payload.get('format') if isinstance(payload, dict) else None) or request.args.get('format', 'zip')
+    if not isinstance(companies, list) or not companies:
+        return jsonify({"error": "Expected a non-empty list of companies"}), 400
+    if len(companies) > BATCH_MAX_COMPANIES:
+        return jsonify({"error": f"At most {BATCH_MAX_COMPANIES} companies per batch"}), 413
+    if output_format not in ('zip', 'ndjson'):
+        return jsonify({"error": "format must be 'zip' or 'ndjson'"}), 400
+    try:
+        doc_ids = parse_doc_selection(request.args.get('docs'))
+    except ValueError as e:
+        return jsonify({"error": str(e), "available": DOCUMENT_IDS}), 400
+
+    admission = contextlib.ExitStack()
+    try:
+        admission.enter_context(admit_build(request_cost(companies, doc_ids), request_memory(companies, doc_ids)))
+    except RateLimited as e:
+        return retry_later(e)
+
+    if output_format == 'ndjson':
+        response = Response(stream_batch_ndjson(companies, doc_ids), mimetype='application/x-ndjson')
+    else:
+        response = Response(stream_batch_zip(companies, doc_ids), mimetype='application/zip')
+        response.headers['Content-Disposition'] = 'attachment; filename=Bilingual_Business_Template_Packs.zip'
+    response.headers['X-Batch-Total'] = str(len(companies))
+    return hold_for_response(response, admission)
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Queue a pack build; poll /jobs/<id> and download /jobs/<id>/result."""
+    COMPANY_INFO = request.get_json(silent=True)
+    if not isinstance(COMPANY_INFO, dict):
+        return jsonify({"error": "Expected the company details as a JSON object"}), 400
+    try:
+        doc_ids = parse_doc_selection(request.args.get('docs'))
+    except ValueError as e:
+        return jsonify({"error": str(e), "available": DOCUMENT_IDS}), 400
+    try:
+        check_document_inputs(COMPANY_INFO, doc_ids)
+    except InvalidField as e:
+        return jsonify(e.to_dict()), 400
+    try:
+        # Charged now; the job's worker waits for build_gate instead of the request
+        charge(client_key(request.headers.get('X-API-Key'), request.remote_addr), request_cost([COMPANY_INFO], doc_ids))
+        job_id = job_queue.submit(COMPANY_INFO, doc_ids)
+    except (QueueFull, RateLimited) as e:
+        return retry_later(e)
+    response = jsonify({"job_id": job_id, "status_url": f"/jobs/{job_id}", "result_url": f"/jobs/{job_id}/result"})
+    response.status_code = 202
+    response.headers['Location'] = f"/jobs/{job_id}"
+    return response
+
+@app.route('/jobs/stats', methods=['GET'])
+def job_stats():
+    return jsonify(job_queue.stats())
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_queue.status(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    status, result = job_queue.result(job_id)
+    if status is None:
+        return jsonify({"error": "Unknown job"}), 404
+    if status in ('queued', 'running'):
+        return jsonify({"error": "Job has not finished", "status": status}), 409
+    if status == 'expired':
+        return jsonify({"error": "Job result has expired", "status": status}), 410
+    if status == 'failed':
+        return jsonify({"error": "Job failed", "status": status, "job": job_queue.status(job_id)}), 500
+    return send_file(
+        io.BytesIO(result),
+        mimetype='application/zip',
+        as_attachment=True,
+        download_name='Bilingual_Business_Template_Pack.zip'
+    )
+
+@app.route('/documents', methods=['GET'])
+def list_documents():
+    return jsonify([
+        {"id": doc_id, "filename": filename, "mimetype": document_mimetype(doc_id)}
+        for doc_id, filename, _ in PACK_DOCUMENTS
+    ])
+
+@app.route('/documents/dependencies', methods=['GET'])
+def document_dependencies():
+    """{field: [doc_id, ...]}: the documents a follow-up request rebuilds when that field changes."""
+    return jsonify(field_dependencies())
+
+@app.route('/generate/<doc_id>', methods=['GET', 'POST'])
+@profiled
+def generate_document(doc_id):
+    """Build a single document. POST takes the company JSON, GET takes it as query parameters.
+
+    /generate/service_log also takes a multipart upload: the company fields as
+    form fields and the maintenance history as a CSV file named service_log.
+    """
+    if doc_id not in DOCUMENT_BUILDERS:
+        return jsonify({"error": f"Unknown document: {doc_id}", "available": DOCUMENT_IDS}), 404
+    try:
+        upload = request.files.get('service_log') if doc_id == 'service_log' else None
+        if upload is not None:
+            # The CSV is read row by row while the sheet is written, so it is
+            # built in this process and, having no content address, not cached.
+            COMPANY_INFO = dict(request.form.to_dict(), service_log=iter_service_log_csv(upload.stream))
+            g.build_inline = True
+        else:
+            COMPANY_INFO = request.json if request.method == 'POST' else request.args.to_dict()
+        check_document_inputs(COMPANY_INFO, [doc_id])
+        filename = DOCUMENT_BUILDERS[doc_id][0]
         
-        # 2. Create a temporary directory to store files
-        with tempfile.TemporaryDirectory() as temp_dir:
-            
-            # --- 3. Generate all 10 documents ---
-            
-            # Doc 1: Agreement
-            doc1 = create_rental_agreement(COMPANY_INFO)
-            doc1.save(os.path.join(temp_dir, '01_Equipment_Rental_Agreement.docx'))
-            
-            # Doc 2: Booking Form
-            doc2 = create_booking_form(COMPANY_INFO)
-            doc2.save(os.path.join(temp_dir, '02_Machinery_Booking_Form.docx'))
-            
-            # Doc 3: Invoice
-            wb3 = create_invoice_xlsx(COMPANY_INFO)
-            wb3.save(os.path.join(temp_dir, '03_Professional_Invoice.xlsx'))
-            
-            # Doc 4: Service Log
-            wb4 = create_service_log(COMPANY_INFO)
-            wb4.save(os.path.join(temp_dir, '04_Equipment_Service_Log.xlsx'))
-            
-            # Doc 5: Payment Reminder
-            doc5 = create_payment_reminder(COMPANY_INFO)
-            doc5.save(os.path.join(temp_dir, '05_Payment_Reminder_Letter.docx'))
-            
-            # Doc 6: Customer Portal Form
-            doc6 = create_customer_portal_form(COMPANY_INFO)
-            doc6.save(os.path.join(temp_dir, '06_Customer_Portal_Form.docx'))
-            
-            # Doc 7: Quotation
-            wb7 = create_quotation_template(COMPANY_INFO)
-            wb7.save(os.path.join(temp_dir, '07_Quotation_Template.xlsx'))
-            
-            # Doc 8: Delivery Checklist
-            doc8 = create_delivery_checklist(COMPANY_INFO)
-            doc8.save(os.path.join(temp_dir, '08_Delivery_Checklist.docx'))
-            
-            # Doc 9: User Guide (PDF from memory)
-            pdf_buffer = create_user_guide_pdf(COMPANY_INFO)
-            with open(os.path.join(temp_dir, '09_User_Guide.pdf'), 'wb') as f:
-                f.write(pdf_buffer.getvalue())
-            
-            # Doc 10: Product Overview
-            doc10 = create_product_overview(COMPANY_INFO)
-            doc10.save(os.path.join(temp_dir, '10_Product_Overview.docx'))
-            
-            # --- 4. Create the ZIP file ---
-            zip_buffer = io.BytesIO()
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-                for root, _, files in os.walk(temp_dir):
-                    for file in files:
-                        zf.write(os.path.join(root, file), arcname=file)
-            
-            zip_buffer.seek(0)
-            
-            # --- 5. Send the ZIP file to the customer ---
-            return send_file(
-                zip_buffer,
-                mimetype='application/zip',
-                as_attachment=True,
-                download_name='Bilingual_Business_Template_Pack.zip'
-            )
+        cache_key = None if upload is not None else pack_cache_key(COMPANY_INFO, [doc_id], kind='file')
+        profiling = g.get('profiling', False)
+        if cache_key is not None and request.if_none_match.contains_weak(cache_key) and not profiling:
+            return not_modified(cache_key)
+        
+        data = None if profiling or cache_key is None else pack_cache.get(cache_key)
+        cache_status = 'hit' if data is not None else 'miss' if cache_key is not None else 'bypass'
+        if data is None:
+            # An uploaded CSV's rows are only counted while the sheet is built; guess ~100 bytes a row
+            extra_rows = (request.content_length or 0) // 100 if upload is not None else 0
+            with admit_build(request_cost([COMPANY_INFO], [doc_id], extra_rows),
+                             request_memory([COMPANY_INFO], [doc_id], extra_rows)):
+                ((_, _, data),) = iter_documents(COMPANY_INFO, [doc_id])
+            if cache_key is not None:
+                pack_cache.put(cache_key, data)
+        
+        response = send_file(
+            io.BytesIO(data),
+            mimetype=document_mimetype(doc_id),
+            as_attachment=True,
+            download_name=filename,
+            etag=False
+        )
+        if cache_key is not None:
+            response.set_etag(cache_key, weak=True)
+        response.headers['X-Pack-Cache'] = cache_status
+        return response
+
+    except RateLimited as e:
+        return retry_later(e)
+
+    except InvalidField as e:
+        return jsonify(e.to_dict()), 400
+
+    except DocumentBuildError as e:
+        print(f"Error building {e.filename or 'the pack'}: {e}")
+        return jsonify(e.to_dict()), 504 if e.timed_out else 500
 
     except Exception as e:
         print(f"Error: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text format. Each gunicorn worker reports its own numbers."""
+    lines = STAGE_SECONDS.render() + REQUEST_SECONDS.render()
+    for name, value in pack_cache.snapshot().items():
+        kind = 'gauge' if name in ('entries', 'bytes') else 'counter'
+        suffix = '' if kind == 'gauge' else '_total'
+        lines += [f"# TYPE pack_cache_{name}{suffix} {kind}", f"pack_cache_{name}{suffix} {value}"]
+    lines += ["# TYPE pack_job_queue_depth gauge", f"pack_job_queue_depth {job_queue.stats()['queue_depth']}"]
+    lines += ["# TYPE pack_admission_inflight_cost gauge", f"pack_admission_inflight_cost {build_gate.inflight:g}",
+              "# TYPE pack_admission_waiting gauge", f"pack_admission_waiting {build_gate.waiting}",
+              "# TYPE pack_admission_rejected_total counter", f"pack_admission_rejected_total {build_gate.rejected}",
+              "# TYPE pack_rate_limited_total counter", f"pack_rate_limited_total {rate_buckets.limited}"]
+    lines += BUILDER_RSS_DELTA.render() + BUILDER_PEAK.render()
+    lines += ["# TYPE pack_admission_inflight_memory_bytes gauge",
+              f"pack_admission_inflight_memory_bytes {build_gate.inflight_memory:.0f}",
+              "# TYPE pack_admission_rejected_memory_total counter",
+              f"pack_admission_rejected_memory_total {build_gate.rejected_memory}",
+              "# TYPE pack_builder_pool_recycles_total counter", f"pack_builder_pool_recycles_total {builder_pool_recycles}"]
+    rss, available = current_rss(), memory_available()
+    if rss is not None:
+        lines += ["# TYPE process_resident_memory_bytes gauge", f"process_resident_memory_bytes {rss}"]
+    if available is not None:
+        lines += ["# TYPE pack_memory_available_bytes gauge", f"pack_memory_available_bytes {available}"]
+    if worker_rss:
+        lines.append("# TYPE pack_builder_worker_rss_bytes gauge")
+        lines += [f'pack_builder_worker_rss_bytes{{pid="{pid}"}} {value}' for pid, value in sorted(worker_rss.items())]
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+@app.route('/profiles', methods=['GET'])
+def list_profiles():
+    if not is_profile_admin():
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify(profile_names())
+
+@app.route('/profiles/<profile_id>', methods=['GET'])
+def download_profile(profile_id):
+    """The raw .pstats file (open with pstats/snakeviz) or collapsed stacks (flamegraph.pl/speedscope)."""
+    if not is_profile_admin():
+        return jsonify({"error": "Forbidden"}), 403
+    if not re.fullmatch(r'[\w-]+\.(pstats|collapsed)', profile_id):
+        return jsonify({"error": "Unknown profile"}), 404
+    path = os.path.join(PROFILE_DIR, profile_id)
+    if not os.path.isfile(path):
+        return jsonify({"error": "Unknown profile"}), 404
+    return send_file(path, mimetype='text/plain' if profile_id.endswith('.collapsed') else 'application/octet-stream',
+                     as_attachment=True, download_name=profile_id)
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness: the process is up and serving, warm or not."""
+    return jsonify({"status": "ok"})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """Readiness: 503 until warm_up() has finished, so the load balancer skips cold workers."""
+    status = 200 if _ready.is_set() else 503
+    return jsonify(warm_up_state), status
+
+@app.route('/pack-cache/stats', methods=['GET'])
+def pack_cache_stats():
+    return jsonify(pack_cache.snapshot())
+
 # ============================================================================
 # 6. RUN THE SERVER
 # ============================================================================
 if __name__ == '__main__':
+    start_warm_up()
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,367 @@
+"""ASGI entry point for the template pack backend.
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000 [--workers N]
+
+POST /generate-pack is served natively. The event loop parses the request and
+answers 304s and pack-cache hits itself. A miss hands the same code the Flask
+route uses (app.build_pack_zip, or app.stream_pack_zip with ?stream=1) to a
+bounded thread pool, whose documents go through app's builder process pool as
+usual. One process can therefore hold many open connections while only
+ASGI_MAX_BUILDS packs are being built; up to ASGI_MAX_WAITING more wait for a
+slot and anything beyond that gets a 429 with Retry-After. These slots take
+the place of app.build_gate; builds are still charged to app's token buckets.
+Clients are told apart the way the Flask routes do it, by address after
+app.TRUSTED_PROXY_HOPS X-Forwarded-For hops.
+
+Every other route, and profiled /generate-pack requests, runs the Flask app
+through a small WSGI bridge on ASGI_WSGI_THREADS threads. The bridge reads the
+whole request body before calling Flask.
+
+GET /asgi/limits reports these limits and how much of them is in use.
+"""
+import asyncio
+import contextlib
+import io
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from werkzeug.http import parse_etags, quote_etag
+
+import app
+
+# --- Concurrency Settings ---
+# Packs built at the same time by this process (each holds one build thread until it is sent).
+ASGI_MAX_BUILDS = int(os.environ.get('ASGI_MAX_BUILDS', '4'))
+# Requests allowed to wait for a build slot; the rest are turned away with 429.
+ASGI_MAX_WAITING = int(os.environ.get('ASGI_MAX_WAITING', '64'))
+# Threads running the Flask app for every route that is not served natively.
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', '8'))
+
+PACK_FILENAME = 'Bilingual_Business_Template_Pack.zip'
+# Spilled (PACK_SPOOL_MAX_BYTES) archives are sent from disk in chunks of this size
+SEND_CHUNK_BYTES = 1024 * 1024
+
+
+class SlotsFull(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Too many packs are being built; try again shortly")
+        self.retry_after = retry_after
+
+
+class BuildSlots:
+    """At most `size` builds at once and at most `max_waiting` requests queued behind them."""
+
+    def __init__(self, size, max_waiting):
+        self.size = size
+        self.max_waiting = max_waiting
+        self.building = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.avg_build_seconds = None  # moving average, for Retry-After
+        self._semaphore = asyncio.Semaphore(size)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        if self._semaphore.locked() and self.waiting >= self.max_waiting:
+            self.rejected += 1
+            raise SlotsFull(self.retry_after())
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.building += 1
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.avg_build_seconds = elapsed if self.avg_build_seconds is None else (
+                0.8 * self.avg_build_seconds + 0.2 * elapsed)
+            self.building -= 1
+            self._semaphore.release()
+
+    def retry_after(self):
+        return max(1, math.ceil((self.waiting + 1) * (self.avg_build_seconds or 1.0) / max(1, self.size)))
+
+    def snapshot(self):
+        return {
+            "max_builds": self.size,
+            "building": self.building,
+            "max_waiting": self.max_waiting,
+            "waiting": self.waiting,
+            "rejected": self.rejected,  # this process only
+            "avg_build_ms": app.ms(self.avg_build_seconds),
+            "wsgi_threads": ASGI_WSGI_THREADS,
+            "builder_processes": app.PACK_WORKERS if app.PACK_WORKERS > 1 else 0,
+        }
+
+
+build_slots = BuildSlots(ASGI_MAX_BUILDS, ASGI_MAX_WAITING)
+build_executor = ThreadPoolExecutor(max_workers=ASGI_MAX_BUILDS, thread_name_prefix='asgi-build')
+wsgi_executor = ThreadPoolExecutor(max_workers=ASGI_WSGI_THREADS, thread_name_prefix='asgi-wsgi')
+
+
+# ============================================================================
+# HTTP PLUMBING
+# ============================================================================
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ConnectionResetError("Client disconnected before sending the whole body")
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return bytes(body)
+
+
+def encode_headers(headers):
+    # Same default as flask_cors.CORS(app) on the Flask side
+    headers = [('Access-Control-Allow-Origin', '*')] + list(headers)
+    return [(name.lower().encode('latin-1'), str(value).encode('latin-1')) for name, value in headers]
+
+
+async def send_response(send, status, headers=(), body=b''):
+    await send({'type': 'http.response.start', 'status': status, 'headers': encode_headers(headers)})
+    await send({'type': 'http.response.body', 'body': body})
+    return status
+
+
+async def send_json(send, status, payload, headers=()):
+    body = json.dumps(payload).encode('utf-8')
+    return await send_response(send, status, [('Content-Type', 'application/json'), *headers], body)
+
+
+def pack_headers(cache_key, cache_status, size=None):
+    headers = [('Content-Type', 'application/zip'),
+               ('Content-Disposition', f'attachment; filename={PACK_FILENAME}'),
+               ('ETag', quote_etag(cache_key, weak=True)),
+               ('X-Pack-Cache', cache_status)]
+    if size is not None:
+        headers.append(('Content-Length', size))
+    return headers
+
+
+# ============================================================================
+# NATIVE /generate-pack
+# ============================================================================
+async def generate_pack(scope, receive, send):
+    started = time.perf_counter()
+    status = 500
+    try:
+        status = await serve_pack(scope, receive, send)
+    finally:
+        if app.METRICS_ENABLED:
+            app.REQUEST_SECONDS.observe(time.perf_counter() - started, '/generate-pack', str(status))
+
+
+async def serve_pack(scope, receive, send):
+    """The Flask generate_pack() route, with every blocking step moved off the event loop."""
+    loop = asyncio.get_running_loop()
+    headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in scope['headers']}
+    query = parse_qs(scope['query_string'].decode('latin-1'))
+    try:
+        COMPANY_INFO = json.loads(await read_body(receive))
+    except ValueError:
+        return await send_json(send, 400, {"error": "Expected the company details as JSON"})
+    try:
+        doc_ids = app.parse_doc_selection(query.get('docs', [None])[0])
+    except ValueError as e:
+        return await send_json(send, 400, {"error": str(e), "available": app.DOCUMENT_IDS})
+    try:
+        app.check_document_inputs(COMPANY_INFO, doc_ids)
+    except app.InvalidField as e:
+        return await send_json(send, 400, e.to_dict())
+
+    cache_key = app.pack_cache_key(COMPANY_INFO, doc_ids)
+    if parse_etags(headers.get('if-none-match')).contains_weak(cache_key):
+        return await send_response(send, 304, [('ETag', quote_etag(cache_key, weak=True))])
+
+    # The pack cache may have to read its disk tier
+    zip_bytes = await loop.run_in_executor(wsgi_executor, app.pack_cache.get, cache_key)
+    if zip_bytes is not None:
+        return await send_response(send, 200, pack_headers(cache_key, 'hit', len(zip_bytes)), zip_bytes)
+
+    try:
+        # Same token buckets as the Flask routes (possibly in SQLite, hence the thread)
+        address = scope['client'][0] if scope.get('client') else None
+        client = app.client_key(headers.get('x-api-key'), app.proxied_address(address, headers.get('x-forwarded-for')))
+        if app.PACK_STREAMING or query.get('stream') == ['1']:
+            await loop.run_in_executor(wsgi_executor, app.charge, client, app.request_cost([COMPANY_INFO], doc_ids))
+            async with build_slots.acquire():
+                with reserve_memory([COMPANY_INFO], doc_ids):
+                    return await stream_pack(send, COMPANY_INFO, doc_ids, cache_key)
+        # Only what changed since the client's earlier pack (X-Base-Pack or If-None-Match) is built and charged
+        base_header = headers.get('x-base-pack') or headers.get('if-none-match')
+        base, to_build = await loop.run_in_executor(wsgi_executor, app.plan_rebuild, COMPANY_INFO, doc_ids, base_header)
+        await loop.run_in_executor(wsgi_executor, app.charge, client, app.request_cost([COMPANY_INFO], to_build))
+        async with build_slots.acquire():
+            with reserve_memory([COMPANY_INFO], to_build):
+                archive, rebuilt = await loop.run_in_executor(build_executor, app.build_pack_zip, COMPANY_INFO, doc_ids, base)
+            partial = len(rebuilt) < len(app.DOCUMENT_IDS if doc_ids is None else doc_ids)
+            return await send_archive(send, archive, cache_key, rebuilt if partial else None)
+    except (SlotsFull, app.RateLimited) as e:
+        return await send_json(send, getattr(e, 'status', 429), {"error": str(e), "retry_after": e.retry_after},
+                               [('Retry-After', e.retry_after)])
+    except app.DocumentBuildError as e:
+        print(f"Error building {e.filename or 'the pack'}: {e}")
+        return await send_json(send, 504 if e.timed_out else 500, e.to_dict())
+    except Exception as e:
+        print(f"Error: {e}")
+        return await send_json(send, 500, {"error": str(e)})
+
+
+def reserve_memory(companies, doc_ids):
+    """app.build_gate's memory check, without its queue: the build slots already are one."""
+    memory = app.request_memory(companies, doc_ids) if app.MEMORY_PER_DOCUMENT_MB else 0
+    return app.build_gate.admit(0, memory, wait=False)
+
+
+async def send_archive(send, archive, cache_key, rebuilt=None):
+    """Send a freshly built pack; rebuilt lists the members built when the rest came from a base pack."""
+    loop = asyncio.get_running_loop()
+    size = archive.seek(0, io.SEEK_END)
+    archive.seek(0)
+    headers = pack_headers(cache_key, 'miss' if rebuilt is None else 'partial', size)
+    if rebuilt is not None:
+        headers.append(('X-Pack-Rebuilt', ','.join(rebuilt)))
+    if not app.PACK_SPOOL_MAX_BYTES or size <= app.PACK_SPOOL_MAX_BYTES:
+        # Still in memory (a spooled file only rolls over past its max_size); cached as Flask does
+        data = archive.getvalue() if isinstance(archive, io.BytesIO) else archive.read()
+        archive.close()
+        app.pack_cache.put(cache_key, data)
+        return await send_response(send, 200, headers, data)
+
+    # Spilled to disk: too big for the memory cache, sent in chunks as Flask's send_file would
+    await send({'type': 'http.response.start', 'status': 200, 'headers': encode_headers(headers)})
+    try:
+        while chunk := await loop.run_in_executor(build_executor, archive.read, SEND_CHUNK_BYTES):
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        archive.close()
+    return 200
+
+
+async def stream_pack(send, COMPANY_INFO, doc_ids, cache_key):
+    """Send each member as its builder finishes; the build thread only ever runs one step of the generator."""
+    loop = asyncio.get_running_loop()
+    chunks = app.stream_pack_zip(COMPANY_INFO, doc_ids)
+    started = False
+    try:
+        while (chunk := await loop.run_in_executor(build_executor, next, chunks, None)) is not None:
+            if not started:
+                # Headers wait for the first document, so an early build failure still gets a proper error status
+                await send({'type': 'http.response.start', 'status': 200,
+                            'headers': encode_headers(pack_headers(cache_key, 'bypass'))})
+                started = True
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    except Exception:
+        if not started:
+            raise
+        # Cutting the stream leaves the client with an archive that has no central directory
+        return 500
+    finally:
+        with contextlib.suppress(ValueError):  # still running in a build thread after a cancellation
+            chunks.close()
+    await send({'type': 'http.response.body', 'body': b''})
+    return 200
+
+
+# ============================================================================
+# WSGI BRIDGE: everything else goes to the Flask app
+# ============================================================================
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name, value = name.decode('latin-1').upper().replace('-', '_'), value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = name if name == 'CONTENT_TYPE' else f'HTTP_{name}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+async def call_flask(scope, receive, send):
+    loop = asyncio.get_running_loop()
+    environ = wsgi_environ(scope, await read_body(receive))
+    start = {}
+
+    def start_response(status, headers, exc_info=None):
+        start['status'], start['headers'] = int(status.split(' ', 1)[0]), headers
+        return lambda data: None  # the write() callable; Flask never uses it
+
+    body = await loop.run_in_executor(wsgi_executor, app.app, environ, start_response)
+    chunks = iter(body)
+    try:
+        chunk = await loop.run_in_executor(wsgi_executor, next, chunks, None)
+        # Flask calls start_response before handing back its iterable
+        await send({'type': 'http.response.start', 'status': start['status'],
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                for name, value in start['headers']]})
+        while chunk is not None:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await loop.run_in_executor(wsgi_executor, next, chunks, None)
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(body, 'close'):
+            with contextlib.suppress(ValueError):
+                await loop.run_in_executor(wsgi_executor, body.close)
+
+
+# ============================================================================
+# APPLICATION
+# ============================================================================
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            app.start_warm_up()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            build_executor.shutdown(wait=False, cancel_futures=True)
+            wsgi_executor.shutdown(wait=False, cancel_futures=True)
+            app.reset_builder_pool()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def wants_profile(scope):
+    return any(name == b'x-profile-token' for name, _ in scope['headers'])
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif scope['type'] != 'http':
+        return
+    elif scope['path'] == '/generate-pack' and scope['method'] == 'POST' and not wants_profile(scope):
+        await generate_pack(scope, receive, send)
+    elif scope['path'] == '/asgi/limits' and scope['method'] == 'GET':
+        await send_json(send, 200, build_slots.snapshot())
+    else:
+        await call_flask(scope, receive, send)
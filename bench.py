@@ -0,0 +1,494 @@
+"""Benchmarks for the template pack backend.
+
+Usage:
+    python bench.py run [--repeat 20] [--json results.json]
+    python bench.py compare before.json after.json
+    python bench.py load [--clients 8] [--requests 10] [--url http://host:port] [--json results.json]
+    python bench.py compression [--repeat 50] [--json results.json]
+    python bench.py startup [--repeat 10] [--json results.json]
+
+'run' times every builder (object construction and save separately, or
+together for write-only workbooks and builders that save themselves, plus
+the skeleton path), ZIP assembly and the full /generate-pack request
+through the Flask test client. It reports p50/p95/p99 latency, the
+tracemalloc peak and output sizes. Save two runs with --json and diff them
+with 'compare'.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.request
+import zipfile
+from datetime import datetime
+
+import app
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SAMPLE_COMPANY_INFO = {
+    "name": "Syarikat Jentera Maju Sdn Bhd",
+    "phone": "+60 3-5566 7788",
+    "email": "admin@jenteramaju.com.my",
+    "tax_id": "W10-1808-32001234",
+    "reg_no": "201901012345 (1234567-A)",
+    "address": "No. 8, Jalan Perindustrian 3, 47100 Puchong, Selangor",
+    "bank_name": "Maybank Berhad",
+    "bank_account": "5144 2233 6789",
+    "swift_code": "MBBEMYKL",
+}
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of seconds, in milliseconds."""
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return round(ordered[rank] * 1000, 3)
+
+
+def summarize(samples):
+    return {
+        'n': len(samples),
+        'p50_ms': percentile(samples, 50),
+        'p95_ms': percentile(samples, 95),
+        'p99_ms': percentile(samples, 99),
+        'mean_ms': round(statistics.mean(samples) * 1000, 3),
+    }
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def traced_peak(fn):
+    """tracemalloc peak (bytes) of one call; run separately so tracing doesn't skew the timings."""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def save_bytes(result):
+    if isinstance(result, io.BytesIO):
+        return result.getvalue()
+    buffer = io.BytesIO()
+    result.save(buffer)
+    return buffer.getvalue()
+
+
+def print_table(title, rows):
+    print(f"\n{title}")
+    print(f"{'':<34}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak KiB':>10}{'bytes':>10}")
+    for name, row in rows.items():
+        peak = row.get('peak_bytes')
+        print(f"{name:<34}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}"
+              f"{(peak / 1024 if peak else 0):>10.0f}{row.get('bytes', ''):>10}")
+
+
+# ============================================================================
+# BUILDERS, ZIP ASSEMBLY AND THE FULL REQUEST
+# ============================================================================
+def bench_builders(repeat):
+    results = {}
+    for doc_id, filename, builder in app.PACK_DOCUMENTS:
+        built = builder(SAMPLE_COMPANY_INFO)  # warm imports and lazy caches
+        data = save_bytes(built)
+        if getattr(built, 'write_only', False) or isinstance(built, io.BytesIO):
+            # A write-only workbook streams its rows while saving and can only be saved once;
+            # builders that return bytes (cached formula values, the PDF) save as they build
+            build_save = lambda: save_bytes(builder(SAMPLE_COMPANY_INFO))
+            results[f'{doc_id}.build_save'] = dict(summarize(timed(build_save, repeat)),
+                                                   peak_bytes=traced_peak(build_save), bytes=len(data))
+        else:
+            results[f'{doc_id}.build'] = dict(
+                summarize(timed(lambda: builder(SAMPLE_COMPANY_INFO), repeat)),
+                peak_bytes=traced_peak(lambda: builder(SAMPLE_COMPANY_INFO)))
+            results[f'{doc_id}.save'] = dict(
+                summarize(timed(lambda: save_bytes(built), repeat)),
+                peak_bytes=traced_peak(lambda: save_bytes(built)), bytes=len(data))
+        if app.SKELETON_CACHE_ENABLED and app.get_skeleton(doc_id) is not None:
+            results[f'{doc_id}.skeleton'] = dict(
+                summarize(timed(lambda: app.render_from_skeleton(doc_id, SAMPLE_COMPANY_INFO), repeat)),
+                peak_bytes=traced_peak(lambda: app.render_from_skeleton(doc_id, SAMPLE_COMPANY_INFO)))
+    # user_guide.build is answered from the rendered-PDF cache after the first call
+    layout = lambda: app.layout_user_guide(SAMPLE_COMPANY_INFO['name'])
+    results['user_guide.layout'] = dict(summarize(timed(layout, repeat)), peak_bytes=traced_peak(layout))
+    return results
+
+
+def bench_xlsx_rows(repeat, rows=1000):
+    """Styled table rows: coordinate strings and per-attribute styles vs. named styles by row."""
+    from openpyxl import Workbook
+
+    def per_attribute():
+        wb = Workbook()
+        ws = wb.active
+        parts = app.xlsx_style_parts()
+        for row in range(1, rows + 1):
+            ws[f'A{row}'], ws[f'B{row}'], ws[f'C{row}'], ws[f'D{row}'] = 'Line', 5, 8500, f"=B{row}*C{row}"
+            for col in 'ABCD':
+                ws[f'{col}{row}'].border = parts['Pack Cell']['border']
+            ws[f'C{row}'].number_format = ws[f'D{row}'].number_format = '#,##0.00'
+
+    def named_styles():
+        wb = Workbook()
+        ws = wb.active
+        app.add_xlsx_styles(wb, 'Pack Cell', 'Pack Amount Cell')
+        styles = ['Pack Cell', 'Pack Cell', 'Pack Amount Cell', 'Pack Amount Cell']
+        for row in range(1, rows + 1):
+            app.write_xlsx_row(ws, row, ['Line', 5, 8500, f"=B{row}*C{row}"], styles)
+
+    return {f'xlsx.rows_{rows}.per_attribute': summarize(timed(per_attribute, repeat)),
+            f'xlsx.rows_{rows}.named_styles': summarize(timed(named_styles, repeat))}
+
+
+def bench_service_log_rows(repeat, sizes=(1000, 10000)):
+    """Write-only service log fed from a generator: time grows with rows, peak memory should not."""
+    results = {}
+    for rows in sizes:
+        def build():
+            entries = ({'equipment_id': f'EQ-{i:05d}', 'location': 'Yard', 'date': '2025-01-15', 'hour_meter': 1200 + i,
+                        'service_type': 'Routine', 'description': '500-hour service, oil change', 'parts_used': 'Oil, Filters',
+                        'labour_cost': 500, 'parts_cost': 850, 'next_service_due': '2025-02-15'} for i in range(rows))
+            return app.render_full_document('service_log', dict(SAMPLE_COMPANY_INFO, service_log=entries))
+
+        results[f'service_log.rows_{rows}'] = dict(summarize(timed(build, repeat)), peak_bytes=traced_peak(build),
+                                                   bytes=len(build()))
+    return results
+
+
+def bench_line_items(repeat, sizes=(10, 1000, 10000)):
+    """Invoice with N line items: rows, totals and the cached formula results."""
+    results = {}
+    for lines in sizes:
+        info = dict(SAMPLE_COMPANY_INFO, line_items=[
+            {'description': f'Excavator rental, day {i + 1}', 'quantity': 1 + i % 5, 'unit_price': 850 + i % 13}
+            for i in range(lines)])
+        build = lambda: app.render_full_document('invoice', info)
+        results[f'invoice.lines_{lines}'] = dict(summarize(timed(build, repeat if lines < 10000 else max(1, repeat // 10))),
+                                                 peak_bytes=traced_peak(build), bytes=len(build()))
+    return results
+
+
+def bench_equipment_schedule(repeat, sizes=(10, 1000, 5000)):
+    """Rental agreement with an N-row equipment schedule (bulk DOCX table writer)."""
+    results = {}
+    for rows in sizes:
+        info = dict(SAMPLE_COMPANY_INFO, equipment=[
+            {'equipment_id': f'EQ-{i:05d}', 'description': 'Hydraulic Excavator', 'make_model': 'Caterpillar 320',
+             'condition': 'Good, 1,200 hrs', 'replacement_value': 450000} for i in range(rows)])
+        build = lambda: app.render_full_document('rental_agreement', info)
+        results[f'rental_agreement.equipment_{rows}'] = dict(summarize(timed(build, repeat)), peak_bytes=traced_peak(build),
+                                                             bytes=len(build()))
+    return results
+
+
+def bench_docx_template(repeat):
+    """Blank DOCX: parsing the bundled default.docx every time vs. cloning the per-process template."""
+    from docx import Document
+    app.docx_template()
+    return {'docx.new.parse_default': dict(summarize(timed(Document, repeat)), peak_bytes=traced_peak(Document)),
+            'docx.new.template_clone': dict(summarize(timed(app.new_docx, repeat)), peak_bytes=traced_peak(app.new_docx))}
+
+
+def bench_incremental(repeat):
+    """Follow-up pack after a bank_account edit: everything rebuilt vs. unchanged members spliced from the base."""
+    base, _ = app.build_pack_zip(SAMPLE_COMPANY_INFO)
+    base = base.getvalue()
+    edited = dict(SAMPLE_COMPANY_INFO, bank_account='5144 9999 0000')
+    full = lambda: app.build_pack_zip(edited)
+    spliced = lambda: app.build_pack_zip(edited, base=base)
+    return {'pack.bank_edit.full': summarize(timed(full, repeat)),
+            'pack.bank_edit.spliced': dict(summarize(timed(spliced, repeat)), rebuilt=len(spliced()[1]))}
+
+
+def bench_zip(repeat):
+    documents = app.build_documents(SAMPLE_COMPANY_INFO)
+
+    def assemble():
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as zf:
+            for filename, data in documents.items():
+                app.write_member(zf, filename, data)
+        return buffer
+
+    return {'zip.assemble': dict(summarize(timed(assemble, repeat)), peak_bytes=traced_peak(assemble),
+                                 bytes=len(assemble().getvalue()))}
+
+
+def bench_request(repeat):
+    # A fresh, memory-only cache with no room means every request really builds the pack
+    app.pack_cache = app.PackCache(0, 0)
+    client = app.app.test_client()
+
+    def request():
+        response = client.post('/generate-pack', json=SAMPLE_COMPANY_INFO)
+        assert response.status_code == 200, response.data[:200]
+        return response.data
+
+    size = len(request())
+    return {'request.generate_pack': dict(summarize(timed(request, repeat)), peak_bytes=traced_peak(request), bytes=size)}
+
+
+def run(repeat):
+    results = {}
+    results.update(bench_builders(repeat))
+    results.update(bench_xlsx_rows(max(3, repeat // 4)))
+    results.update(bench_service_log_rows(max(1, repeat // 10)))
+    results.update(bench_line_items(max(1, repeat // 4)))
+    results.update(bench_equipment_schedule(max(1, repeat // 4)))
+    results.update(bench_docx_template(repeat))
+    results.update(bench_incremental(max(3, repeat // 4)))
+    results.update(bench_zip(repeat))
+    results.update(bench_request(repeat))
+    print_table(f"repeat={repeat}, PACK_WORKERS={app.PACK_WORKERS}", results)
+    return results
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)['results']
+    with open(after_path) as f:
+        after = json.load(f)['results']
+    print(f"{'':<34}{'before p50':>12}{'after p50':>12}{'change':>9}")
+    for name in before:
+        if name not in after or 'p50_ms' not in before[name]:
+            continue
+        old, new = before[name]['p50_ms'], after[name]['p50_ms']
+        change = (new - old) / old * 100 if old else 0.0
+        print(f"{name:<34}{old:>12.2f}{new:>12.2f}{change:>+8.1f}%")
+    for name in sorted(set(after) - set(before)):
+        print(f"{name:<34}{'-':>12}{after[name].get('p50_ms', 0):>12.2f}{'new':>9}")
+
+
+# ============================================================================
+# LOAD: N concurrent clients against the app (in-process or a live URL)
+# ============================================================================
+def load(clients, requests_per_client, url=None):
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def client_loop(client_index):
+        test_client = None if url else app.app.test_client()
+        for i in range(requests_per_client):
+            # Vary the name so the pack cache doesn't answer every request
+            payload = dict(SAMPLE_COMPANY_INFO, name=f"{SAMPLE_COMPANY_INFO['name']} {client_index}-{i}")
+            started = time.perf_counter()
+            try:
+                if url:
+                    req = urllib.request.Request(f"{url.rstrip('/')}/generate-pack", data=json.dumps(payload).encode(),
+                                                 headers={'Content-Type': 'application/json'})
+                    with urllib.request.urlopen(req, timeout=300) as response:
+                        response.read()
+                else:
+                    response = test_client.post('/generate-pack', json=payload)
+                    if response.status_code != 200:
+                        raise RuntimeError(f"HTTP {response.status_code}")
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client_loop, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    result = dict(summarize(latencies) if latencies else {'n': 0}, clients=clients, errors=len(errors),
+                  elapsed_s=round(elapsed, 3), throughput_rps=round(len(latencies) / elapsed, 2),
+                  target=url or 'in-process')
+    print(f"\n{clients} clients x {requests_per_client} requests against {result['target']}")
+    for key, value in result.items():
+        print(f"  {key:<16}{value}")
+    if errors:
+        print(f"  first error: {errors[0]}")
+    return {'load.generate_pack': result}
+
+
+# ============================================================================
+# ZIP COMPRESSION: CPU time vs. output size for the current pack
+# ============================================================================
+COMPRESSION_CONFIGS = [
+    # (label, PACK_COMPRESSION mode, level)
+    ('deflate-6 (old)', 'deflate', 6),
+    ('deflate-1', 'deflate', 1),
+    ('deflate-9', 'deflate', 9),
+    ('stored', 'stored', None),
+    ('policy', 'policy', 6),
+    ('adaptive', 'adaptive', 6),
+]
+
+
+def bench_compression(repeat):
+    documents = app.build_documents(SAMPLE_COMPANY_INFO)
+    results = {}
+    for label, mode, level in COMPRESSION_CONFIGS:
+        app._measured_methods.clear()  # adaptive mode measures on its first pack
+        cpu_times = []
+        for _ in range(repeat):
+            buffer = io.BytesIO()
+            started = time.process_time()
+            with zipfile.ZipFile(buffer, 'w') as zf:
+                for filename, data in documents.items():
+                    app.write_member(zf, filename, data, mode, level)
+            cpu_times.append(time.process_time() - started)
+        results[f'compression.{label}'] = {
+            'cpu_ms_median': round(statistics.median(cpu_times) * 1000, 3),
+            'zip_bytes': len(buffer.getvalue()),
+            'input_bytes': sum(len(data) for data in documents.values()),
+        }
+
+    print(f"{'config':<30}{'cpu ms':>10}{'zip bytes':>12}")
+    for name, row in results.items():
+        print(f"{name:<30}{row['cpu_ms_median']:>10.3f}{row['zip_bytes']:>12}")
+    return results
+
+
+# ============================================================================
+# STARTUP: fresh interpreters, so nothing is already imported or cached
+# ============================================================================
+# Serve the app on an ephemeral port and print the port once it is listening
+SERVE_SNIPPET = """
+import app
+from werkzeug.serving import make_server
+server = make_server('127.0.0.1', 0, app.app)
+print(server.port, flush=True)
+server.serve_forever()
+"""
+# Libraries the builders import lazily, timed the same way for reference
+FORMAT_LIBRARIES = {'docx': 'docx', 'xlsx': 'openpyxl', 'pdf': 'reportlab.platypus'}
+
+
+def import_times(module):
+    """(cumulative microseconds of module, {direct child import: cumulative us}) from -X importtime."""
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=HERE, capture_output=True, text=True, check=True).stderr
+    total, children = 0, {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        if name.strip() == module and depth == 0:
+            total = int(cumulative)
+        elif depth == 1:
+            children[name.strip()] = int(cumulative)
+    return total, children
+
+
+def time_to_listening():
+    """Seconds from spawning the interpreter to the first successful /healthz."""
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', SERVE_SNIPPET], cwd=HERE, stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL, text=True)
+    try:
+        port = int(process.stdout.readline())
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/healthz', timeout=30) as response:
+            response.read()
+        return time.perf_counter() - started
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def bench_startup(repeat):
+    app_samples, children = [], {}
+    for _ in range(repeat):
+        total, direct = import_times('app')
+        app_samples.append(total / 1e6)
+        for name, cumulative in direct.items():
+            children.setdefault(name, []).append(cumulative / 1e6)
+
+    results = {
+        'startup.time_to_listening': summarize([time_to_listening() for _ in range(repeat)]),
+        'startup.import.app': summarize(app_samples),
+    }
+    heaviest = sorted(children, key=lambda name: statistics.median(children[name]), reverse=True)[:8]
+    for name in heaviest:
+        results[f'startup.import.app/{name}'] = summarize(children[name])
+    for fmt, module in FORMAT_LIBRARIES.items():
+        results[f'startup.import.{fmt}:{module}'] = summarize([import_times(module)[0] / 1e6 for _ in range(repeat)])
+    results['startup.loaded_at_import'] = {'modules': subprocess.run(
+        [sys.executable, '-c', 'import sys, app; print(" ".join(m for m in %r if m in sys.modules))'
+         % sorted(FORMAT_LIBRARIES.values())],
+        cwd=HERE, capture_output=True, text=True, check=True).stdout.split()}
+
+    print_table(f"startup, repeat={repeat} (fresh interpreter each time)",
+                {name: row for name, row in results.items() if 'p50_ms' in row})
+    print(f"\ngenerator libraries loaded by 'import app': {results['startup.loaded_at_import']['modules'] or 'none'}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='builders, save, ZIP assembly and the full request')
+    run_parser.add_argument('--repeat', type=int, default=20)
+    run_parser.add_argument('--json', help='write results to this file')
+
+    compare_parser = subparsers.add_parser('compare', help='diff two --json result files')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+
+    load_parser = subparsers.add_parser('load', help='concurrent clients against /generate-pack')
+    load_parser.add_argument('--clients', type=int, default=8)
+    load_parser.add_argument('--requests', type=int, default=10, help='requests per client')
+    load_parser.add_argument('--url', help='base URL of a running server (default: in-process test client)')
+    load_parser.add_argument('--json', help='write results to this file')
+
+    compression = subparsers.add_parser('compression', help='ZIP assembly CPU time vs. size per compression mode')
+    compression.add_argument('--repeat', type=int, default=50)
+    compression.add_argument('--json', help='write results to this file')
+
+    startup = subparsers.add_parser('startup', help='import time and time-to-listening in fresh interpreters')
+    startup.add_argument('--repeat', type=int, default=10)
+    startup.add_argument('--json', help='write results to this file')
+
+    args = parser.parse_args()
+    if args.command == 'compare':
+        compare(args.before, args.after)
+        return
+    if args.command == 'run':
+        results = run(args.repeat)
+    elif args.command == 'load':
+        results = load(args.clients, args.requests, args.url)
+    elif args.command == 'compression':
+        results = bench_compression(args.repeat)
+    elif args.command == 'startup':
+        results = bench_startup(args.repeat)
+
+    if args.json:
+        meta = {
+            'command': args.command,
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'pack_workers': app.PACK_WORKERS,
+            'skeleton_cache': app.SKELETON_CACHE_ENABLED,
+        }
+        with open(args.json, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
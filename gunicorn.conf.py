@@ -0,0 +1,46 @@
+"""gunicorn settings for the template pack backend.
+
+    gunicorn -c gunicorn.conf.py app:app
+
+Each worker warms itself after forking (see app.warm_up) and answers /readyz
+with 503 until that is done. With GUNICORN_PRELOAD=1 the master imports the
+app and builds every document once before forking, so workers inherit the
+loaded modules and template caches and only have to start their builder pool.
+
+Workers grow as lxml/openpyxl/reportlab leave fragmented heaps behind. With
+GUNICORN_MAX_RSS_MB set, a worker whose RSS is above it after a request
+finishes that request and is replaced (its builder pool goes with it);
+GUNICORN_MAX_REQUESTS is the blunter, count-based fallback.
+"""
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', '2'))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '0') == '1'
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', '0'))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', str(max_requests // 10)))
+max_rss_mb = float(os.environ.get('GUNICORN_MAX_RSS_MB', '0'))
+
+
+def when_ready(server):
+    if preload_app:
+        # Only in-process work here: the builder pool and its processes must
+        # be created after the fork, in each worker.
+        import app
+        app.warm_builders()
+
+
+def post_fork(server, worker):
+    import app
+    app.start_warm_up()
+
+
+def post_request(worker, req, environ, resp):
+    if not max_rss_mb:
+        return
+    import app
+    rss = app.current_rss()
+    if rss is not None and rss > max_rss_mb * 1024 * 1024:
+        worker.log.info("Worker %s at %.0f MiB RSS (limit %g); recycling", worker.pid, rss / 1024 / 1024, max_rss_mb)
+        worker.alive = False  # finish this request, then exit; the arbiter starts a fresh worker
@@ -0,0 +1,163 @@
+import threading
+import time
+
+import pytest
+
+import app
+
+COMPANY_INFO = {
+    "name": "Syarikat Jentera Maju Sdn Bhd",
+    "phone": "+60 3-5566 7788",
+    "email": "admin@jenteramaju.com.my",
+    "tax_id": "W10-1808-32001234",
+    "reg_no": "201901012345 (1234567-A)",
+    "address": "No. 8, Jalan Perindustrian 3, 47100 Puchong, Selangor",
+    "bank_name": "Maybank Berhad",
+    "bank_account": "5144 2233 6789",
+    "swift_code": "MBBEMYKL",
+}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(app.time, 'time', clock)
+    return clock
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def buckets(request, tmp_path):
+    return app.TokenBuckets(None if request.param == 'memory' else str(tmp_path / 'buckets.sqlite3'))
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app, 'PACK_WORKERS', 1)
+    monkeypatch.setattr(app, 'pack_cache', app.PackCache(16, 64 * 1024 * 1024))
+    monkeypatch.setattr(app, 'rate_buckets', app.TokenBuckets())
+    monkeypatch.setattr(app, 'build_gate', app.BuildGate(20, 8, 10))
+    return app.app.test_client()
+
+
+def company(i):
+    return dict(COMPANY_INFO, name=f"Syarikat {i} Sdn Bhd")
+
+
+def test_bucket_refills_at_its_rate(buckets, clock):
+    limits = [('a', 1.0, 5.0)]
+    assert buckets.take(3, limits) == 0
+    assert buckets.take(3, limits) == pytest.approx(1.0)  # 2 left, 1 short at 1/s
+    clock.now += 1
+    assert buckets.take(3, limits) == 0
+    clock.now += 100
+    assert buckets.take(5, limits) == 0  # refilled, but never past the burst
+    assert buckets.take(1, limits) == pytest.approx(1.0)
+    assert buckets.limited == 2
+
+
+def test_oversize_cost_leaves_bucket_in_debt(buckets, clock):
+    limits = [('a', 1.0, 5.0)]
+    assert buckets.take(12, limits) == 0  # a full bucket lets a batch bigger than the burst through
+    assert buckets.take(1, limits) == pytest.approx(8.0)  # -7 tokens: 8s until 1 is back
+    clock.now += 8
+    assert buckets.take(1, limits) == 0
+
+
+def test_charge_is_all_or_nothing(buckets, clock):
+    assert buckets.take(4, [('b', 1.0, 4.0)]) == 0
+    assert buckets.take(2, [('a', 1.0, 5.0), ('b', 1.0, 4.0)]) == pytest.approx(2.0)
+    assert buckets.take(5, [('a', 1.0, 5.0)]) == 0  # 'a' wasn't charged for the refused take
+
+
+def test_unknown_api_keys_share_the_address_bucket(monkeypatch, client):
+    monkeypatch.setattr(app, 'RATE_LIMIT_KEY_RATE', 0.001)
+    monkeypatch.setattr(app, 'RATE_LIMIT_KEY_BURST', 1)
+    monkeypatch.setattr(app, 'KNOWN_API_KEYS', frozenset({app.api_key_digest('issued-key')}))
+
+    first = client.post('/generate-pack?docs=invoice', json=company(1), headers={'X-API-Key': 'made-up-1'})
+    assert first.status_code == 200
+    second = client.post('/generate-pack?docs=invoice', json=company(2), headers={'X-API-Key': 'made-up-2'})
+    assert second.status_code == 429 and int(second.headers['Retry-After']) >= 1
+    assert client.post('/generate-pack?docs=invoice', json=company(3)).status_code == 429
+    # An issued key has a bucket of its own
+    issued = client.post('/generate-pack?docs=invoice', json=company(4), headers={'X-API-Key': 'issued-key'})
+    assert issued.status_code == 200
+
+
+def test_client_key():
+    assert app.client_key(None, '10.0.0.1') == 'addr:10.0.0.1'
+    assert app.client_key('nobody-issued-this', '10.0.0.1') == 'addr:10.0.0.1'
+
+
+def test_request_cost_counts_rows():
+    assert app.request_cost([COMPANY_INFO]) == len(app.DOCUMENT_IDS)
+    assert app.request_cost([COMPANY_INFO, COMPANY_INFO], ['invoice']) == 2
+    items = [{"description": "Excavator", "quantity": 1, "unit_price": 100}] * 250
+    assert app.request_cost([dict(COMPANY_INFO, line_items=items)], ['invoice', 'quotation']) == \
+        2 + 500 / app.ADMISSION_ROWS_PER_COST
+    assert app.request_cost([dict(COMPANY_INFO, line_items=items)], ['rental_agreement']) == 1
+
+
+def test_queued_request_gets_429_after_max_wait(monkeypatch, client):
+    gate = app.BuildGate(1, 8, 0.2)
+    monkeypatch.setattr(app, 'build_gate', gate)
+    with gate.admit(1):
+        started = time.monotonic()
+        response = client.post('/generate-pack?docs=invoice', json=COMPANY_INFO)
+        assert time.monotonic() - started >= 0.2
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
+    assert gate.rejected == 1 and gate.waiting == 0 and gate.inflight == 0
+
+
+def test_full_wait_queue_refuses_at_once():
+    gate = app.BuildGate(1, 0, 10)
+    with gate.admit(1):
+        started = time.monotonic()
+        with pytest.raises(app.RateLimited):
+            with gate.admit(1):
+                pass
+        assert time.monotonic() - started < 1
+
+
+def test_oversize_request_waits_for_an_empty_gate():
+    gate = app.BuildGate(2, 8, 5)
+    with gate.admit(5):  # bigger than the capacity, but nothing else is in flight
+        assert gate.inflight == 5
+
+    admitted = threading.Event()
+
+    def oversize():
+        with gate.admit(5):
+            admitted.set()
+
+    with gate.admit(1):
+        worker = threading.Thread(target=oversize)
+        worker.start()
+        assert not admitted.wait(0.2)
+        assert gate.waiting == 1
+    assert admitted.wait(5)
+    worker.join()
+    assert gate.inflight == 0
+
+
+def test_cache_hits_and_304s_are_not_charged(monkeypatch, client):
+    charged = []
+    monkeypatch.setattr(app, 'charge', lambda client, cost: charged.append(cost))
+
+    first = client.post('/generate-pack?docs=invoice', json=COMPANY_INFO)
+    assert first.headers['X-Pack-Cache'] == 'miss' and charged == [1]
+    assert client.post('/generate-pack?docs=invoice', json=COMPANY_INFO).headers['X-Pack-Cache'] == 'hit'
+    assert client.post('/generate-pack?docs=invoice', json=COMPANY_INFO,
+                       headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+    assert client.post('/generate/invoice', json=COMPANY_INFO).status_code == 200
+    assert client.post('/generate/invoice', json=COMPANY_INFO).status_code == 200
+    assert charged == [1, 1]
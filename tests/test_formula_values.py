@@ -0,0 +1,67 @@
+import io
+
+import pytest
+from openpyxl import load_workbook
+
+import app
+
+COMPANY_INFO = {
+    "name": "Syarikat Jentera Maju Sdn Bhd",
+    "phone": "+60 3-5566 7788",
+    "email": "admin@jenteramaju.com.my",
+    "tax_id": "W10-1808-32001234",
+    "reg_no": "201901012345 (1234567-A)",
+    "address": "No. 8, Jalan Perindustrian 3, 47100 Puchong, Selangor",
+    "bank_name": "Maybank Berhad",
+    "bank_account": "5144 2233 6789",
+    "swift_code": "MBBEMYKL",
+    "line_items": [
+        {"description": "Hydraulic Excavator", "quantity": 5, "unit_price": 8500},
+        {"description": "Operator Service", "quantity": 2.5, "unit_price": 1999.99},
+        ["Delivery & Pickup", 1, 1500],
+    ],
+}
+
+# doc_id -> first line item row
+TABLES = {'invoice': 15, 'quotation': 14}
+
+
+def load(doc_id, data_only):
+    data = app.render_full_document(doc_id, COMPANY_INFO)
+    return load_workbook(io.BytesIO(data), data_only=data_only).active
+
+
+@pytest.mark.parametrize('doc_id', TABLES)
+def test_cached_values_match_line_items(doc_id):
+    values, formulas = load(doc_id, data_only=True), load(doc_id, data_only=False)
+    start_row = TABLES[doc_id]
+    items = COMPANY_INFO['line_items']
+
+    for row, item in enumerate(items, start_row):
+        quantity, unit_price = (item['quantity'], item['unit_price']) if isinstance(item, dict) else item[1:]
+        assert formulas[f'D{row}'].value == f'=B{row}*C{row}'
+        assert values[f'D{row}'].value == pytest.approx(quantity * unit_price)
+
+    subtotal_row = start_row + len(items) + 1
+    subtotal = sum(values[f'D{row}'].value for row in range(start_row, start_row + len(items)))
+    assert formulas[f'D{subtotal_row}'].value == f'=SUM(D{start_row}:D{start_row + len(items) - 1})'
+    assert values[f'D{subtotal_row}'].value == pytest.approx(subtotal)
+    assert values[f'D{subtotal_row + 1}'].value == pytest.approx(subtotal * 0.06)
+    assert values[f'D{subtotal_row + 2}'].value == pytest.approx(subtotal * 1.06)
+
+
+def test_quotation_durations_show_as_days():
+    sheet = load('quotation', data_only=True)
+    cell = sheet[f'B{TABLES["quotation"]}']
+    assert cell.value == 5 and cell.number_format == 'General" days"'
+
+
+@pytest.mark.parametrize('cell', [
+    b'<c r="D15" s="3"><f>B15*C15</f><v></v></c>',
+    b'<c r="D15" s="3"><f>B15*C15</f><v/></c>',
+    b'<c s="3" r="D15"><f>B15*C15</f></c>',
+])
+def test_formula_cell_spellings(cell):
+    match = app.FORMULA_CELL_PATTERN.fullmatch(cell)
+    assert match is not None
+    assert app.CELL_REFERENCE_PATTERN.search(match.group(1)).group(1) == b'D15'
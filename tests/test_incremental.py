@@ -0,0 +1,68 @@
+import io
+import zipfile
+
+import pytest
+
+import app
+
+COMPANY_INFO = {
+    "name": "Syarikat Jentera Maju Sdn Bhd",
+    "phone": "+60 3-5566 7788",
+    "email": "admin@jenteramaju.com.my",
+    "tax_id": "W10-1808-32001234",
+    "reg_no": "201901012345 (1234567-A)",
+    "address": "No. 8, Jalan Perindustrian 3, 47100 Puchong, Selangor",
+    "bank_name": "Maybank Berhad",
+    "bank_account": "5144 2233 6789",
+    "swift_code": "MBBEMYKL",
+}
+
+
+@pytest.fixture(autouse=True)
+def build_inline(monkeypatch):
+    monkeypatch.setattr(app, 'PACK_WORKERS', 1)
+
+
+def build(COMPANY_INFO, base=None):
+    archive, built = app.build_pack_zip(COMPANY_INFO, base=base)
+    return archive.read(), built
+
+
+def member_contents(zf, name):
+    """What a member holds, with the DOCX/XLSX save timestamps blanked out."""
+    data = zf.read(name)
+    return app.archive_members(data) if name.endswith(('.docx', '.xlsx')) else data
+
+
+def test_partial_rebuild_round_trips():
+    base, _ = build(COMPANY_INFO)
+    edited = dict(COMPANY_INFO, bank_account="1111 2222 3333")
+
+    partial, rebuilt = build(edited, base=base)
+    fresh, _ = build(edited)
+
+    assert rebuilt and set(rebuilt) < set(app.DOCUMENT_IDS)
+    with zipfile.ZipFile(io.BytesIO(partial)) as spliced, \
+            zipfile.ZipFile(io.BytesIO(base)) as previous, \
+            zipfile.ZipFile(io.BytesIO(fresh)) as full:
+        assert spliced.testzip() is None
+        assert spliced.namelist() == full.namelist()
+
+        rebuilt_names = {app.DOCUMENT_BUILDERS[doc_id][0] for doc_id in rebuilt}
+        for info in spliced.infolist():
+            if info.filename not in rebuilt_names:
+                # Copied members keep the base pack's bytes, CRC and timestamp
+                copied = previous.getinfo(info.filename)
+                assert (info.CRC, info.compress_size, info.date_time) == \
+                       (copied.CRC, copied.compress_size, copied.date_time)
+                assert spliced.read(info.filename) == previous.read(info.filename)
+            assert member_contents(spliced, info.filename) == member_contents(full, info.filename)
+
+
+def test_unchanged_request_reuses_every_member():
+    base, _ = build(COMPANY_INFO)
+    partial, rebuilt = build(COMPANY_INFO, base=base)
+
+    assert rebuilt == []
+    with zipfile.ZipFile(io.BytesIO(partial)) as spliced:
+        assert spliced.testzip() is None
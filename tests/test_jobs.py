@@ -0,0 +1,147 @@
+import io
+import os
+import sqlite3
+import threading
+import time
+import zipfile
+
+import pytest
+
+import app
+
+COMPANY_INFO = {
+    "name": "Syarikat Jentera Maju Sdn Bhd",
+    "phone": "+60 3-5566 7788",
+    "email": "admin@jenteramaju.com.my",
+    "tax_id": "W10-1808-32001234",
+    "reg_no": "201901012345 (1234567-A)",
+    "address": "No. 8, Jalan Perindustrian 3, 47100 Puchong, Selangor",
+    "bank_name": "Maybank Berhad",
+    "bank_account": "5144 2233 6789",
+    "swift_code": "MBBEMYKL",
+}
+
+
+def make_queue(monkeypatch, tmp_path, max_queued=10, result_ttl=3600, timeout=600):
+    """A JobQueue on its own database whose workers the test drives by hand."""
+    queue = app.JobQueue(str(tmp_path / 'jobs.sqlite3'), 1, max_queued, result_ttl, timeout)
+    queue._started_pid = os.getpid()  # no background worker threads
+    monkeypatch.setattr(app, 'job_queue', queue)
+    monkeypatch.setattr(app, 'PACK_WORKERS', 1)
+    return queue
+
+
+def work_one(queue):
+    claimed = queue._next()
+    assert claimed is not None
+    queue._run(*claimed)
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+def submit(client, docs='invoice'):
+    response = client.post(f'/jobs?docs={docs}', json=COMPANY_INFO)
+    assert response.status_code == 202
+    return response.json['job_id']
+
+
+def test_job_runs_to_done(monkeypatch, tmp_path, client):
+    queue = make_queue(monkeypatch, tmp_path)
+    job_id = submit(client)
+    job = client.get(f'/jobs/{job_id}').json
+    assert (job['status'], job['position']) == ('queued', 1)
+    assert client.get(f'/jobs/{job_id}/result').status_code == 409
+
+    job, admission = queue._next()
+    assert client.get(f'/jobs/{job_id}').json['status'] == 'running'
+    queue._run(job, admission)
+
+    job = client.get(f'/jobs/{job_id}').json
+    assert job['status'] == 'done' and job['size'] > 0 and job['run_ms'] >= 0
+    result = client.get(f'/jobs/{job_id}/result')
+    assert result.status_code == 200
+    assert zipfile.ZipFile(io.BytesIO(result.data)).namelist() == ['03_Professional_Invoice.xlsx']
+    assert app.build_gate.inflight == 0
+
+
+def test_failed_build_fails_the_job(monkeypatch, tmp_path, client):
+    queue = make_queue(monkeypatch, tmp_path)
+
+    def broken(COMPANY_INFO, doc_ids=None, base=None):
+        raise app.DocumentBuildError('invoice', "boom")
+    monkeypatch.setattr(app, 'build_pack_zip', broken)
+    job_id = submit(client)
+    work_one(queue)
+
+    job = client.get(f'/jobs/{job_id}').json
+    assert job['status'] == 'failed' and job['error']['document'] == 'invoice'
+    assert client.get(f'/jobs/{job_id}/result').status_code == 500
+
+
+def test_full_queue_answers_429(monkeypatch, tmp_path, client):
+    make_queue(monkeypatch, tmp_path, max_queued=2)
+    submit(client)
+    submit(client)
+    response = client.post('/jobs', json=COMPANY_INFO)
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+    assert client.get('/jobs/stats').json['rejected'] == 1
+
+
+def test_result_expires(monkeypatch, tmp_path, client):
+    queue = make_queue(monkeypatch, tmp_path, result_ttl=0.05)
+    job_id = submit(client)
+    work_one(queue)
+    assert client.get(f'/jobs/{job_id}').json['status'] == 'done'
+    time.sleep(0.1)
+    assert client.get(f'/jobs/{job_id}').json['status'] == 'expired'
+    assert client.get(f'/jobs/{job_id}/result').status_code == 410
+
+
+def test_timed_out_job_stays_failed(monkeypatch, tmp_path, client):
+    queue = make_queue(monkeypatch, tmp_path, timeout=0.05)
+    job_id = submit(client)
+    job, admission = queue._next()
+    time.sleep(0.1)
+    queue._sweep()
+    assert client.get(f'/jobs/{job_id}').json['status'] == 'failed'
+
+    queue._run(job, admission)  # the worker finishes late
+    job = client.get(f'/jobs/{job_id}').json
+    assert job['status'] == 'failed' and 'timed out' in job['error']['error']
+    assert client.get(f'/jobs/{job_id}/result').status_code == 500
+
+
+def test_busy_database_does_not_fail_polls(monkeypatch, tmp_path, client):
+    queue = make_queue(monkeypatch, tmp_path)
+    job_id = submit(client)
+
+    def locked():
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(queue, '_sweep', locked)
+    assert client.get(f'/jobs/{job_id}').json['status'] == 'queued'
+    assert client.get('/jobs/stats').status_code == 200
+
+
+def test_gate_wait_is_not_run_time(monkeypatch, tmp_path, client):
+    queue = make_queue(monkeypatch, tmp_path, timeout=0.2)
+    gate = app.BuildGate(1, 8, 0.05)
+    monkeypatch.setattr(app, 'build_gate', gate)
+    job_id = submit(client)
+
+    claimed = []
+    with gate.admit(1):
+        worker = threading.Thread(target=lambda: claimed.append(queue._next()))
+        worker.start()
+        time.sleep(0.3)  # past the job timeout, but the job is still waiting for the gate
+        queue._sweep()
+        assert client.get(f'/jobs/{job_id}').json['status'] == 'queued'
+    worker.join(timeout=5)
+
+    queue._run(*claimed[0])
+    job = client.get(f'/jobs/{job_id}').json
+    assert job['status'] == 'done'
+    assert job['wait_ms'] >= 300
@@ -0,0 +1,132 @@
+import os
+import time
+from datetime import datetime
+
+import pytest
+
+import app
+
+COMPANY_INFO = {
+    "name": "Syarikat Jentera Maju Sdn Bhd",
+    "phone": "+60 3-5566 7788",
+    "email": "admin@jenteramaju.com.my",
+    "tax_id": "W10-1808-32001234",
+    "reg_no": "201901012345 (1234567-A)",
+    "address": "No. 8, Jalan Perindustrian 3, 47100 Puchong, Selangor",
+    "bank_name": "Maybank Berhad",
+    "bank_account": "5144 2233 6789",
+    "swift_code": "MBBEMYKL",
+}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app, 'PACK_WORKERS', 1)
+    monkeypatch.setattr(app, 'pack_cache', app.PackCache(16, 64 * 1024 * 1024))
+    return app.app.test_client()
+
+
+@pytest.fixture
+def no_builds(monkeypatch):
+    def refuse(*args, **kwargs):
+        raise AssertionError("nothing should be built")
+    monkeypatch.setattr(app, 'render_document', refuse)
+    monkeypatch.setattr(app, 'build_documents', refuse)
+
+
+def test_memory_tier_evicts_least_recently_used():
+    cache = app.PackCache(2, 1024)
+    cache.put('a', b'1')
+    cache.put('b', b'2')
+    assert cache.get('a') == b'1'  # 'b' is now the oldest
+    cache.put('c', b'3')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1' and cache.get('c') == b'3'
+    assert cache.snapshot()['evictions'] == 1
+
+
+def test_memory_tier_evicts_to_fit_bytes():
+    cache = app.PackCache(10, 10)
+    cache.put('a', b'x' * 6)
+    cache.put('b', b'y' * 6)
+    assert cache.get('a') is None and cache.get('b') == b'y' * 6
+    cache.put('big', b'z' * 11)  # larger than the whole budget: not kept in memory
+    assert cache.snapshot()['bytes'] == 6
+
+
+def test_disk_tier_expires_after_ttl(tmp_path):
+    cache = app.PackCache(0, 0, str(tmp_path), ttl=60)
+    cache.put('fresh', b'1')
+    cache.put('stale', b'2')
+    old = time.time() - 120
+    os.utime(tmp_path / 'stale.zip', (old, old))
+    assert cache.get('fresh') == b'1'
+    assert cache.get('stale') is None
+    assert not (tmp_path / 'stale.zip').exists()
+    assert cache.snapshot()['disk_evictions'] == 1
+
+
+def test_disk_tier_refills_memory(tmp_path):
+    app.PackCache(0, 0, str(tmp_path)).put('k', b'data')
+    cache = app.PackCache(4, 1024, str(tmp_path))
+    assert cache.get('k') == b'data'
+    assert cache.get('k') == b'data'
+    assert (cache.stats['disk_hits'], cache.stats['hits']) == (1, 1)
+
+
+def test_key_changes_with_selection_and_day():
+    key = app.pack_cache_key(COMPANY_INFO)
+    assert app.pack_cache_key(COMPANY_INFO) == key
+    assert app.pack_cache_key(dict(reversed(COMPANY_INFO.items()))) == key
+    assert app.pack_cache_key(COMPANY_INFO, ['invoice']) != key
+    assert app.pack_cache_key(COMPANY_INFO, ['invoice']) != app.pack_cache_key(COMPANY_INFO, ['quotation'])
+    assert app.pack_cache_key(COMPANY_INFO, ['invoice']) != app.pack_cache_key(COMPANY_INFO, ['invoice'], kind='file')
+    with app.pinned_clock(datetime(2030, 1, 1, 9)):
+        new_year = app.pack_cache_key(COMPANY_INFO)
+    with app.pinned_clock(datetime(2030, 1, 1, 17)):
+        assert app.pack_cache_key(COMPANY_INFO) == new_year
+    with app.pinned_clock(datetime(2030, 1, 2, 9)):
+        assert app.pack_cache_key(COMPANY_INFO) != new_year
+
+
+def test_fingerprint_follows_module_constants(monkeypatch):
+    before = app.template_fingerprint('rental_agreement')
+    app.template_fingerprint.cache_clear()
+    monkeypatch.setattr(app, 'DISCLAIMER_TEXT', app.DISCLAIMER_TEXT + " Amended.")
+    try:
+        assert app.template_fingerprint('rental_agreement') != before
+    finally:
+        app.template_fingerprint.cache_clear()
+
+
+def test_fingerprint_is_stable_within_a_process():
+    first = app.template_fingerprint('invoice')
+    app.template_fingerprint.cache_clear()
+    assert app.template_fingerprint('invoice') == first
+
+
+def test_weak_etag_answers_304_before_building(client, no_builds):
+    key = app.pack_cache_key(COMPANY_INFO)
+    response = client.post('/generate-pack', json=COMPANY_INFO, headers={'If-None-Match': f'W/"{key}"'})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == f'W/"{key}"'
+
+    key = app.pack_cache_key(COMPANY_INFO, ['invoice'], kind='file')
+    response = client.post('/generate/invoice', json=COMPANY_INFO, headers={'If-None-Match': f'W/"{key}"'})
+    assert response.status_code == 304
+
+
+def test_etag_round_trip(client):
+    response = client.post('/generate-pack?docs=invoice,quotation', json=COMPANY_INFO)
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert etag.startswith('W/"')
+    assert response.headers['X-Pack-Cache'] == 'miss'
+
+    again = client.post('/generate-pack?docs=invoice,quotation', json=COMPANY_INFO)
+    assert again.headers['X-Pack-Cache'] == 'hit' and again.data == response.data
+    assert client.post('/generate-pack?docs=invoice,quotation', json=COMPANY_INFO,
+                       headers={'If-None-Match': etag}).status_code == 304
+    # A different selection is a different pack
+    other = client.post('/generate-pack?docs=invoice', json=COMPANY_INFO, headers={'If-None-Match': etag})
+    assert other.status_code == 200 and other.headers['ETag'] != etag
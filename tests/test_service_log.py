@@ -0,0 +1,46 @@
+import io
+import os
+import tempfile
+
+import pytest
+
+import app
+
+COMPANY_FORM = {
+    "name": "Syarikat Jentera Maju Sdn Bhd",
+    "phone": "+60 3-5566 7788",
+    "email": "admin@jenteramaju.com.my",
+    "tax_id": "W10-1808-32001234",
+    "reg_no": "201901012345 (1234567-A)",
+    "address": "No. 8, Jalan Perindustrian 3, 47100 Puchong, Selangor",
+    "bank_name": "Maybank Berhad",
+    "bank_account": "5144 2233 6789",
+    "swift_code": "MBBEMYKL",
+}
+
+
+@pytest.fixture
+def scratch_dir(monkeypatch, tmp_path):
+    """Send every temp file (openpyxl's write-only sheets included) to an empty directory."""
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    return tmp_path
+
+
+def upload(csv_text):
+    client = app.app.test_client()
+    form = dict(COMPANY_FORM, service_log=(io.BytesIO(csv_text.encode()), 'service_log.csv'))
+    return client.post('/generate/service_log', data=form, content_type='multipart/form-data')
+
+
+def test_bad_row_names_the_row_and_leaves_no_temp_file(scratch_dir):
+    response = upload("equipment_id,labour_cost,parts_cost\nEQ-001,500,850\nEQ-002,abc,450\n")
+    assert response.status_code in (400, 500)
+    assert "row 2" in response.json['error'] and "labour_cost" in response.json['error']
+    assert os.listdir(scratch_dir) == []
+
+
+def test_uploaded_log_builds(scratch_dir):
+    response = upload("Equipment ID,Labour Cost,Parts Cost\nEQ-001,500,850\nEQ-002,1200,450\n")
+    assert response.status_code == 200
+    assert response.data[:2] == b'PK'
+    assert os.listdir(scratch_dir) == []
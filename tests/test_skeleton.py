@@ -0,0 +1,35 @@
+import pytest
+
+import app
+
+SKELETON_DOCUMENTS = [doc_id for doc_id in app.DOCUMENT_IDS
+                      if app.DOCUMENT_BUILDERS[doc_id][0].endswith(('.docx', '.xlsx'))]
+
+COMPANY_INFO = {
+    "name": "Kedai Jentera \"Ah Chong\" & Anak-Anak <Sdn> Bhd",
+    "phone": "+60 3-5566 7788",
+    "email": "o'brien@jentera.com.my",
+    "tax_id": "W10-1808-32001234",
+    "reg_no": "201901012345 (1234567-A)",
+    "address": "Tingkat 3, Menara Cahaya – Jalan Sultan Ismail, 50250 Kuala Lumpur",
+    "bank_name": "Bank Kerjasama Rakyat Malaysia Berhad · Cawangan Pusat Bandar",
+    "bank_account": "5144 2233 6789",
+    "swift_code": "BKRMMYKL",
+}
+
+
+@pytest.mark.parametrize('doc_id', SKELETON_DOCUMENTS)
+def test_skeleton_matches_full_render(doc_id):
+    patched = app.render_from_skeleton(doc_id, COMPANY_INFO)
+    assert patched is not None, "the skeleton should handle escaped and non-ASCII values"
+    full = app.render_full_document(doc_id, COMPANY_INFO)
+    assert app.archive_members(patched) == app.archive_members(full)
+
+
+@pytest.mark.parametrize('value', [" Padded Sdn Bhd", "=HYPERLINK(\"http://example.com\")"])
+@pytest.mark.parametrize('doc_id', SKELETON_DOCUMENTS)
+def test_unpatchable_value_falls_back_to_full_render(doc_id, value):
+    COMPANY = dict(COMPANY_INFO, name=value)
+    assert app.render_from_skeleton(doc_id, COMPANY) is None
+    rendered = app.render_document(doc_id, COMPANY)
+    assert app.archive_members(rendered) == app.archive_members(app.render_full_document(doc_id, COMPANY))